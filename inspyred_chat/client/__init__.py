@@ -1,31 +1,228 @@
+import os
 import socket
+import ssl
 import threading
+from datetime import datetime
+from functools import lru_cache
+from itertools import count
+from pathlib import Path
+from random import uniform
+from time import sleep
 
+from inspyred_chat import protocol
+from inspyred_chat.client.cli import CLIArgs
 from inspyred_chat.client.commands import CMD_PREFIX, valid_commands
+from inspyred_chat.client.output import Output
+from inspyred_chat.client.store import DEFAULT_STORE, MessageStore
 
 from uuid import uuid4
 import uuid
 
 UUID = uuid4()
 
+DOWNLOAD_DIR = Path.home().joinpath('Downloads')
+"""
+(pathlib.Path) - Where fetched files are saved. Files are downloaded into '<file_id>.part' and renamed once complete,
+so that a download can be resumed without knowing the file's name. A file never replaces one that's already there;
+it's saved as e.g. 'name (1).ext' instead.
+"""
+
+UPLOAD_RATE = 1024 * 1024
+"""
+(int) - The most bytes per second we'll upload, so that file uploads never crowd out our chat messages.
+"""
+
+RECV_SIZE = 256 * 1024
+"""
+(int) - The most bytes we'll take off the socket at once. Everything complete in it is dealt with before the next read.
+"""
+
+RECV_BUFFER = 1024 * 1024
+"""
+(int) - The kernel receive buffer we ask for, so that a burst from the server waits on our side of the connection 
+rather than in the server's write buffer.
+"""
+
+RECONNECT_DELAY = 0.5
+"""
+(float) - The longest we wait, in seconds, before the first attempt at reconnecting to a server we lost. Each attempt
+waits a random time up to this, so that a server dropping everybody at once isn't hit by everybody at once, and the
+limit doubles after every failed attempt.
+"""
+
+RECONNECT_MAX_DELAY = 30.0
+"""
+(float) - The longest we ever wait between two attempts at reconnecting.
+"""
+
+RECONNECT_ATTEMPTS = 10
+"""
+(int) - How many times we try to reconnect before giving up.
+"""
+
+TLS_SESSIONS = {}
+"""
+(dict) - The last TLS session we had with each server, keyed by '(addr, port)', so that reconnecting can resume it
+instead of doing a full handshake. The 'ssl' module can't save sessions to disk, so they only last as long as the
+client does; it reconnects by itself rather than lose them.
+"""
+
 # nick = input('Please choose a nickname: ')
 
 
+@lru_cache(maxsize=None)
+def tls_context(cafile=None):
+    """
+    Get the (cached) 'SSLContext' for connecting to TLS servers.
+
+    Arguments:
+        cafile (str):
+            A CA bundle, or the server's own certificate if it's self-signed, to verify the server against. The
+            system's trusted CAs are used if this isn't given.
+
+    Returns:
+        ssl.SSLContext:
+            The context.
+    """
+    return ssl.create_default_context(cafile=cafile)
+
+
 class Client:
-    def __init__(self, addr, port, nick=None):
+    def __init__(self, addr, port, nick=None, tls=False, cafile=None, store_path=DEFAULT_STORE):
+
+        while nick is None or not protocol.valid_nick(nick):
+            nick = input('Please choose a nickname (no spaces): ').strip()
 
-        self._nick = input('Please choose a nickname: ') if nick is None else nick
+        self._nick = nick
         self.addr = addr
         self.port = port
+        self.tls = tls
+        self.cafile = cafile
+        self.closing = False
+
+        self.roster = {}
+        self.roster_version = None
+
+        self.server = f'{addr}:{port}'
+        self.store = MessageStore(store_path)
+        self.epoch = None
+        self.high_water = 0
+        self.scrollback = None
 
-        self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client.connect((self.addr, self.port))
+        self.output = Output()
+
+        # The handler for each kind of server message, keyed by its first word. Anything else is shown as it is.
+        self.handlers = {
+            'CHAT': self.handle_chat,
+            'SYNC': self.handle_sync,
+            'HISTORY': self.handle_history_end,
+            'ROSTER': self.apply_roster,
+            'FILE': self.handle_file_message,
+            'REQ': self.handle_request,
+            'NICK': self.handle_nick_rejected,
+        }
+
+        self.send_lock = threading.Lock()
+        self.files = {}
+        self.uploads = {}
+        self.uploading = set()
+        self.downloads = {}
+        self.sink = None
+
+        self.client = None
+        self.connect()
 
         self.start_connection()
 
+    def connect(self):
+        """
+        Open a connection to the server, resuming our last TLS session with it if we have one.
+
+        Returns:
+            None
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Has to be set before connecting for the kernel to advertise a window this big.
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER)
+
+        try:
+            sock.connect((self.addr, self.port))
+
+            if self.tls:
+                sock = tls_context(self.cafile).wrap_socket(
+                    sock,
+                    server_hostname=self.addr,
+                    session=TLS_SESSIONS.get((self.addr, self.port))
+                )
+        except OSError:
+            sock.close()
+            raise
+
+        self.client = sock
+
+    def reconnect(self):
+        """
+        Connect to the server again after losing the connection.
+
+        Anything that belonged to the old connection is dropped; downloads can be picked up again with '/fetch' and
+        uploads by sending the file again. The chat we missed is caught up on once the server sends its 'SYNC'.
+
+        Returns:
+            Boolean:
+                True once we're connected again, False if we gave up or were told to disconnect meanwhile.
+        """
+        self.client.close()
+        self.sink = None
+        self.roster_version = None
+
+        for file in self.downloads.values():
+            file.close()
+        self.downloads.clear()
+
+        delay = RECONNECT_DELAY
+
+        for _ in range(RECONNECT_ATTEMPTS):
+            sleep(uniform(0, delay))
+
+            if self.closing:
+                return False
+
+            try:
+                self.connect()
+                return True
+            except OSError:
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+        return False
+
+    def remember_tls_session(self):
+        """
+        Keep hold of our TLS session so that the next connection to this server can resume it.
+
+        TLS 1.3 servers only send their session tickets after the handshake, so this is called once the server has
+        started talking to us, and again on the way out.
+
+        Returns:
+            None
+        """
+        if self.tls and self.client.session is not None:
+            TLS_SESSIONS[(self.addr, self.port)] = self.client.session
+
     def disconnect(self):
+        if self.closing:
+            return
+
+        self.closing = True
+        self.remember_tls_session()
         self.client.close()
 
+        if self.epoch is not None:
+            self.store.set_high_water(self.server, self.epoch, self.high_water)
+
+        # Closing, rather than just committing, also folds the write-ahead log back into the database.
+        self.store.close()
+        self.output.close()
+
     def start_connection(self):
         recv_thread = threading.Thread(target=self.receive)
         recv_thread.start()
@@ -42,39 +239,475 @@ class Client:
         self.write()
         self._nick = new_nickname
 
+    def send_line(self, msg):
+        with self.send_lock:
+            self.client.sendall(protocol.encode_line(msg))
+
+    def offer_file(self, path):
+        """
+        Offer a file to the server. The upload itself starts once the server tells us where to start from.
+
+        The file ID is worked out from the file's path, size and modification time, so offering the same file again
+        after an interrupted upload resumes it rather than starting over.
+
+        Arguments:
+            path (str|pathlib.Path):
+                The file to upload.
+
+        Returns:
+            None
+        """
+        path = Path(path).expanduser().resolve()
+        stat = path.stat()
+        file_id = uuid.uuid5(uuid.NAMESPACE_URL, f'{path}:{stat.st_size}:{stat.st_mtime_ns}').hex
+
+        self.uploads[file_id] = path
+        self.send_line(f'{CMD_PREFIX}{protocol.CMD_UPLOAD} {file_id} {stat.st_size} {path.name}')
+
+    def upload(self, file_id, offset):
+        """
+        Send a file to the server in '/chunk' frames, starting at `offset`.
+
+        Each chunk is sent straight from the file with 'socket.sendfile()' while holding the send lock, so chat lines
+        can only go out between chunks. Uploads are held to `UPLOAD_RATE`.
+
+        Arguments:
+            file_id (str):
+                The file's ID.
+
+            offset (int):
+                Where the server wants us to start.
+
+        Returns:
+            None
+        """
+        path = self.uploads[file_id]
+        size = path.stat().st_size
+
+        try:
+            with open(path, 'rb') as file:
+                while offset < size:
+                    length = min(protocol.CHUNK_SIZE, size - offset)
+
+                    with self.send_lock:
+                        self.client.sendall(
+                            protocol.encode_line(f'{CMD_PREFIX}{protocol.CMD_CHUNK} {file_id} {offset} {length}')
+                        )
+                        self.client.sendfile(file, offset, length)
+
+                    offset += length
+                    sleep(length / UPLOAD_RATE)
+        except OSError:
+            self.output.emit(f'Sending {path.name} was interrupted. Send it again to carry on where it stopped.')
+        finally:
+            self.uploading.discard(file_id)
+
+    def fetch_file(self, file_id):
+        """
+        Ask the server for a file, carrying on from wherever an earlier attempt got to.
+
+        Arguments:
+            file_id (str):
+                The ID from the 'FILE AVAILABLE' announcement.
+
+        Returns:
+            None
+        """
+        if not protocol.FILE_ID.match(file_id):
+            self.output.emit(f'{file_id!r} isn\'t a file ID.')
+            return
+
+        part = DOWNLOAD_DIR.joinpath(f'{file_id}.part')
+        offset = part.stat().st_size if part.exists() else 0
+
+        self.send_line(f'{CMD_PREFIX}{protocol.CMD_FETCH} {file_id} {offset}')
+
+    def start_download(self, line):
+        """
+        Get ready for a file the server is about to send, from its 'FILE START' line.
+
+        Arguments:
+            line (str):
+                The 'FILE START' line.
+
+        Returns:
+            None
+        """
+        file_id, size, name = line[len(protocol.FILE_START) + 1:].split(' ', 2)
+        name = protocol.file_name(name)
+
+        if not protocol.FILE_ID.match(file_id) or name is None or not size.isdigit():
+            self.output.emit(f'Not fetching a file the server sent under a bad ID or name: {line}')
+            return
+
+        self.files[file_id] = (name, int(size))
+
+        if file_id in self.downloads:
+            return
+
+        DOWNLOAD_DIR.mkdir(parents=True, exist_ok=True)
+        part = DOWNLOAD_DIR.joinpath(f'{file_id}.part')
+
+        if part.exists() and part.stat().st_size >= int(size):
+            self.save_download(file_id)
+        else:
+            self.downloads[file_id] = open(part, 'r+b' if part.exists() else 'wb')
+
+    def save_download(self, file_id):
+        """
+        Move a finished download into place under its own name, or the first variation of it that isn't taken.
+
+        Arguments:
+            file_id (str):
+                The file's ID.
+
+        Returns:
+            None
+        """
+        name, _ = self.files[file_id]
+        part = DOWNLOAD_DIR.joinpath(f'{file_id}.part')
+        stem, suffix = Path(name).stem, Path(name).suffix
+
+        try:
+            for n in count():
+                target = DOWNLOAD_DIR.joinpath(f'{stem} ({n}){suffix}' if n else name)
+                try:
+                    # Unlike renaming, linking never replaces a file that's already there.
+                    os.link(part, target)
+                except FileExistsError:
+                    continue
+                break
+
+            part.unlink()
+        except OSError as err:
+            self.output.emit(f'Unable to save {name}: {err}. The download was kept as {part}')
+            return
+
+        self.output.emit(f'Saved {target}')
+
+    def start_sink(self, line):
+        """
+        Get ready to save the raw bytes following a 'FILE DATA' line.
+
+        Data for a file we didn't get a 'FILE START' for is read and thrown away.
+
+        Arguments:
+            line (str):
+                The 'FILE DATA' line.
+
+        Returns:
+            None
+        """
+        file_id, offset, length = line[len(protocol.FILE_DATA) + 1:].split(' ')
+
+        file = self.downloads.get(file_id)
+        if file is not None:
+            file.seek(int(offset))
+
+        self.sink = [file_id, int(length)]
+
+    def write_sink(self, view):
+        """
+        Save received raw bytes into the file being downloaded.
+
+        Arguments:
+            view (memoryview):
+                The received data.
+
+        Returns:
+            int:
+                How many bytes of `view` belonged to the file.
+        """
+        file_id, expecting = self.sink
+        view = view[:expecting]
+
+        file = self.downloads.get(file_id)
+        if file is not None:
+            file.write(view)
+
+        if len(view) < expecting:
+            self.sink[1] -= len(view)
+            return len(view)
+
+        self.sink = None
+
+        if file is not None and file.tell() >= self.files[file_id][1]:
+            file.close()
+            del self.downloads[file_id]
+            self.save_download(file_id)
+
+        return len(view)
+
+    def handle_file_message(self, line):
+        if line.startswith(protocol.FILE_DATA):
+            self.start_sink(line)
+
+        elif line.startswith(protocol.FILE_START):
+            self.start_download(line)
+
+        elif line.startswith(protocol.FILE_ACCEPT):
+            file_id, offset = line[len(protocol.FILE_ACCEPT) + 1:].split(' ')
+            if file_id in self.uploads and file_id not in self.uploading:
+                self.uploading.add(file_id)
+                threading.Thread(target=self.upload, args=(file_id, int(offset)), daemon=True).start()
+
+        elif line.startswith(protocol.FILE_AVAILABLE):
+            file_id, size, nick, name = line[len(protocol.FILE_AVAILABLE) + 1:].split(' ', 3)
+            if not protocol.FILE_ID.match(file_id) or protocol.file_name(name) is None or not size.isdigit():
+                return
+            self.files[file_id] = (protocol.file_name(name), int(size))
+            self.output.emit(
+                f'{nick} shared {name} ({size} bytes). Type \'{CMD_PREFIX}fetch {file_id}\' to download it.'
+            )
+
+        elif line.startswith(protocol.FILE_ERROR):
+            file_id = line[len(protocol.FILE_ERROR) + 1:].partition(' ')[0]
+            if file_id in self.downloads:
+                self.downloads.pop(file_id).close()
+            self.output.emit(f'File transfer failed: {line[len(protocol.FILE_ERROR) + 1:]}')
+
+        else:
+            self.output.emit(line)
+
+    def handle_request(self, line):
+        if line == protocol.REQ_NICK:
+            self.remember_tls_session()
+            self.send_line(self.nickname)
+        elif line == protocol.REQ_UUID:
+            self.send_line(str(UUID))
+            self.send_line(f'{protocol.CMD_PREFIX}{protocol.CMD_ROSTER}')
+        else:
+            self.output.emit(line)
+
+    def handle_nick_rejected(self, line):
+        # We'd only give the same nickname again, so there's no point staying connected.
+        self.output.emit(f'The server won\'t accept our nickname: {line[len(protocol.NICK_REJECTED) + 1:]}')
+        self.disconnect()
+
+    def apply_roster(self, line):
+        """
+        Bring our copy of the server's roster up to date from a 'ROSTER' message, and tell the user who came and went.
+
+        Deltas that don't follow on from the version we hold are ignored, and a fresh snapshot is asked for instead.
+
+        Arguments:
+            line (str):
+                The 'ROSTER SNAPSHOT' or 'ROSTER DELTA' line from the server.
+
+        Returns:
+            None
+        """
+        from_version, to_version, added, removed = protocol.parse_roster(line)
+
+        if from_version is None:
+            self.roster = added
+            self.roster_version = to_version
+            self.output.emit(f'Users online: {", ".join(sorted(self.roster.values()))}')
+            return
+
+        if self.roster_version is None or to_version <= self.roster_version:
+            return
+
+        if from_version != self.roster_version:
+            self.send_line(f'{protocol.CMD_PREFIX}{protocol.CMD_ROSTER}')
+            return
+
+        for uid in removed:
+            nick = self.roster.pop(uid, None)
+            if nick is not None:
+                self.output.emit(f'{nick} left the server!')
+
+        for uid, nick in added.items():
+            self.roster[uid] = nick
+            self.output.emit(f'{nick} joined!')
+
+        self.roster_version = to_version
+
+    def handle_sync(self, line):
+        """
+        Work out what we missed since we were last connected, from the server's 'SYNC' line, and ask for it.
+
+        If the server has started a new epoch since, our high-water mark means nothing to it and we ask for everything
+        it still has.
+
+        Arguments:
+            line (str):
+                The 'SYNC' line.
+
+        Returns:
+            None
+        """
+        epoch, latest = line[len(protocol.SYNC) + 1:].split(' ')
+        stored_epoch, seq = self.store.high_water(self.server)
+
+        self.epoch = epoch
+        self.high_water = seq if stored_epoch == epoch else 0
+
+        if self.high_water < int(latest):
+            self.send_line(f'{CMD_PREFIX}{protocol.CMD_HISTORY} {self.high_water}')
+
+    def handle_chat(self, line):
+        """
+        Keep and show a chat message, unless we've already got it.
+
+        Arguments:
+            line (str):
+                The 'CHAT' line.
+
+        Returns:
+            None
+        """
+        seq, time_ms, nick, text, display = protocol.parse_chat(line)
+
+        new = self.store.add(self.server, self.epoch, seq, time_ms, nick, text)
+
+        # Only move the high-water mark while we hold everything up to it; anything after a gap will come round again
+        # with the history we asked for.
+        if seq == self.high_water + 1:
+            self.high_water = seq
+
+        if new:
+            self.output.emit(display)
+
+    def handle_history_end(self, line):
+        last, latest = (int(seq) for seq in line[len(protocol.HISTORY_END) + 1:].split(' '))
+
+        # Whatever the server no longer had is gone for good, so don't wait for it.
+        if last > self.high_water:
+            self.high_water = last
+
+        if last < latest:
+            self.send_line(f'{CMD_PREFIX}{protocol.CMD_HISTORY} {last}')
+
+    def show_scrollback(self):
+        """
+        Show the next page of older messages from the local store. Each call goes further back.
+
+        Returns:
+            None
+        """
+        rows = self.store.page(self.server, self.scrollback)
+
+        if not rows:
+            self.output.emit('No more scrollback.')
+            return
+
+        self.scrollback = (rows[0][2], rows[0][0])
+
+        for _, _, time_ms, nick, text in rows:
+            self.output.emit(f'[{datetime.fromtimestamp(time_ms / 1000):%Y-%m-%d %H:%M}] <<{nick}>> {text}')
+
+    def dispatch(self, line):
+        handler = self.handlers.get(line.partition(' ')[0])
+
+        if handler is None:
+            self.output.emit(line)
+        else:
+            handler(line)
+
+    def process(self, data):
+        """
+        Deal with every complete message in received data.
+
+        All the complete lines are decoded in one go and handed to their handlers. Raw file data following a 'FILE
+        DATA' line goes straight into the file being downloaded.
+
+        Arguments:
+            data (bytes):
+                The received data, including anything left over from last time.
+
+        Returns:
+            int:
+                How much of `data` was used. The rest is the start of a message that hasn't fully arrived yet.
+        """
+        pos = 0
+
+        with memoryview(data) as view:
+            while pos < len(data):
+                if self.sink is not None:
+                    pos += self.write_sink(view[pos:])
+                    continue
+
+                end = data.rfind(protocol.TERMINATOR, pos)
+                if end == -1:
+                    break
+
+                # ASCII decoding turns every byte into exactly one character (undecodable ones into a replacement
+                # character), so lengths in the text are lengths in `data`.
+                for line in data[pos:end].decode(protocol.ENCODING, errors='replace').split('\n'):
+                    pos += len(line) + 1
+                    self.dispatch(line)
+
+                    # Whatever follows is raw file data, which we may have decoded as lines above; go back for it.
+                    if self.sink is not None:
+                        break
+
+        return pos
+
     def receive(self):
+        pending = b''
         while True:
             try:
-                msg = self.client.recv(1024).decode('ascii')
-                if msg == 'REQ NICK':
-                    self.client.send(self.nickname.encode('ascii'))
-                elif msg == 'REQ UUID':
-                    self.client.send(str(UUID).encode('ascii'))
-                else:
-                    print(msg)
+                data = self.client.recv(RECV_SIZE)
+                if not data:
+                    raise ConnectionResetError()
+
+                data = pending + data if pending else data
+                pending = data[self.process(data):]
+
+                # One transaction for everything that arrived in this read.
+                if self.epoch is not None:
+                    self.store.set_high_water(self.server, self.epoch, self.high_water)
+                self.store.commit()
             except:
-                print('An unknown error occurred')
-                self.client.close()
-                break
+                if self.closing:
+                    break
+
+                self.output.emit('Lost the connection to the server. Reconnecting...')
+                pending = b''
+
+                if not self.reconnect():
+                    if not self.closing:
+                        self.output.emit('Unable to reconnect to the server.')
+                    break
 
     def write(self):
         while True:
-            msg = input("")
+            try:
+                msg = input("")
+            except (EOFError, KeyboardInterrupt):
+                self.disconnect()
+                break
+
             vc = valid_commands
             if not msg.startswith('/'):
-                self.client.send(msg.encode('ascii'))
+                try:
+                    self.send_line(msg)
+                except OSError:
+                    self.output.emit('Not connected to the server; your message wasn\'t sent.')
             else:
-                cmd = msg.replace('/', '').lower()
+                cmd, *args = msg[len(CMD_PREFIX):].split(' ', 1)
+                cmd = cmd.lower()
                 if cmd in vc.keys():
-                    vc[cmd]['func'](self.client)
+                    vc[cmd]['func'](self, *args)
                     if cmd == 'disconnect':
                         break
                 else:
-                    print('Unknown command!')
+                    self.output.emit('Unknown command!')
 
 
-chat_client = Client('192.168.2.145', 5300)
-client = chat_client.client
+def main():
+    args = CLIArgs().parse_args()
+
+    Client(
+        args.host,
+        args.port,
+        nick=args.nick,
+        tls=args.tls or args.cafile is not None,
+        cafile=args.cafile,
+        store_path=args.store
+    )
+
 
 # def receive():
 #     while True:
@@ -94,3 +727,7 @@ client = chat_client.client
 #     while True:
 #         msg = f'{nick}: {input("")}'
 #         client.send(msg.encode('ascii'))
+
+
+if __name__ == '__main__':
+    main()
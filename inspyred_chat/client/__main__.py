@@ -0,0 +1,3 @@
+from inspyred_chat.client import main
+
+main()
@@ -0,0 +1,93 @@
+from argparse import ArgumentParser, ArgumentTypeError
+
+from inspyred_chat import protocol
+from inspyred_chat.client.store import DEFAULT_STORE
+
+DEFAULT_HOST = '192.168.2.145'
+
+DEFAULT_PORT = 5300
+
+
+def nickname(value):
+    """
+    Parse a nickname given on the command line.
+
+    Arguments:
+        value (str):
+            The value as given.
+
+    Returns:
+        str:
+            The nickname.
+
+    Raises:
+        argparse.ArgumentTypeError:
+            If the server wouldn't accept the nickname.
+    """
+    if not protocol.valid_nick(value):
+        raise ArgumentTypeError(f'can\'t be empty or contain spaces or control characters, not {value!r}')
+
+    return value
+
+
+class CLIArgs(ArgumentParser):
+    def __init__(self):
+        """
+        Sets up command-line arguments for the chat client.
+        """
+        super().__init__()
+
+        self.description = 'Connect to an Inspyred Chat server.'
+        self.prog = 'inspyred-chat'
+
+        self.add_argument(
+            'host',
+            action='store',
+            nargs='?',
+            help=f'The address of the server to connect to. The default is: {DEFAULT_HOST}',
+            default=DEFAULT_HOST
+        )
+
+        self.add_argument(
+            'port',
+            action='store',
+            nargs='?',
+            type=int,
+            help=f'The port the server is listening on. The default is: {DEFAULT_PORT}',
+            default=DEFAULT_PORT
+        )
+
+        self.add_argument(
+            '-n',
+            '--nick',
+            action='store',
+            type=nickname,
+            required=False,
+            help='The nickname to chat under. You\'ll be asked for one if this isn\'t given.',
+            default=None
+        )
+
+        self.add_argument(
+            '--tls',
+            action='store_true',
+            required=False,
+            help='Connect over TLS. Needed for servers started with \'--tls\'.',
+            default=False
+        )
+
+        self.add_argument(
+            '--cafile',
+            action='store',
+            required=False,
+            help='Verify the server against this CA bundle, or against the server\'s own certificate if it\'s '
+                 'self-signed, instead of the system\'s trusted CAs. Implies \'--tls\'.',
+            default=None
+        )
+
+        self.add_argument(
+            '--store',
+            action='store',
+            required=False,
+            help=f'Where to keep the local copy of the chat. The default is: {DEFAULT_STORE}',
+            default=DEFAULT_STORE
+        )
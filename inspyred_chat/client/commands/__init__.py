@@ -4,13 +4,46 @@ def handle_command(cmd):
     pass
 
 
-def disconnect_from_server(server_instance, quit_msg='Leaving.'):
-    server_instance.close()
+def disconnect_from_server(client, quit_msg='Leaving.'):
+    client.disconnect()
+
+
+def send_file(client, path=None):
+    if path is None:
+        client.output.emit('Usage: /send <path>')
+        return
+
+    try:
+        client.offer_file(path)
+    except OSError as err:
+        client.output.emit(f'Unable to send {path}: {err}')
+
+
+def fetch_file(client, file_id=None):
+    if file_id is None:
+        client.output.emit('Usage: /fetch <file id>')
+        return
+
+    client.fetch_file(file_id.strip())
+
+
+def scrollback(client, *args):
+    client.show_scrollback()
+
 
 valid_commands = {
     'disconnect': {
         'func': disconnect_from_server
-    }
+    },
+    'send': {
+        'func': send_file
+    },
+    'fetch': {
+        'func': fetch_file
+    },
+    'scrollback': {
+        'func': scrollback
+    },
 }
 
 CMD_PREFIX = '/'
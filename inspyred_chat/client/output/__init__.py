@@ -0,0 +1,110 @@
+"""
+Coalesced, rate-limited terminal output for the chat client.
+
+Printing every message as it arrives means a write and a terminal flush per line, which is slower than a busy channel
+can fill. Instead, lines are queued and written out together a few times a second, in one write and one flush.
+
+The queue is bounded. If messages arrive faster than they can be shown, the oldest unshown ones are dropped and a note
+says how many; they're all still in the message store, and '/scrollback' shows them.
+"""
+import sys
+import threading
+from collections import deque
+from time import sleep
+
+FLUSH_INTERVAL = 0.05
+"""
+(float) - The shortest time, in seconds, between two writes to the terminal.
+"""
+
+MAX_PENDING = 2000
+"""
+(int) - How many lines may be waiting to be shown before the oldest are dropped.
+"""
+
+
+class Output:
+    def __init__(self, stream=None, interval=FLUSH_INTERVAL, max_pending=MAX_PENDING):
+        """
+        A background writer that shows queued lines in batches.
+
+        Arguments:
+            stream (io.TextIOBase):
+                Where to write. (Defaults to whatever 'sys.stdout' is when each batch is written)
+
+            interval (float):
+                The shortest time between two writes. (Defaults to `FLUSH_INTERVAL`)
+
+            max_pending (int):
+                How many lines may wait to be shown. (Defaults to `MAX_PENDING`)
+        """
+        self.stream = stream
+        self.interval = interval
+        self.pending = deque(maxlen=max_pending)
+        self.dropped = 0
+
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='output', daemon=True)
+        self._thread.start()
+
+    def emit(self, line):
+        """
+        Queue a line to be shown.
+
+        Arguments:
+            line (str):
+                The line, without a trailing newline.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            if len(self.pending) == self.pending.maxlen:
+                self.dropped += 1
+            self.pending.append(line)
+
+        self._wake.set()
+
+    def flush(self):
+        """
+        Write out everything queued, right now.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            if not self.pending:
+                return
+            lines = list(self.pending)
+            self.pending.clear()
+            dropped, self.dropped = self.dropped, 0
+
+        if dropped:
+            lines.insert(0, f'[{dropped} messages not shown; use /scrollback to see them]')
+
+        stream = self.stream or sys.stdout
+        stream.write('\n'.join(lines) + '\n')
+        stream.flush()
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait()
+            self._wake.clear()
+            self.flush()
+
+            # Let more lines gather before the next write.
+            sleep(self.interval)
+
+    def close(self):
+        """
+        Show whatever is still queued and stop the writer.
+
+        Returns:
+            None
+        """
+        self._closed = True
+        self._wake.set()
+        self._thread.join()
+        self.flush()
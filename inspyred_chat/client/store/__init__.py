@@ -0,0 +1,219 @@
+"""
+A local, on-disk copy of the chat, so that restarting the client keeps its scrollback and reconnecting only asks the
+server for what's new.
+
+Messages are kept in SQLite, indexed by the server's sequence numbers (for catching up) and by time (for looking
+back). Alongside them the store remembers each server's high-water mark; the newest message up to which we're sure to
+have everything.
+
+The store is kept to a bounded size on disk by dropping the oldest messages once it grows past its limit.
+"""
+import sqlite3
+import threading
+from pathlib import Path
+
+from appdirs import user_data_dir
+
+DEFAULT_STORE = Path(user_data_dir('InspyredChat', appauthor='Inspyre-Softworks')).joinpath('messages.sqlite3')
+"""
+(pathlib.Path) - Where the client keeps its messages unless told otherwise.
+"""
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+"""
+(int) - How big the store may grow on disk before the oldest messages are dropped.
+"""
+
+PRUNE_FRACTION = 0.1
+"""
+(float) - How much of the store to drop at once when it's grown too big, so pruning doesn't happen on every commit.
+"""
+
+PAGE_SIZE = 50
+"""
+(int) - How many messages a page of scrollback holds.
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    server TEXT NOT NULL,
+    epoch TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    time_ms INTEGER NOT NULL,
+    nick TEXT NOT NULL,
+    text TEXT NOT NULL,
+    UNIQUE (server, epoch, seq)
+);
+CREATE INDEX IF NOT EXISTS messages_by_time ON messages (server, time_ms);
+CREATE TABLE IF NOT EXISTS high_water (
+    server TEXT PRIMARY KEY,
+    epoch TEXT NOT NULL,
+    seq INTEGER NOT NULL
+);
+"""
+
+
+class MessageStore:
+    def __init__(self, path=DEFAULT_STORE, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        Open (or create) a message store.
+
+        Writes are only committed by `commit()`, so that a burst of received messages costs a single transaction.
+        The store can be used from more than one thread.
+
+        Arguments:
+            path (str|pathlib.Path):
+                The database file. (Defaults to `DEFAULT_STORE`)
+
+            max_bytes (int):
+                Roughly how big the file may grow. (Defaults to `DEFAULT_MAX_BYTES`)
+        """
+        self.path = Path(path).expanduser()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+
+        # Must be set before the first table is created to take effect, and lets pruning give space back.
+        self.db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+
+    def add(self, server, epoch, seq, time_ms, nick, text):
+        """
+        Keep a message.
+
+        Arguments:
+            server (str):
+                The server it came from, as 'host:port'.
+
+            epoch (str):
+                The server's epoch.
+
+            seq (int):
+                The message's sequence number.
+
+            time_ms (int):
+                When the server got the message, in milliseconds since the epoch.
+
+            nick (str):
+                The sender's nickname.
+
+            text (str):
+                The message.
+
+        Returns:
+            Boolean:
+                True if the message is new, False if we already had it.
+        """
+        with self.lock:
+            cursor = self.db.execute(
+                'INSERT OR IGNORE INTO messages (server, epoch, seq, time_ms, nick, text) VALUES (?, ?, ?, ?, ?, ?)',
+                (server, epoch, seq, time_ms, nick, text)
+            )
+
+        return cursor.rowcount == 1
+
+    def high_water(self, server):
+        """
+        Get the newest message up to which we have everything from a server.
+
+        Arguments:
+            server (str):
+                The server, as 'host:port'.
+
+        Returns:
+            A tuple of (epoch, seq):
+                (None, 0) if we've never synced with the server.
+        """
+        with self.lock:
+            row = self.db.execute('SELECT epoch, seq FROM high_water WHERE server = ?', (server,)).fetchone()
+
+        return row if row is not None else (None, 0)
+
+    def set_high_water(self, server, epoch, seq):
+        with self.lock:
+            self.db.execute(
+                'INSERT INTO high_water (server, epoch, seq) VALUES (?, ?, ?) '
+                'ON CONFLICT (server) DO UPDATE SET epoch = excluded.epoch, seq = excluded.seq',
+                (server, epoch, seq)
+            )
+
+    def commit(self):
+        """
+        Write out everything added since the last commit, pruning the oldest messages if the store has grown too big.
+
+        Returns:
+            None
+        """
+        with self.lock:
+            self.db.commit()
+
+            while self.size() > self.max_bytes and self._prune():
+                pass
+
+    def size(self):
+        """
+        How many bytes of the database file are in use.
+        """
+        page_size, = self.db.execute('PRAGMA page_size').fetchone()
+        pages, = self.db.execute('PRAGMA page_count').fetchone()
+        free, = self.db.execute('PRAGMA freelist_count').fetchone()
+        return (pages - free) * page_size
+
+    def _prune(self):
+        count, = self.db.execute('SELECT COUNT(*) FROM messages').fetchone()
+        drop = max(1, int(count * PRUNE_FRACTION))
+
+        dropped = self.db.execute(
+            'DELETE FROM messages WHERE id IN (SELECT id FROM messages ORDER BY time_ms LIMIT ?)', (drop,)
+        ).rowcount
+        self.db.commit()
+        self.db.execute('PRAGMA incremental_vacuum')
+
+        return dropped
+
+    def page(self, server, before=None, limit=PAGE_SIZE):
+        """
+        Get a page of scrollback.
+
+        Messages are in the order the server got them, which for history we caught up on later isn't the order they
+        arrived here. Pages are found through the time index rather than by offset, so any page is as quick to get as
+        the first.
+
+        Arguments:
+            server (str):
+                The server, as 'host:port'.
+
+            before (tuple):
+                Only return messages older than this one, given as the '(time_ms, id)' of the first message on the
+                previous page. (Defaults to the newest messages)
+
+            limit (int):
+                The most messages to return. (Defaults to `PAGE_SIZE`)
+
+        Returns:
+            list:
+                Tuples of (id, seq, time_ms, nick, text), oldest first.
+        """
+        query = 'SELECT id, seq, time_ms, nick, text FROM messages WHERE server = ?'
+        args = [server]
+
+        if before is not None:
+            query += ' AND (time_ms, id) < (?, ?)'
+            args.extend(before)
+
+        with self.lock:
+            rows = self.db.execute(f'{query} ORDER BY time_ms DESC, id DESC LIMIT ?', (*args, limit)).fetchall()
+
+        rows.reverse()
+        return rows
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
@@ -0,0 +1,327 @@
+"""
+The wire protocol spoken between the chat server and its clients.
+
+Every message, in either direction, is a single line of ASCII text ending in '\\n'. The server sends;
+
+    CHAT <seq> <time> <<nick>> <text>
+        A chat message. Every message gets the next sequence number <seq>, and <time> is when the server got it, in
+        milliseconds since the epoch. Everything from '<<' on is the message as it should be shown.
+
+    SYNC <epoch> <seq>
+        Sent as soon as the handshake is done. <seq> is the newest chat message so far. Sequence numbers are only
+        comparable within the same <epoch>; a server that starts afresh (rather than taking over from another) starts
+        a new one.
+
+    HISTORY END <last> <latest>
+        Ends the answer to a '/history' request. <last> is the newest message that was sent with it. If it's older
+        than <latest>, ask again from <last> for the rest.
+
+    REQ NICK
+    REQ UUID
+        Handshake requests; the client answers each with a single line. Nicknames have to pass `valid_nick()`.
+
+    NICK REJECTED <reason>
+        The nickname the client gave can't be used. The server asks for another one straight after.
+
+    ROSTER SNAPSHOT <version> <json>
+        The full list of connected users, as a JSON object of '{client_uuid_hex: nick}'.
+
+    ROSTER DELTA <from_version> <to_version> <json>
+        The changes between two roster versions, as a JSON object of '{"+": {client_uuid_hex: nick}, "-": [...]}'.
+        A client holding roster version <from_version> applies it to get to <to_version>. Any other client should ask
+        for a new snapshot instead.
+
+    FILE ACCEPT <file_id> <offset>
+        The server is ready for the upload of <file_id>, starting at byte <offset>. Uploads that were cut short are
+        resumed by offering the same <file_id> again.
+
+    FILE AVAILABLE <file_id> <size> <nick> <name>
+        Someone finished uploading a file, which can now be fetched.
+
+    FILE START <file_id> <size> <name>
+        The answer to a '/fetch'. The file's 'FILE DATA' chunks follow, unless the client already has all <size>
+        bytes of it.
+
+    FILE DATA <file_id> <offset> <length>
+        Followed by exactly <length> raw bytes of the file, starting at <offset>. Files are sent in chunks of at most
+        `CHUNK_SIZE` bytes, and other lines may arrive between chunks.
+
+    FILE ERROR <file_id> <reason>
+        A transfer couldn't go ahead.
+
+Lines a client sends that start with `CMD_PREFIX` are commands for the server rather than chat;
+
+    /roster
+        Ask for a roster snapshot.
+
+    /upload <file_id> <size> <name>
+        Offer a file. The client picks <file_id>; 32 lowercase hex digits, e.g. 'uuid4().hex'. <name> has to pass
+        `file_name()`.
+
+    /chunk <file_id> <offset> <length>
+        Followed by exactly <length> raw bytes of the file being uploaded.
+
+    /fetch <file_id> [<offset>]
+        Ask for a file, optionally resuming from <offset>. An <offset> equal to the file's size just gets the 'FILE
+        START' line.
+
+    /history <seq>
+        Ask for the chat messages after <seq> that the server still remembers, as 'CHAT' lines.
+"""
+import json
+import re
+
+ENCODING = 'ascii'
+
+TERMINATOR = b'\n'
+
+MAX_LINE = 4096
+"""
+(int) - The longest line, in bytes, we're willing to buffer while waiting for its terminator.
+"""
+
+CMD_PREFIX = '/'
+
+CHAT = 'CHAT'
+SYNC = 'SYNC'
+HISTORY_END = 'HISTORY END'
+
+REQ_NICK = 'REQ NICK'
+REQ_UUID = 'REQ UUID'
+NICK_REJECTED = 'NICK REJECTED'
+ROSTER_SNAPSHOT = 'ROSTER SNAPSHOT'
+ROSTER_DELTA = 'ROSTER DELTA'
+
+FILE_ACCEPT = 'FILE ACCEPT'
+FILE_AVAILABLE = 'FILE AVAILABLE'
+FILE_START = 'FILE START'
+FILE_DATA = 'FILE DATA'
+FILE_ERROR = 'FILE ERROR'
+
+CMD_ROSTER = 'roster'
+CMD_UPLOAD = 'upload'
+CMD_CHUNK = 'chunk'
+CMD_FETCH = 'fetch'
+CMD_HISTORY = 'history'
+
+CHUNK_SIZE = 64 * 1024
+"""
+(int) - The most file data sent in a single 'FILE DATA' or '/chunk' frame.
+"""
+
+FILE_ID = re.compile(r'^[0-9a-f]{32}$')
+"""
+(re.Pattern) - What a file ID has to look like.
+"""
+
+
+def encode_line(text):
+    """
+    Turn a message into the bytes that go on the wire.
+
+    Any newlines inside the message are replaced with spaces so that it stays a single line.
+
+    Arguments:
+        text (str):
+            The message.
+
+    Returns:
+        bytes:
+            The encoded, terminated line.
+    """
+    return text.replace('\n', ' ').encode(ENCODING, errors='replace') + TERMINATOR
+
+
+def valid_nick(nick):
+    """
+    Check whether a nickname can be used.
+
+    Nicknames appear as a single space-separated field in roster, chat and file messages, so they can't be empty or
+    contain spaces or control characters.
+
+    Arguments:
+        nick (str):
+            The nickname.
+
+    Returns:
+        Boolean:
+            True if the nickname can be used.
+    """
+    return bool(nick) and nick.isprintable() and ' ' not in nick
+
+
+def file_name(name):
+    """
+    Get the bare file name out of a name given for a file, so that it's safe to save the file under.
+
+    Any directories in front of it are dropped, whichever kind of slash separates them.
+
+    Arguments:
+        name (str):
+            The name as given.
+
+    Returns:
+        str|None:
+            The file name, or None if there's nothing usable left; an empty name, '.', '..' or one with control
+            characters in it.
+    """
+    name = name.replace('\\', '/').rpartition('/')[2]
+
+    if name in ('', '.', '..') or not name.isprintable():
+        return None
+
+    return name
+
+
+def next_line(data, pos=0):
+    """
+    Find the next complete line in received data.
+
+    This lets the caller stop after any line, which is needed when a line announces raw bytes that follow it.
+
+    Arguments:
+        data (bytes|bytearray):
+            The received data.
+
+        pos (int):
+            Where in `data` to start looking. (Defaults to 0)
+
+    Returns:
+        A tuple of (line, pos):
+            line (str|None):
+                The line, decoded and without its terminator, or None if there isn't a complete line left.
+
+            pos (int):
+                Where the data after the line starts. Unchanged if no line was found.
+    """
+    end = data.find(TERMINATOR, pos)
+
+    if end == -1:
+        return None, pos
+
+    return bytes(data[pos:end]).decode(ENCODING, errors='replace'), end + 1
+
+
+def format_snapshot(version, members):
+    """
+    Build a 'ROSTER SNAPSHOT' line.
+
+    Arguments:
+        version (int):
+            The roster version.
+
+        members (dict):
+            The connected users' nicknames, keyed by their client UUID as an int.
+
+    Returns:
+        str:
+            The message.
+    """
+    return f'{ROSTER_SNAPSHOT} {version} {json.dumps({f"{uid:032x}": nick for uid, nick in members.items()})}'
+
+
+def format_delta(from_version, to_version, added, removed):
+    """
+    Build a 'ROSTER DELTA' line.
+
+    Arguments:
+        from_version (int):
+            The roster version the delta applies to.
+
+        to_version (int):
+            The roster version it produces.
+
+        added (dict):
+            The nicknames of users who joined, keyed by their client UUID as an int.
+
+        removed (iterable):
+            The client UUIDs, as ints, of users who left.
+
+    Returns:
+        str:
+            The message.
+    """
+    body = {
+        '+': {f'{uid:032x}': nick for uid, nick in added.items()},
+        '-': [f'{uid:032x}' for uid in removed],
+    }
+    return f'{ROSTER_DELTA} {from_version} {to_version} {json.dumps(body, separators=(",", ":"))}'
+
+
+def parse_roster(line):
+    """
+    Parse a 'ROSTER SNAPSHOT' or 'ROSTER DELTA' line.
+
+    Arguments:
+        line (str):
+            The line, as received.
+
+    Returns:
+        A tuple of (from_version, to_version, added, removed):
+            For a snapshot 'from_version' is None and 'added' holds every member. Client UUIDs are left as hex
+            strings.
+
+    Raises:
+        ValueError:
+            If the line isn't a well-formed roster message.
+    """
+    if line.startswith(ROSTER_SNAPSHOT):
+        version, body = line[len(ROSTER_SNAPSHOT) + 1:].split(' ', 1)
+        return None, int(version), json.loads(body), []
+
+    if line.startswith(ROSTER_DELTA):
+        from_version, to_version, body = line[len(ROSTER_DELTA) + 1:].split(' ', 2)
+        body = json.loads(body)
+        return int(from_version), int(to_version), body['+'], body['-']
+
+    raise ValueError(f'Not a roster message: {line!r}')
+
+
+def format_chat(seq, time_ms, nick, text):
+    """
+    Build a 'CHAT' line.
+
+    Arguments:
+        seq (int):
+            The message's sequence number.
+
+        time_ms (int):
+            When the server got the message, in milliseconds since the epoch.
+
+        nick (str):
+            The sender's nickname.
+
+        text (str):
+            The message.
+
+    Returns:
+        str:
+            The message.
+    """
+    return f'{CHAT} {seq} {time_ms} <<{nick}>> {text}'
+
+
+def parse_chat(line):
+    """
+    Parse a 'CHAT' line.
+
+    Arguments:
+        line (str):
+            The line, as received.
+
+    Returns:
+        A tuple of (seq, time_ms, nick, text, display):
+            'display' is the message as it should be shown. The nickname is split off at the first '>> ', so a
+            nickname that itself contains '>> ' comes out short.
+
+    Raises:
+        ValueError:
+            If the line isn't a well-formed chat message.
+    """
+    if not line.startswith(CHAT + ' '):
+        raise ValueError(f'Not a chat message: {line!r}')
+
+    seq, time_ms, display = line[len(CHAT) + 1:].split(' ', 2)
+    nick, _, text = display[2:].partition('>> ')
+
+    return int(seq), int(time_ms), nick, text, display
@@ -0,0 +1,664 @@
+"""
+A local control socket for looking inside a running server.
+
+The server listens on a Unix socket (see '--admin-socket') that only our own user can connect to. Each connection
+sends a single command line and gets a single line of JSON back, after which the server hangs up;
+
+    stats
+        Every connection's traffic, queue depth and idle time, and what the main loop is juggling.
+
+    threads
+        Every thread in the process and what it's doing right now.
+
+    profile [<seconds>]
+        Run cProfile over the main loop for a while (default `DEFAULT_SECONDS`) and return the busiest functions.
+
+    tracemalloc [<seconds>]
+        Trace allocations for a while and return where the heap grew the most.
+
+    timings [on|off|reset]
+        Switch the timing hooks around accept, TLS handshakes, the chat handshake, recv, decode and fan-out on or off,
+        and return what they've measured so far.
+
+Commands are carried out on the server's main loop, between client events. None of them hold the loop up for long;
+
+    - The 'profile' and 'tracemalloc' commands' answers are sent once their time is up.
+    - Answers are sent as fast as the admin connection takes them, from the loop, rather than waited on.
+    - Long lists, like the connections in 'stats', are a `Listing`; they're only turned into JSON a batch at a time, as
+      the answer goes out. Each item reflects the moment its batch was written rather than the moment the command
+      was given.
+
+Use `query()`, or the 'inspyred-chat-admin' command, to talk to the socket.
+"""
+import cProfile
+import io
+import json
+import os
+import pstats
+import selectors
+import socket
+import sys
+import threading
+import traceback
+import tracemalloc
+from argparse import ArgumentParser
+from functools import wraps
+from time import monotonic, perf_counter_ns
+
+DEFAULT_SECONDS = 10.0
+"""
+(float) - How long 'profile' and 'tracemalloc' run for if not told otherwise.
+"""
+
+MAX_SECONDS = 300.0
+"""
+(float) - The longest 'profile' or 'tracemalloc' is allowed to run.
+"""
+
+MAX_COMMAND = 1024
+"""
+(int) - The longest command line, in bytes, an admin connection may send.
+"""
+
+REPLY_TIMEOUT = 5.0
+"""
+(float) - How many seconds an admin connection may go without reading any of its reply before we give up on it.
+"""
+
+LISTING_BATCH = 500
+"""
+(int) - How many items of a `Listing` are turned into JSON at once.
+"""
+
+TOP = 30
+"""
+(int) - How many entries 'profile' and 'tracemalloc' report.
+"""
+
+
+class Deferred:
+    __slots__ = ('kind', 'deadline', 'finish')
+
+    def __init__(self, kind, seconds, finish):
+        """
+        An answer to a command that won't be ready for a while.
+
+        Arguments:
+            kind (str):
+                What's being measured. Only one of each kind may run at once.
+
+            seconds (float):
+                How long until the answer is ready.
+
+            finish (callable):
+                Called, with no arguments, once the time is up. Returns the answer.
+        """
+        self.kind = kind
+        self.deadline = monotonic() + seconds
+        self.finish = finish
+
+
+class Listing:
+    __slots__ = ('items', 'describe')
+
+    def __init__(self, items, describe):
+        """
+        A list in an answer that's only worked out while the answer is being sent, `LISTING_BATCH` items at a time.
+
+        Only allowed as a value in the top level of an answer.
+
+        Arguments:
+            items (iterable):
+                What to list. Taken as it is; pass a copy of anything that may change while the answer is sent.
+
+            describe (callable):
+                Called with each item once its batch is due. Returns something JSON serializable, or None to leave
+                the item out (e.g. because it's gone since).
+        """
+        self.items = items
+        self.describe = describe
+
+
+class Sending:
+    __slots__ = ('chunks', 'view', 'deadline')
+
+    def __init__(self, payload):
+        """
+        An answer on its way out to an admin connection.
+
+        Arguments:
+            payload (dict):
+                The answer.
+        """
+        self.chunks = encode(payload)
+        self.view = memoryview(b'')
+        self.deadline = monotonic() + REPLY_TIMEOUT
+
+
+class Timings:
+    def __init__(self, targets):
+        """
+        Optional timing hooks around the functions that make up each stage of the server's work.
+
+        While disabled, the hooked functions are the untouched originals, so the hooks cost nothing at all. Enabling
+        them swaps each target for a wrapper that records how long every call took.
+
+        Arguments:
+            targets (list):
+                A list of (stage, owner, name) tuples. 'owner' is the module (or any object) the function is looked
+                up on when it's called, and 'name' is the attribute it's looked up by.
+        """
+        self.targets = targets
+        self.originals = {}
+        self.stats = {}
+
+    @property
+    def enabled(self):
+        return bool(self.originals)
+
+    def _wrap(self, stage, func):
+        stats = self.stats.setdefault(stage, [0, 0, 0])
+
+        @wraps(func)
+        def timed(*args, **kwargs):
+            start = perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = perf_counter_ns() - start
+                stats[0] += 1
+                stats[1] += elapsed
+                if elapsed > stats[2]:
+                    stats[2] = elapsed
+
+        return timed
+
+    def enable(self):
+        for stage, owner, name in self.targets:
+            if (owner, name) not in self.originals:
+                func = getattr(owner, name)
+                self.originals[(owner, name)] = func
+                setattr(owner, name, self._wrap(stage, func))
+
+    def disable(self):
+        for (owner, name), func in self.originals.items():
+            setattr(owner, name, func)
+        self.originals.clear()
+
+    def reset(self):
+        for stats in self.stats.values():
+            stats[:] = [0, 0, 0]
+
+    def command(self, args):
+        """
+        The 'timings' admin command.
+
+        Arguments:
+            args (list):
+                Optionally one of 'on', 'off' or 'reset'.
+
+        Returns:
+            dict:
+                Whether the hooks are enabled, and the `report()`.
+        """
+        action = args[0].lower() if args else None
+
+        if action == 'on':
+            self.enable()
+        elif action == 'off':
+            self.disable()
+        elif action == 'reset':
+            self.reset()
+        elif action is not None:
+            raise ValueError(f'expected on, off or reset, not {action}')
+
+        return {'enabled': self.enabled, 'stages': self.report()}
+
+    def report(self):
+        """
+        Summarize what's been measured.
+
+        Returns:
+            dict:
+                For each stage that's been timed; how many calls there were, and their total, mean and longest
+                duration.
+        """
+        return {
+            stage: {
+                'calls': calls,
+                'total_ms': round(total / 1e6, 3),
+                'mean_us': round(total / calls / 1e3, 3) if calls else 0.0,
+                'max_us': round(longest / 1e3, 3),
+            }
+            for stage, (calls, total, longest) in self.stats.items()
+        }
+
+
+class AdminServer:
+    def __init__(self, path, selector, commands):
+        """
+        Serve admin commands on a Unix socket from a selector loop.
+
+        The listening socket and every admin connection are registered with `selector` with this object as their
+        data; hand their events to `ready()`. Call `run_due()` at least as often as `deadline` says.
+
+        Arguments:
+            path (str|pathlib.Path):
+                Where to create the socket.
+
+            selector (selectors.BaseSelector):
+                The loop's selector.
+
+            commands (dict):
+                Extra commands, as functions taking the command's arguments (a list of strings) and returning a dict
+                or a `Deferred`. These are offered alongside the built-in 'threads', 'profile' and 'tracemalloc'.
+        """
+        self.path = str(path)
+        self.selector = selector
+        self.commands = {'threads': threads, 'profile': profile, 'tracemalloc': trace_allocations, **commands}
+        self.buffers = {}
+        self.waiting = {}
+        self.sending = {}
+
+        self.sock = listen(self.path)
+        self.inode = os.stat(self.path).st_ino
+        selector.register(self.sock, selectors.EVENT_READ, self)
+
+    @property
+    def busy(self):
+        """
+        Whether any answers are waiting to be worked out or sent.
+        """
+        return bool(self.waiting or self.sending)
+
+    @property
+    def deadline(self):
+        """
+        When `run_due()` next has something to do, as a 'time.monotonic()' value, or None if nothing is waiting.
+        """
+        deadlines = [deferred.deadline for deferred in self.waiting.values()]
+        deadlines.extend(sending.deadline for sending in self.sending.values())
+        return min(deadlines) if deadlines else None
+
+    def ready(self, sock):
+        if sock is self.sock:
+            self._accept()
+        elif sock in self.sending:
+            self._write(sock)
+        else:
+            self._read(sock)
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except BlockingIOError:
+                return
+
+            conn.setblocking(False)
+            self.buffers[conn] = bytearray()
+            self.selector.register(conn, selectors.EVENT_READ, self)
+
+    def _read(self, conn):
+        try:
+            data = conn.recv(MAX_COMMAND)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+
+        if not data:
+            self._close(conn)
+            return
+
+        buffer = self.buffers[conn]
+        buffer += data
+
+        line, found, _ = bytes(buffer).partition(b'\n')
+
+        if not found and len(buffer) <= MAX_COMMAND:
+            return
+
+        # One command per connection, so stop listening to it.
+        self.selector.unregister(conn)
+
+        if not found:
+            self._reply(conn, {'error': 'command too long'})
+        else:
+            self._run(conn, line.decode('utf-8', errors='replace').split())
+
+    def _run(self, conn, words):
+        if not words:
+            self._reply(conn, {'error': 'no command', 'commands': sorted(self.commands)})
+            return
+
+        name, args = words[0].lower(), words[1:]
+        command = self.commands.get(name)
+
+        if command is None:
+            self._reply(conn, {'error': f'unknown command: {name}', 'commands': sorted(self.commands)})
+            return
+
+        if any(deferred.kind == name for deferred in self.waiting.values()):
+            self._reply(conn, {'error': f'{name} is already running'})
+            return
+
+        try:
+            result = command(args)
+        except ValueError as err:
+            self._reply(conn, {'error': str(err)})
+            return
+
+        if isinstance(result, Deferred):
+            self.waiting[conn] = result
+        else:
+            self._reply(conn, result)
+
+    def run_due(self):
+        """
+        Start sending every deferred answer whose time is up, and give up on connections that stopped reading theirs.
+
+        Returns:
+            None
+        """
+        now = monotonic()
+
+        for conn, deferred in [(conn, deferred) for conn, deferred in self.waiting.items() if deferred.deadline <= now]:
+            del self.waiting[conn]
+            self._reply(conn, deferred.finish())
+
+        for conn in [conn for conn, sending in self.sending.items() if sending.deadline <= now]:
+            self._close(conn)
+
+    def _reply(self, conn, payload):
+        self.sending[conn] = Sending(payload)
+        self.selector.register(conn, selectors.EVENT_WRITE, self)
+
+    def _write(self, conn):
+        sending = self.sending[conn]
+
+        try:
+            # At most one more piece of the answer is worked out each time, so a long one takes turns with the chat.
+            if not sending.view:
+                chunk = next(sending.chunks, None)
+                if chunk is None:
+                    self._close(conn)
+                    return
+                sending.view = memoryview(chunk)
+
+            while sending.view:
+                sending.view = sending.view[conn.send(sending.view):]
+                sending.deadline = monotonic() + REPLY_TIMEOUT
+        except BlockingIOError:
+            pass
+        except OSError:
+            self._close(conn)
+
+    def _close(self, conn):
+        try:
+            self.selector.unregister(conn)
+        except (KeyError, ValueError):
+            pass
+
+        self.buffers.pop(conn, None)
+        self.sending.pop(conn, None)
+        conn.close()
+
+    def close(self):
+        """
+        Stop listening, finishing anything still running early.
+
+        Whatever answers are left are sent before returning, giving each connection up to `REPLY_TIMEOUT` to take
+        them. The socket file is only removed if it's still ours, since a newer server may already have replaced it.
+
+        Returns:
+            None
+        """
+        for conn, deferred in list(self.waiting.items()):
+            del self.waiting[conn]
+            self._reply(conn, deferred.finish())
+
+        for conn, sending in list(self.sending.items()):
+            try:
+                conn.settimeout(REPLY_TIMEOUT)
+                conn.sendall(sending.view)
+                for chunk in sending.chunks:
+                    conn.sendall(chunk)
+            except OSError:
+                pass
+
+        for conn in list(self.buffers):
+            self._close(conn)
+
+        self.selector.unregister(self.sock)
+        self.sock.close()
+
+        try:
+            if os.stat(self.path).st_ino == self.inode:
+                os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def encode(payload):
+    """
+    Turn an answer into JSON a piece at a time.
+
+    Arguments:
+        payload (dict):
+            The answer. Any `Listing` in it is worked out `LISTING_BATCH` items at a time.
+
+    Returns:
+        generator:
+            The pieces of the encoded answer, as bytes, ending with a newline.
+    """
+    listings = {key: value for key, value in payload.items() if isinstance(value, Listing)}
+    head = json.dumps({key: value for key, value in payload.items() if key not in listings})
+
+    if not listings:
+        yield head.encode('utf-8') + b'\n'
+        return
+
+    yield head[:-1].encode('utf-8')
+    separator = ', ' if len(head) > 2 else ''
+
+    for key, listing in listings.items():
+        yield f'{separator}{json.dumps(key)}: ['.encode('utf-8')
+        separator = ', '
+
+        items = iter(listing.items)
+        first = True
+
+        while True:
+            batch = []
+            for item in items:
+                described = listing.describe(item)
+                if described is not None:
+                    batch.append(json.dumps(described))
+                if len(batch) == LISTING_BATCH:
+                    break
+
+            if not batch:
+                break
+
+            yield (('' if first else ', ') + ', '.join(batch)).encode('utf-8')
+            first = False
+
+        yield b']'
+
+    yield b'}\n'
+
+
+def listen(path):
+    """
+    Open the admin socket.
+
+    Any stale socket file left at `path` is replaced, and the new one is only accessible by our own user.
+
+    Arguments:
+        path (str|pathlib.Path):
+            Where to create the socket.
+
+    Returns:
+        socket.socket:
+            The listening (non-blocking) Unix socket.
+    """
+    path = str(path)
+
+    if os.path.exists(path):
+        os.unlink(path)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o077)
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(old_umask)
+
+    sock.listen(8)
+    sock.setblocking(False)
+
+    return sock
+
+
+def seconds(args):
+    """
+    Parse the optional duration given to 'profile' or 'tracemalloc'.
+
+    Raises:
+        ValueError:
+            If it isn't a number between 0 and `MAX_SECONDS`.
+    """
+    try:
+        value = float(args[0]) if args else DEFAULT_SECONDS
+    except ValueError:
+        raise ValueError(f'not a number of seconds: {args[0]}') from None
+
+    if not 0 < value <= MAX_SECONDS:
+        raise ValueError(f'seconds must be more than 0 and at most {MAX_SECONDS}')
+
+    return value
+
+
+def threads(args):
+    """
+    List every thread in the process, and the innermost frames of what each is doing.
+    """
+    frames = sys._current_frames()
+    listing = []
+
+    for thread in threading.enumerate():
+        frame = frames.get(thread.ident)
+        stack = traceback.format_stack(frame, limit=5) if frame is not None else []
+        listing.append({
+            'name': thread.name,
+            'ident': thread.ident,
+            'daemon': thread.daemon,
+            'alive': thread.is_alive(),
+            'stack': [line.rstrip() for line in stack],
+        })
+
+    return {'threads': listing}
+
+
+def profile(args):
+    """
+    Profile the main loop (cProfile only sees the thread that enabled it) for a while.
+    """
+    duration = seconds(args)
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+    def finish():
+        profiler.disable()
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(TOP)
+        return {'seconds': duration, 'profile': out.getvalue()}
+
+    return Deferred('profile', duration, finish)
+
+
+def trace_allocations(args):
+    """
+    Trace the whole process's allocations for a while, and compare the heap before and after.
+    """
+    duration = seconds(args)
+    started = not tracemalloc.is_tracing()
+
+    if started:
+        tracemalloc.start()
+
+    # Leave tracemalloc's own bookkeeping out of the results.
+    ours = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    before = tracemalloc.take_snapshot().filter_traces(ours)
+
+    def finish():
+        after = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+
+        if started:
+            tracemalloc.stop()
+
+        return {
+            'seconds': duration,
+            'current': current,
+            'peak': peak,
+            'top': [str(stat) for stat in after.filter_traces(ours).compare_to(before, 'lineno')[:TOP]],
+        }
+
+    return Deferred('tracemalloc', duration, finish)
+
+
+def query(path, command, timeout=MAX_SECONDS + REPLY_TIMEOUT):
+    """
+    Send a command to a server's admin socket and wait for the answer.
+
+    Arguments:
+        path (str|pathlib.Path):
+            The admin socket.
+
+        command (str):
+            The command line, e.g. 'profile 5'.
+
+        timeout (float):
+            How long to wait for the answer, in seconds. (Defaults to long enough for the longest 'profile')
+
+    Returns:
+        dict:
+            The decoded answer.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(str(path))
+        sock.sendall(command.encode('utf-8') + b'\n')
+
+        data = bytearray()
+        while not data.endswith(b'\n'):
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+
+    return json.loads(data)
+
+
+def main():
+    parser = ArgumentParser(description='Look inside a running chat server through its admin socket.')
+
+    parser.add_argument('socket', action='store', help='The admin socket the server was started with.')
+
+    parser.add_argument(
+        'command',
+        action='store',
+        nargs='+',
+        help='The command to run; stats, threads, profile [seconds], tracemalloc [seconds] or timings [on|off|reset].'
+    )
+
+    args = parser.parse_args()
+    answer = query(args.socket, ' '.join(args.command))
+
+    if 'profile' in answer:
+        print(answer['profile'])
+    else:
+        print(json.dumps(answer, indent=2))
+
@@ -0,0 +1,185 @@
+"""
+Record a compact binary capture of the traffic a running server sees.
+
+A capture file starts with a small header followed by a flat run of records. Each record is one connection event (a
+connect, the nickname given during the handshake, a message, or a disconnect) stamped with the number of nanoseconds
+since the capture started and a small per-capture connection number. Captures are read back with `read_capture()` and
+fed into a local server by `inspyred_chat.server.capture.replay`.
+"""
+import struct
+from collections import namedtuple
+from pathlib import Path
+from threading import Lock
+from time import monotonic_ns, time
+
+from inspyred_chat.server.capture.errors import CaptureFormatError
+
+MAGIC = b'ICCAP'
+"""
+(bytes) - The bytes every capture file starts with.
+"""
+
+FORMAT_VERSION = 1
+"""
+(int) - The version of the capture format written by `CaptureWriter`.
+"""
+
+HEADER = struct.Struct('<5sBd')
+"""
+(struct.Struct) - The file header; magic, format version and the wall-clock time (in seconds) the capture started.
+"""
+
+RECORD = struct.Struct('<BIQI')
+"""
+(struct.Struct) - A record header; event kind, connection number, nanoseconds since capture start and payload length.
+"""
+
+CONNECT = 1
+NICK = 2
+MESSAGE = 3
+DISCONNECT = 4
+
+KINDS = {
+    CONNECT: 'CONNECT',
+    NICK: 'NICK',
+    MESSAGE: 'MESSAGE',
+    DISCONNECT: 'DISCONNECT',
+}
+"""
+(dict) - The name of each event kind that can appear in a capture, keyed by its numeric value.
+"""
+
+CaptureRecord = namedtuple('CaptureRecord', ['kind', 'conn_id', 't_ns', 'payload'])
+
+
+class CaptureWriter:
+    def __init__(self, filepath):
+        """
+        Append connection events and messages to a capture file.
+
+        The file is created (or truncated) as soon as the writer is instantiated. All methods are safe to call from
+        any number of threads at once.
+
+        Arguments:
+            filepath (str|pathlib.Path):
+                Where the capture should be written.
+        """
+        self.filepath = Path(filepath).expanduser().resolve()
+        self._lock = Lock()
+        self._next_conn_id = 0
+        self._start_ns = monotonic_ns()
+
+        self._file = open(self.filepath, 'wb')
+        self._file.write(HEADER.pack(MAGIC, FORMAT_VERSION, time()))
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def record(self, kind, conn_id, payload=b''):
+        """
+        Write a single event to the capture.
+
+        Arguments:
+            kind (int):
+                One of; CONNECT, NICK, MESSAGE, DISCONNECT
+
+            conn_id (int):
+                The connection number handed out by `new_connection()`.
+
+            payload (bytes|str):
+                Whatever data belongs to the event. Strings are encoded as ASCII, the same as they'd be on the wire.
+
+        Returns:
+            None
+        """
+        if isinstance(payload, str):
+            payload = payload.encode('ascii', errors='replace')
+
+        t_ns = monotonic_ns() - self._start_ns
+
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(RECORD.pack(kind, conn_id, t_ns, len(payload)))
+            self._file.write(payload)
+
+    def new_connection(self, addr):
+        """
+        Hand out a connection number for a freshly accepted client and record that it connected.
+
+        Arguments:
+            addr:
+                The address tuple returned by 'socket.accept()'.
+
+        Returns:
+            conn_id (int):
+                The number to pass to `record()` for every later event on this connection.
+        """
+        with self._lock:
+            conn_id = self._next_conn_id
+            self._next_conn_id += 1
+
+        self.record(CONNECT, conn_id, f'{addr[0]}:{addr[1]}')
+
+        return conn_id
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+
+def read_capture(filepath):
+    """
+    Read back a capture written by `CaptureWriter`.
+
+    A capture that was cut short (the server was killed mid-write, for instance) is read up to the last complete
+    record.
+
+    Arguments:
+        filepath (str|pathlib.Path):
+            The capture file to read.
+
+    Returns:
+        A tuple of (started, records):
+            started (float):
+                The wall-clock time the capture started.
+
+            records (list):
+                A list of `CaptureRecord`, in the order they were written.
+
+    Raises:
+        CaptureFormatError:
+            If the file doesn't start with a capture header we know how to read.
+    """
+    records = []
+
+    with open(filepath, 'rb') as file:
+        header = file.read(HEADER.size)
+
+        if len(header) < HEADER.size:
+            raise CaptureFormatError(f'{filepath} is too short to hold a capture header.')
+
+        magic, version, started = HEADER.unpack(header)
+
+        if magic != MAGIC:
+            raise CaptureFormatError(f'{filepath} does not start with {MAGIC!r}.')
+
+        if version != FORMAT_VERSION:
+            raise CaptureFormatError(f'Capture format version {version} is not supported.')
+
+        while True:
+            head = file.read(RECORD.size)
+            if len(head) < RECORD.size:
+                break
+
+            kind, conn_id, t_ns, length = RECORD.unpack(head)
+            payload = file.read(length)
+
+            if len(payload) < length:
+                break
+
+            records.append(CaptureRecord(kind, conn_id, t_ns, payload))
+
+    return started, records
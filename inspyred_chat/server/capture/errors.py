@@ -0,0 +1,15 @@
+class CaptureFormatError(Exception):
+    message = 'The file given is not a valid InspyredChat traffic capture!'
+
+    def __init__(self, message=message):
+        """
+        Raised when 'inspyred_chat.server.capture' is asked to read a file that doesn't look like a capture it wrote.
+
+        Args:
+            message (String):
+                 Any additional information that needs to be conveyed.
+        """
+        if message != self.message:
+            self.message = f'{self.message}\nSome additional information from the caller: {message}'
+
+        super(CaptureFormatError, self).__init__(self.message)
@@ -0,0 +1,338 @@
+"""
+Replay a traffic capture against a (local) chat server.
+
+Every connection in the capture gets its own client socket which connects, identifies itself, talks and disconnects at
+the same offsets it did originally, divided by the replay speed. Each replayed message is tagged so that it can be
+recognised when the server broadcasts it back out, which lets us measure delivery latency to every connected replay
+client.
+
+Usage:
+    python -m inspyred_chat.server.capture.replay capture.bin --speed 10
+"""
+import re
+import socket
+from argparse import ArgumentParser
+from collections import Counter, defaultdict
+from threading import Condition, Event, Lock, Thread
+from time import monotonic, sleep
+from uuid import uuid4
+
+from inspyred_chat.protocol import REQ_NICK, REQ_UUID, TERMINATOR
+from inspyred_chat.server.capture import CONNECT, DISCONNECT, MESSAGE, NICK, read_capture
+
+TAG_PATTERN = re.compile(r'~r(\d+):(\d+)~')
+"""
+(re.Pattern) - Matches the tag appended to every replayed message.
+"""
+
+TAG_TAIL = 32
+"""
+(int) - How many trailing characters of received data to keep around in case a tag was split across two reads.
+"""
+
+HANDSHAKE_TIMEOUT = 10.0
+"""
+(float) - How many seconds a replay connection waits for the server to finish its handshake before giving up.
+"""
+
+
+class ReplayStats:
+    def __init__(self):
+        """
+        Collects the results of a replay from all replay connections at once.
+        """
+        self._lock = Lock()
+        self.sent = {}
+        self.latencies = []
+        self.delivered = set()
+        self.errors = Counter()
+        self.attempts = 0
+        self.connections = 0
+
+    def message_sent(self, tag, when):
+        with self._lock:
+            self.sent[tag] = when
+
+    def message_received(self, tag, when):
+        with self._lock:
+            sent_at = self.sent.get(tag)
+            if sent_at is None:
+                return
+            self.latencies.append(when - sent_at)
+            self.delivered.add(tag)
+
+    def connecting(self):
+        with self._lock:
+            self.attempts += 1
+
+    def connected(self):
+        with self._lock:
+            self.connections += 1
+
+    def error(self, kind):
+        with self._lock:
+            self.errors[kind] += 1
+
+    def report(self, elapsed):
+        """
+        Summarise the replay as a printable string.
+
+        Arguments:
+            elapsed (float):
+                How long, in seconds, the replay took.
+
+        Returns:
+            String:
+                The report.
+        """
+        lat = sorted(self.latencies)
+
+        def pct(p):
+            return lat[min(len(lat) - 1, int(len(lat) * p))] * 1000
+
+        lines = [
+            f'Replayed {self.connections} connection(s) in {elapsed:.2f}s',
+            f'Messages sent: {len(self.sent)}',
+            f'Deliveries seen: {len(lat)} (undelivered to sender or anyone else: '
+            f'{len(self.sent) - len(self.delivered)})',
+        ]
+
+        if lat:
+            lines.append(
+                f'Delivery latency (ms): min {lat[0] * 1000:.2f} / p50 {pct(.50):.2f} / p95 {pct(.95):.2f} / '
+                f'p99 {pct(.99):.2f} / max {lat[-1] * 1000:.2f}'
+            )
+
+        total = sum(self.errors.values())
+        attempts = self.attempts + len(self.sent)
+        rate = (total / attempts * 100) if attempts else 0.0
+        lines.append(f'Errors: {total} ({rate:.2f}% of connects + sends)')
+
+        for kind, count in sorted(self.errors.items()):
+            lines.append(f'    {kind}: {count}')
+
+        return '\n'.join(lines)
+
+
+class ReplayConnection(Thread):
+    def __init__(self, conn_id, events, addr, speed, start, stats, drain=2.0):
+        """
+        Play back everything a single captured connection did.
+
+        Arguments:
+            conn_id (int):
+                The connection number from the capture.
+
+            events (list):
+                The `CaptureRecord` objects belonging to this connection, in order.
+
+            addr (tuple):
+                The (host, port) of the server to replay against.
+
+            speed (float):
+                How many times faster than real-time to replay. Zero replays as fast as possible.
+
+            start (float):
+                The 'time.monotonic()' value the replay as a whole started at.
+
+            stats (ReplayStats):
+                Where to record results.
+
+            drain (float):
+                The most seconds to wait, before disconnecting, for our own messages to be broadcast back to us.
+        """
+        super().__init__(daemon=True)
+        self.conn_id = conn_id
+        self.events = events
+        self.addr = addr
+        self.speed = speed
+        self.start_time = start
+        self.stats = stats
+        self.nick = next((e.payload for e in events if e.kind == NICK), f'replay{conn_id}'.encode('ascii'))
+        self.drain = drain
+        self.sock = None
+        self.ready = Event()
+        self._closing = False
+        self._sent = 0
+        self._own_prefix = f'~r{conn_id}:'
+        self._outstanding = set()
+        self._echoed = Condition()
+
+    def wait_until(self, t_ns):
+        if not self.speed:
+            return
+
+        delay = self.start_time + (t_ns / 1e9) / self.speed - monotonic()
+        if delay > 0:
+            sleep(delay)
+
+    def listen(self):
+        tail = ''
+
+        while True:
+            try:
+                data = self.sock.recv(4096)
+            except OSError:
+                data = b''
+
+            if not data:
+                if not self._closing:
+                    self.stats.error('server closed connection')
+                return
+
+            now = monotonic()
+            text = data.decode('ascii', errors='replace')
+
+            try:
+                if REQ_NICK in text:
+                    self.sock.send(self.nick + TERMINATOR)
+                if REQ_UUID in text:
+                    self.sock.send(str(uuid4()).encode('ascii') + TERMINATOR)
+                    self.ready.set()
+            except OSError:
+                return
+
+            text = tail + text
+            end = 0
+            for match in TAG_PATTERN.finditer(text):
+                tag = match.group(0)
+                self.stats.message_received(tag, now)
+                end = match.end()
+
+                if tag.startswith(self._own_prefix):
+                    with self._echoed:
+                        self._outstanding.discard(tag)
+                        self._echoed.notify_all()
+
+            tail = text[max(end, len(text) - TAG_TAIL):]
+
+    def run(self):
+        for event in self.events:
+            self.wait_until(event.t_ns)
+
+            if event.kind == CONNECT:
+                self.stats.connecting()
+                try:
+                    self.sock = socket.create_connection(self.addr)
+                    self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                except OSError:
+                    self.stats.error('connect failed')
+                    return
+                self.stats.connected()
+                Thread(target=self.listen, daemon=True).start()
+
+                # Messages in the capture were all sent after the handshake, so don't send any before it's done.
+                if not self.ready.wait(HANDSHAKE_TIMEOUT):
+                    self.stats.error('handshake timed out')
+                    self._closing = True
+                    self.sock.close()
+                    return
+
+            elif event.kind == MESSAGE and self.sock is not None:
+                tag = f'~r{self.conn_id}:{self._sent}~'
+                self._sent += 1
+                with self._echoed:
+                    self._outstanding.add(tag)
+                self.stats.message_sent(tag, monotonic())
+                try:
+                    self.sock.send(event.payload.rstrip(TERMINATOR) + tag.encode('ascii') + TERMINATOR)
+                except OSError:
+                    self.stats.error('send failed')
+                    return
+
+            elif event.kind == DISCONNECT and self.sock is not None:
+                # Give the server a chance to broadcast what we sent last before we hang up, otherwise fast replays
+                # would count our own final messages as undelivered.
+                with self._echoed:
+                    self._echoed.wait_for(lambda: not self._outstanding, self.drain)
+                self._closing = True
+                self.sock.close()
+                return
+
+
+def replay(filepath, addr, speed=1.0, settle=2.0):
+    """
+    Replay a capture file against the server at `addr`.
+
+    Arguments:
+        filepath (str|pathlib.Path):
+            The capture to replay.
+
+        addr (tuple):
+            The (host, port) the server is listening on.
+
+        speed (float):
+            How many times faster than real-time to replay. Zero replays as fast as possible. (Defaults to 1.0)
+
+        settle (float):
+            How many seconds to keep listening for deliveries after the last connection finished. (Defaults to 2.0)
+
+    Returns:
+        ReplayStats:
+            The collected results.
+    """
+    _, records = read_capture(filepath)
+
+    by_conn = defaultdict(list)
+    for record in records:
+        by_conn[record.conn_id].append(record)
+
+    stats = ReplayStats()
+    start = monotonic()
+
+    conns = [
+        ReplayConnection(conn_id, events, addr, speed, start, stats, drain=settle)
+        for conn_id, events in by_conn.items()
+    ]
+
+    for conn in conns:
+        conn.start()
+
+    for conn in conns:
+        conn.join()
+
+    sleep(settle)
+
+    for conn in conns:
+        if conn.sock is not None:
+            conn._closing = True
+            conn.sock.close()
+
+    return stats
+
+
+def main():
+    parser = ArgumentParser(description='Replay a traffic capture against a chat server.')
+
+    parser.add_argument('capture_file', action='store', help='The capture file recorded with --capture-file.')
+
+    parser.add_argument('-b', '--host', action='store', default='127.0.0.1', help='The server address.')
+
+    parser.add_argument('-p', '--port', action='store', type=int, default=5300, help='The server port.')
+
+    parser.add_argument(
+        '-s',
+        '--speed',
+        action='store',
+        type=float,
+        default=1.0,
+        help='How many times faster than real-time to replay (e.g. 1, 10). Use 0 to replay as fast as possible.'
+    )
+
+    parser.add_argument(
+        '--settle',
+        action='store',
+        type=float,
+        default=2.0,
+        help='Seconds to keep listening for deliveries after the last connection is done.'
+    )
+
+    args = parser.parse_args()
+
+    start = monotonic()
+    stats = replay(args.capture_file, (args.host, args.port), args.speed, args.settle)
+    print(stats.report(monotonic() - start))
+
+
+if __name__ == '__main__':
+    main()
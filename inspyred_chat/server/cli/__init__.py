@@ -1,5 +1,35 @@
-from argparse import ArgumentParser
-from inspyred_chat.server.info import DEFAULT_CONFIG_DIR, PROG, LOG_LEVELS, DEFAULT_PORT
+from argparse import ArgumentParser, ArgumentTypeError
+from inspyred_chat.server.info import (
+    DEFAULT_CONFIG_DIR, DEFAULT_SPOOL_DIR, DEFAULT_TLS_DIR, PROG, LOG_LEVELS, DEFAULT_PORT
+)
+from inspyred_chat.server.transfer import DEFAULT_QUOTA, DEFAULT_RATE
+
+
+def positive_int(value):
+    """
+    Parse a command-line value that has to be a whole number greater than zero.
+
+    Arguments:
+        value (str):
+            The value as given.
+
+    Returns:
+        int:
+            The number.
+
+    Raises:
+        argparse.ArgumentTypeError:
+            If the value isn't a number greater than zero.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+
+    if number <= 0:
+        raise ArgumentTypeError(f'must be a whole number greater than zero, not {value!r}')
+
+    return number
 
 
 class CLIArgs(ArgumentParser):
@@ -83,6 +113,96 @@ class CLIArgs(ArgumentParser):
 
         )
 
+        self.add_argument(
+            '--capture-file',
+            action='store',
+            required=False,
+            help='Record a binary capture of connection events and messages to this file. These captures can be fed '
+                 'back into a server with \'python -m inspyred_chat.server.capture.replay\'.',
+            default=None
+        )
+
+        self.add_argument(
+            '--handoff-socket',
+            action='store',
+            required=False,
+            help='Listen on this Unix socket for a newer server to hand our listening socket and connected clients '
+                 'over to. Start the newer server with \'--takeover\' pointing at the same path.',
+            default=None
+        )
+
+        self.add_argument(
+            '--takeover',
+            action='store',
+            required=False,
+            help='Take over the listening socket and connected clients of the server whose handoff socket is at this '
+                 'path, instead of binding a new one.',
+            default=None
+        )
+
+        self.add_argument(
+            '--spool-dir',
+            action='store',
+            required=False,
+            help=f'Where uploaded files are kept. The default is: {DEFAULT_SPOOL_DIR}',
+            default=DEFAULT_SPOOL_DIR
+        )
+
+        self.add_argument(
+            '--spool-quota',
+            action='store',
+            type=positive_int,
+            required=False,
+            help=f'The most bytes of uploaded files the spool may hold. Uploads that would take it past this are '
+                 f'refused. The default is: {DEFAULT_QUOTA}',
+            default=DEFAULT_QUOTA
+        )
+
+        self.add_argument(
+            '--transfer-rate',
+            action='store',
+            type=positive_int,
+            required=False,
+            help=f'The most bytes per second of file data sent to each client. The default is: {DEFAULT_RATE}',
+            default=DEFAULT_RATE
+        )
+
+        self.add_argument(
+            '--admin-socket',
+            action='store',
+            required=False,
+            help='Listen on this Unix socket for admin commands; live connection stats, thread listings, profiling '
+                 'and timing hooks. Use \'inspyred-chat-admin\' to send them.',
+            default=None
+        )
+
+        self.add_argument(
+            '--tls',
+            action='store_true',
+            required=False,
+            help='Only accept TLS connections. If the certificate and key don\'t exist yet, a self-signed pair is '
+                 'created for the bind address.',
+            default=False
+        )
+
+        self.add_argument(
+            '--tls-cert',
+            action='store',
+            required=False,
+            help=f'The server\'s TLS certificate (chain), PEM encoded. The default is: '
+                 f'{DEFAULT_TLS_DIR.joinpath("server.crt")}',
+            default=DEFAULT_TLS_DIR.joinpath('server.crt')
+        )
+
+        self.add_argument(
+            '--tls-key',
+            action='store',
+            required=False,
+            help=f'The TLS certificate\'s private key, PEM encoded. The default is: '
+                 f'{DEFAULT_TLS_DIR.joinpath("server.key")}',
+            default=DEFAULT_TLS_DIR.joinpath('server.key')
+        )
+
     @property
     def parsed(self):
         """
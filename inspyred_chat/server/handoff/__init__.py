@@ -0,0 +1,297 @@
+"""
+Hand a running server's sockets over to a freshly started one, so that upgrading never disconnects anybody.
+
+The running server listens on a Unix socket (see '--handoff-socket'). A new server started with '--takeover' connects
+to it and is sent, in order;
+
+    1) The listening socket, the roster and the chat history. The new server loads both, then starts accepting on
+       the socket straight away.
+    2) Every connected client socket, in batches, along with the state of its `Session`.
+    3) A 'done' frame, which the new server acknowledges.
+
+The old server is busy handing off the whole time, so nothing it sends can change underneath the new one.
+
+File descriptors travel as SCM_RIGHTS ancillary data, so both processes briefly share the very same sockets; nothing
+is closed or re-opened and clients never notice. Once it gets the acknowledgement the old server closes its copies and
+exits. If the handoff fails before then, the old server carries on with every socket it still holds and the new one
+exits instead.
+
+Every frame on the handoff socket is a 4-byte length followed by that many bytes of JSON. Any file descriptors that
+belong to a frame are attached to its length prefix.
+"""
+import json
+import os
+import socket
+import struct
+from base64 import b64decode, b64encode
+from collections import deque
+
+from inspyred_chat.server.session import Session
+from inspyred_chat.server.transfer import Download, Upload
+
+LENGTH = struct.Struct('<I')
+"""
+(struct.Struct) - The length prefix in front of every frame.
+"""
+
+BATCH_SIZE = 128
+"""
+(int) - How many client sockets to send per frame. Linux won't pass more than 253 descriptors in one message.
+"""
+
+TIMEOUT = 30
+"""
+(int) - How many seconds the old server waits on any one send to, or receive from, the new server before giving up on
+the handoff.
+"""
+
+LISTENER = 'listener'
+SESSIONS = 'sessions'
+DONE = 'done'
+ACK = 'ack'
+
+
+def send_frame(sock, payload, fds=()):
+    """
+    Send a single frame, and any file descriptors that belong to it, down the handoff socket.
+
+    Arguments:
+        sock (socket.socket):
+            The (blocking) handoff connection.
+
+        payload (dict):
+            Anything JSON serializable.
+
+        fds (list):
+            File descriptors to pass along with the frame. (Defaults to none)
+
+    Returns:
+        None
+    """
+    body = json.dumps(payload).encode('ascii')
+    socket.send_fds(sock, [LENGTH.pack(len(body))], list(fds))
+    sock.sendall(body)
+
+
+def recv_exactly(sock, size):
+    data = bytearray()
+
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('The handoff connection closed mid-frame.')
+        data += chunk
+
+    return bytes(data)
+
+
+def recv_frame(sock):
+    """
+    Receive a single frame sent with `send_frame()`.
+
+    Arguments:
+        sock (socket.socket):
+            The (blocking) handoff connection.
+
+    Returns:
+        A tuple of (payload, fds):
+            payload (dict):
+                The decoded frame.
+
+            fds (list):
+                Any file descriptors that came with it, in the order they were sent.
+    """
+    head, fds, _, _ = socket.recv_fds(sock, LENGTH.size, BATCH_SIZE)
+
+    if not head:
+        raise ConnectionError('The handoff connection closed.')
+
+    if len(head) < LENGTH.size:
+        head += recv_exactly(sock, LENGTH.size - len(head))
+
+    length, = LENGTH.unpack(head)
+
+    return json.loads(recv_exactly(sock, length)), fds
+
+
+def dump_session(session):
+    """
+    Get everything about a session that needs to survive a handoff, other than its socket.
+
+    Arguments:
+        session (Session):
+            The session to dump.
+
+    Returns:
+        dict:
+            A JSON serializable description of the session.
+    """
+    return {
+        'addr': list(session.addr),
+        'nick': session.nick,
+        'client_id': f'{session.client_id:032x}',
+        'connection_id': f'{session.connection_id:032x}',
+        'state': session.state,
+        'rbuf': b64encode(session.rbuf).decode('ascii') if session.rbuf else None,
+        'wbuf': b64encode(session.wbuf).decode('ascii') if session.wbuf else None,
+        'grace': session.grace,
+        'upload': session.upload.dump() if session.upload is not None else None,
+        'downloads': [download.dump() for download in session.downloads] if session.downloads else None,
+    }
+
+
+def load_session(data, sock, spool):
+    """
+    Rebuild a session dumped with `dump_session()` around a socket received from the old server.
+
+    Arguments:
+        data (dict):
+            The dumped session.
+
+        sock (socket.socket):
+            The client socket that came with it.
+
+        spool (Spool):
+            The file spool, for picking up any uploads or downloads the session was in the middle of.
+
+    Returns:
+        Session:
+            The rebuilt session.
+    """
+    sock.setblocking(False)
+
+    session = Session(sock, tuple(data['addr']), client_id=int(data['client_id'], 16))
+    session.connection_id = int(data['connection_id'], 16)
+    session.state = data['state']
+
+    if data['nick'] is not None:
+        session.set_nick(data['nick'])
+
+    if data['rbuf']:
+        session.rbuf = bytearray(b64decode(data['rbuf']))
+
+    if data['wbuf']:
+        session.wbuf = bytearray(b64decode(data['wbuf']))
+        session.grace = data.get('grace', 0)
+
+    if data['upload']:
+        session.upload = Upload.load(data['upload'], spool)
+
+    if data['downloads']:
+        session.downloads = deque(Download.load(download, spool) for download in data['downloads'])
+
+    return session
+
+
+def hand_off(conn, server, sessions, roster, history):
+    """
+    Give the listening socket and every session to the server on the other end of `conn`.
+
+    The listening socket goes first, so that the new server can get on with accepting connections while the sessions
+    are still being sent. The roster and chat history come with it, so that whoever joins the new server meanwhile is
+    added to the whole roster and synced against the whole history, rather than empty ones. Returns once the new
+    server has acknowledged receiving everything; the caller may then close its own copies of the sockets.
+
+    Arguments:
+        conn (socket.socket):
+            The (blocking) connection from the new server.
+
+        server (socket.socket):
+            The listening socket.
+
+        sessions (list):
+            Every `Session` to hand over. They must no longer be registered with a selector.
+
+        roster (dict):
+            The committed roster, as dumped by 'Roster.dump()'.
+
+        history (dict):
+            The chat history, as dumped by 'History.dump()'.
+
+    Returns:
+        None
+    """
+    send_frame(conn, {'type': LISTENER, 'roster': roster, 'history': history}, [server.fileno()])
+
+    for start in range(0, len(sessions), BATCH_SIZE):
+        batch = sessions[start:start + BATCH_SIZE]
+        send_frame(
+            conn,
+            {'type': SESSIONS, 'sessions': [dump_session(session) for session in batch]},
+            [session.fileno for session in batch]
+        )
+
+    send_frame(conn, {'type': DONE, 'count': len(sessions)})
+
+    payload, _ = recv_frame(conn)
+
+    if payload.get('type') != ACK:
+        raise ConnectionError(f'Expected an acknowledgement from the new server, got {payload!r}.')
+
+
+def listen(path):
+    """
+    Open the Unix socket a successor server can connect to in order to take over from us.
+
+    Any stale socket file left at `path` is replaced, and the new one is only accessible by our own user.
+
+    Arguments:
+        path (str|pathlib.Path):
+            Where to create the socket.
+
+    Returns:
+        socket.socket:
+            The listening (non-blocking) Unix socket.
+    """
+    path = str(path)
+
+    if os.path.exists(path):
+        os.unlink(path)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o077)
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(old_umask)
+
+    sock.listen(1)
+    sock.setblocking(False)
+
+    return sock
+
+
+def connect(path):
+    """
+    Connect to a running server's handoff socket and receive its listening socket, roster and chat history.
+
+    Arguments:
+        path (str|pathlib.Path):
+            The running server's handoff socket.
+
+    Returns:
+        A tuple of (conn, server, roster, history):
+            conn (socket.socket):
+                The (blocking) handoff connection; the sessions will arrive on it next.
+
+            server (socket.socket):
+                The (non-blocking) listening socket, ready to accept on.
+
+            roster (dict):
+                The old server's roster, as dumped by 'Roster.dump()'. Load it before accepting anybody.
+
+            history (dict):
+                The old server's chat history, as dumped by 'History.dump()'. Load it before accepting anybody.
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.connect(str(path))
+
+    payload, fds = recv_frame(conn)
+
+    if payload.get('type') != LISTENER or len(fds) != 1:
+        raise ConnectionError(f'Expected the listening socket from the old server, got {payload!r}.')
+
+    server = socket.socket(fileno=fds[0])
+    server.setblocking(False)
+
+    return conn, server, payload['roster'], payload['history']
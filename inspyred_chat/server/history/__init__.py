@@ -0,0 +1,126 @@
+"""
+Sequence numbers for chat messages, and a ring of the most recent ones for reconnecting clients to catch up from.
+
+Each message is encoded once, when it's recorded, and the encoded line is what goes into the ring. Catching a client
+up is then just joining a slice of the ring into a single send, however many clients reconnect at once.
+"""
+from collections import deque
+from itertools import islice
+from time import time
+from uuid import uuid4
+
+from inspyred_chat import protocol
+
+HISTORY_SIZE = 1000
+"""
+(int) - How many of the most recent chat messages are kept for clients to catch up from.
+"""
+
+HISTORY_BATCH = 64 * 1024
+"""
+(int) - The most bytes of history sent in answer to a single '/history' request. Clients that are further behind ask
+again for the rest.
+"""
+
+
+class History:
+    def __init__(self, size=HISTORY_SIZE):
+        """
+        The chat sequence and the ring of recent messages.
+
+        Arguments:
+            size (int):
+                How many messages to keep. (Defaults to `HISTORY_SIZE`)
+        """
+        self.epoch = uuid4().hex
+        self.seq = 0
+        self.ring = deque(maxlen=size)
+
+    @property
+    def oldest(self):
+        """
+        The sequence number of the oldest message still in the ring.
+        """
+        return self.seq - len(self.ring) + 1
+
+    def record(self, nick, text):
+        """
+        Give a chat message the next sequence number and remember it.
+
+        Arguments:
+            nick (str):
+                The sender's nickname.
+
+            text (str):
+                The message.
+
+        Returns:
+            bytes:
+                The encoded 'CHAT' line, ready to broadcast.
+        """
+        self.seq += 1
+        line = protocol.encode_line(protocol.format_chat(self.seq, int(time() * 1000), nick, text))
+        self.ring.append(line)
+        return line
+
+    def since(self, after, limit=HISTORY_BATCH):
+        """
+        Get the messages newer than `after` that are still in the ring.
+
+        Arguments:
+            after (int):
+                The newest sequence number the client already has.
+
+            limit (int):
+                Roughly the most bytes to return. At least one message is returned if there are any. (Defaults to
+                `HISTORY_BATCH`)
+
+        Returns:
+            A tuple of (data, last):
+                data (bytes):
+                    The encoded 'CHAT' lines.
+
+                last (int):
+                    The sequence number of the last message in `data`, or of the newest message if there was nothing
+                    to send.
+        """
+        start = max(after + 1, self.oldest)
+
+        if start > self.seq:
+            return b'', self.seq
+
+        lines = []
+        size = 0
+        last = start - 1
+
+        for line in islice(self.ring, start - self.oldest, None):
+            if lines and size + len(line) > limit:
+                break
+            lines.append(line)
+            size += len(line)
+            last += 1
+
+        return b''.join(lines), last
+
+    def dump(self):
+        return {
+            'epoch': self.epoch,
+            'seq': self.seq,
+            'ring': [line.decode(protocol.ENCODING) for line in self.ring],
+        }
+
+    def load(self, data):
+        """
+        Carry on from a history dumped by the server we're taking over from.
+
+        Arguments:
+            data (dict):
+                The output of `dump()`.
+
+        Returns:
+            None
+        """
+        self.epoch = data['epoch']
+        self.seq = data['seq']
+        self.ring.clear()
+        self.ring.extend(line.encode(protocol.ENCODING) for line in data['ring'])
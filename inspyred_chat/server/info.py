@@ -1,4 +1,4 @@
-from appdirs import user_config_dir
+from appdirs import user_cache_dir, user_config_dir
 from inspy_logger import LEVELS as LOG_LEVELS
 from pathlib import Path
 
@@ -11,3 +11,7 @@ CONFIG_FILE_EXTENSION = 'conf'
 
 
 DEFAULT_PORT = 85855
+
+DEFAULT_SPOOL_DIR = Path(user_cache_dir(PROG, appauthor=AUTHOR)).joinpath('spool')
+
+DEFAULT_TLS_DIR = DEFAULT_CONFIG_DIR.joinpath('tls')
@@ -0,0 +1,157 @@
+"""
+A versioned list of who is connected to the server.
+
+Rather than announcing every join and leave on its own, changes are collected for a short window and then committed
+together as a single new roster version. Clients fetch a snapshot once and keep up to date by applying the deltas
+between versions, so a burst of reconnects costs everyone one message instead of one message per reconnect.
+
+Each version's snapshot is only encoded once, however many clients ask for it.
+"""
+import sys
+from time import monotonic
+
+from inspyred_chat import protocol
+
+DEFAULT_WINDOW = 0.25
+"""
+(float) - How many seconds to collect roster changes for before committing them as a new version.
+"""
+
+
+class Roster:
+    def __init__(self, window=DEFAULT_WINDOW):
+        """
+        The connected users, plus the changes that haven't been committed to a version yet.
+
+        Arguments:
+            window (float):
+                How many seconds to collect changes for before they're due to be committed. (Defaults to
+                `DEFAULT_WINDOW`)
+        """
+        self.window = window
+        self.version = 0
+        self.members = {}
+        self._added = {}
+        self._removed = set()
+        self._snapshot = None
+        self.deadline = None
+
+    def __len__(self):
+        return len(self.members)
+
+    @property
+    def due(self):
+        """
+        Whether there are changes waiting to be committed and their window has passed.
+        """
+        return self.deadline is not None and monotonic() >= self.deadline
+
+    def _changed(self):
+        if self.deadline is None:
+            self.deadline = monotonic() + self.window
+
+    def join(self, client_id, nick):
+        """
+        Note that a user joined.
+
+        Arguments:
+            client_id (int):
+                The user's client UUID, as an int.
+
+            nick (str):
+                The user's nickname.
+
+        Returns:
+            None
+        """
+        self._removed.discard(client_id)
+
+        if self.members.get(client_id) == nick:
+            self._added.pop(client_id, None)
+        else:
+            self._added[client_id] = nick
+
+        self._changed()
+
+    def leave(self, client_id):
+        """
+        Note that a user left.
+
+        A user who joins and leaves again within the same window never shows up in a delta at all.
+
+        Arguments:
+            client_id (int):
+                The user's client UUID, as an int.
+
+        Returns:
+            None
+        """
+        self._added.pop(client_id, None)
+
+        if client_id in self.members:
+            self._removed.add(client_id)
+
+        self._changed()
+
+    def commit(self):
+        """
+        Commit the collected changes as a new roster version.
+
+        Returns:
+            A tuple of (from_version, to_version, added, removed), or None if the changes cancelled each other out and
+            the version didn't change.
+        """
+        added, removed = self._added, self._removed
+        self._added, self._removed = {}, set()
+        self.deadline = None
+
+        if not added and not removed:
+            return None
+
+        for client_id in removed:
+            del self.members[client_id]
+        self.members.update(added)
+
+        self.version += 1
+
+        return self.version - 1, self.version, added, removed
+
+    def snapshot(self):
+        """
+        Get the committed roster as a 'ROSTER SNAPSHOT' line.
+
+        Returns:
+            bytes:
+                The encoded line, built the first time it's asked for at the current version.
+        """
+        if self._snapshot is None or self._snapshot[0] != self.version:
+            self._snapshot = self.version, protocol.encode_line(protocol.format_snapshot(self.version, self.members))
+
+        return self._snapshot[1]
+
+    def dump(self):
+        """
+        Get the committed roster in a JSON serializable form, e.g. to hand it to a newer server.
+
+        Returns:
+            dict:
+                The roster version and its members.
+        """
+        return {'version': self.version, 'members': {f'{uid:032x}': nick for uid, nick in self.members.items()}}
+
+    def load(self, data):
+        """
+        Replace the committed roster with one produced by `dump()`.
+
+        Any changes still waiting to be committed are kept.
+
+        Arguments:
+            data (dict):
+                The dumped roster.
+
+        Returns:
+            None
+        """
+        self.version = data['version']
+        self.members = {int(uid, 16): sys.intern(nick) for uid, nick in data['members'].items()}
+        self._snapshot = None
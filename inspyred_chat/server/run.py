@@ -1,12 +1,27 @@
 #  Copyright (c) 2022. Inspyre Softworks
 
+import os
+import selectors
+import signal
 import socket
-from threading import Thread
-from uuid import uuid4
-
+import sys
+from collections import deque
+from pathlib import Path
+from time import monotonic
+from uuid import UUID, uuid4
+
+from inspyred_chat import protocol
+from inspyred_chat.server import admin, handoff, tls
+from inspyred_chat.server.capture import DISCONNECT, MESSAGE, NICK, CaptureWriter
 from inspyred_chat.server.cli import CLIArgs
 from inspyred_chat.server.config import Config
+from inspyred_chat.server.history import History
 from inspyred_chat.server.info import PROG
+from inspyred_chat.server.roster import Roster
+from inspyred_chat.server.session import (
+    ACTIVE, AWAIT_NICK, AWAIT_UUID, STATES, TLS_HANDSHAKE, WOULD_BLOCK, Session, SessionTable
+)
+from inspyred_chat.server.transfer import Download, Spool, Upload
 from inspyred_chat.server.logger import LOG_DEVICE
 
 LOG = LOG_DEVICE.add_child(f'{PROG}.run')
@@ -68,14 +83,35 @@ Note:
                                 ```pip install ip-reveal-headless```
     """
 
-CLIENTS = []
+SESSIONS = SessionTable()
 """
-(list) - A list containing all the client objects for easy access to all.
+(SessionTable) - Every connected client's `Session`, indexed by socket file descriptor and by client UUID.
+
+This replaces the separate 'CLIENTS', 'NICKS' and 'CLIENT_MANIFEST' containers; use 'SESSIONS.active()' and 
+'SESSIONS.nicks()' to get at the connected clients and their nicknames.
 """
 
-NICKS = []
+CLOSING = {}
 """
-(list) - A list of the nicknames of clients connected to the server.
+(dict) - Sessions that failed while we were sending to them, waiting for 'reap()' to disconnect them. Used as an 
+ordered set so that a mass disconnect doesn't recurse through 'broadcast()'.
+"""
+
+ROSTER = Roster()
+"""
+(Roster) - Who's connected, versioned so that clients can keep up through deltas instead of join/leave notices.
+"""
+
+HISTORY = History()
+"""
+(History) - Numbers every chat message and remembers the most recent ones, so reconnecting clients only need to ask 
+for what they missed.
+"""
+
+SELECTOR = selectors.DefaultSelector()
+"""
+(selectors.BaseSelector) - Watches the 'SERVER' socket and every client socket, so that a single thread can serve all 
+connected clients.
 """
 
 SERVER = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -89,14 +125,110 @@ PORT = 5300
 (int) - The port number we'd like to listen on.
 """
 
+BACKLOG = 1024
+"""
+(int) - How many not-yet-accepted connections the kernel should queue up for us.
+"""
+
+RECV_SIZE = 4096
+"""
+(int) - The most bytes we'll read from a client socket each time it becomes readable.
+"""
+
+UPLOAD_RECV_SIZE = protocol.CHUNK_SIZE
+"""
+(int) - The most bytes we'll read at once from a client socket that's in the middle of uploading a file.
+"""
+
+MAX_DOWNLOADS = 4
+"""
+(int) - How many files a single client may be fetching at once.
+"""
+
+SPOOL = Spool(ARGS.spool_dir, ARGS.spool_quota)
+"""
+(Spool) - Where uploaded files are kept until somebody fetches them.
+"""
+
+TRANSFER_RATE = ARGS.transfer_rate
+"""
+(int) - The most bytes per second of file data sent to each client.
+"""
+
+NEXT_CHUNK = {}
+"""
+(dict) - For every session with downloads in progress, the 'time.monotonic()' value at which its next file chunk may 
+be started.
+"""
+
+SLEEPING = set()
+"""
+(set) - Sessions that have stopped asking for write events because they've used up their transfer rate for now. They 
+are woken up by 'receive()' once their 'NEXT_CHUNK' time comes around.
+"""
+
 server_addr = f'{HOST}:{PORT}'
 """
 (str) - The full server address in the format of 'HOST:PORT'.
 """
 
-CLIENT_MANIFEST = {}
+CAPTURE = CaptureWriter(ARGS.capture_file) if ARGS.capture_file else None
 """
-(dict) - Contains all the information for each connected client.
+(CaptureWriter|None) - Records connection events and messages when the server was started with '--capture-file'.
+"""
+
+HANDOFF = None
+"""
+(socket|None) - The Unix socket a newer server can connect to in order to take over from us. Only opened when the 
+server was started with '--handoff-socket'.
+"""
+
+PREDECESSOR = None
+"""
+(socket|None) - Our connection to the server we're taking over from, while its sessions are still arriving. Only 
+used when the server was started with '--takeover'.
+"""
+
+TLS_CONTEXT = None
+"""
+(ssl.SSLContext|None) - What new client sockets are wrapped with when the server was started with '--tls'.
+"""
+
+HANDSHAKES = None
+"""
+(tls.HandshakePool|None) - Runs TLS handshakes off the main loop, so that a burst of new TLS connections doesn't hold
+up everybody else's chat.
+"""
+
+CORKED = set()
+"""
+(set) - TLS sessions with messages queued since the last pass of the main loop. Everything queued for a session during
+one pass goes out together, as few TLS records as possible, instead of one record (and one encryption) per message.
+"""
+
+ADMIN = None
+"""
+(admin.AdminServer|None) - The local admin socket, when the server was started with '--admin-socket'.
+"""
+
+TIMINGS = admin.Timings([
+    ('accept', sys.modules[__name__], 'accept'),
+    ('tls', sys.modules[__name__], 'handshake_results'),
+    ('handshake', sys.modules[__name__], 'handshake'),
+    ('recv', sys.modules[__name__], 'read_from'),
+    ('decode', protocol, 'next_line'),
+    ('fanout', sys.modules[__name__], 'broadcast'),
+])
+"""
+(admin.Timings) - Timing hooks around each stage of serving clients. Switched on and off through the admin socket's 
+'timings' command, and free while off.
+"""
+
+STARTED = monotonic()
+
+RUNNING = True
+"""
+(bool) - Whether 'receive()' should keep going. Set to False once we've handed everything off to a newer server.
 """
 
 
@@ -107,13 +239,321 @@ def server_startup():
     Goes through server socket prep;
         1) Binds to the provided host, and port.
         2) Begins listening.
+        3) Registers the server socket with the selector so 'receive()' picks up new connections.
+
+    When started with '--takeover' the first two steps are skipped; the
+    listening socket and roster are received from the running server
+    instead, and its sessions will follow through 'take_over()'.
+
+    Returns:
+        None
+
+    """
+    global SERVER, PREDECESSOR
+
+    if ARGS.tls:
+        start_tls()
+
+    if ARGS.takeover:
+        SERVER.close()
+        PREDECESSOR, SERVER, roster, history = handoff.connect(ARGS.takeover)
+        ROSTER.load(roster)
+        HISTORY.load(history)
+        SELECTOR.register(PREDECESSOR, selectors.EVENT_READ, None)
+        print(f'TAKEOVER START {ARGS.takeover}')
+    else:
+        SERVER.bind((HOST, PORT))
+        SERVER.listen(BACKLOG)
+        SERVER.setblocking(False)
+        open_handoff_socket()
+
+    SELECTOR.register(SERVER, selectors.EVENT_READ, None)
+
+    if ARGS.admin_socket:
+        open_admin_socket()
+
+
+def open_admin_socket():
+    """
+    Start serving admin commands on '--admin-socket'.
+
+    Returns:
+        None
+    """
+    global ADMIN
+
+    ADMIN = admin.AdminServer(ARGS.admin_socket, SELECTOR, {'stats': stats, 'timings': TIMINGS.command})
+    print(f'ADMIN SOCKET {ARGS.admin_socket}')
+
+
+def stats(args):
+    """
+    The admin socket's 'stats' command.
+
+    Arguments:
+        args (list):
+            Unused.
+
+    Returns:
+        dict:
+            Every connection's traffic, queue depth and idle time, and the state of the main loop.
+    """
+    now = monotonic()
+
+    return {
+        'uptime': round(now - STARTED, 3),
+        'loop': {
+            'sessions': len(SESSIONS),
+            'active': len(SESSIONS.active()),
+            'roster_version': ROSTER.version,
+            'chat_seq': HISTORY.seq,
+            'roster_pending': ROSTER.deadline is not None,
+            'corked': len(CORKED),
+            'closing': len(CLOSING),
+            'downloading': len(NEXT_CHUNK),
+            'sleeping': len(SLEEPING),
+            'timings': TIMINGS.enabled,
+        },
+        # Iterating the session table takes a copy of it, so connections coming and going meanwhile don't matter.
+        'sessions': admin.Listing(SESSIONS, describe_session),
+    }
+
+
+def describe_session(session):
+    """
+    A connection's entry in the admin socket's 'stats'.
+
+    Arguments:
+        session (Session):
+            The connection's session.
+
+    Returns:
+        dict|None:
+            Its traffic, queue depth and idle time, or None if it has gone since 'stats' was asked for.
+    """
+    if session.closed:
+        return None
+
+    return {
+        'fd': session.fileno,
+        'addr': list(session.addr),
+        'nick': session.nick,
+        'state': STATES[session.state],
+        'tls': session.tls,
+        'rx': session.rx,
+        'tx': session.tx,
+        'queued': session.pending,
+        'downloads': len(session.downloads) if session.downloads else 0,
+        'uploading': session.upload is not None,
+        'idle': round(monotonic() - session.last_active, 3),
+    }
+
+
+def start_tls():
+    """
+    Load (or create) the server's certificate and start the handshake workers.
+
+    Returns:
+        None
+    """
+    global TLS_CONTEXT
+
+    cert, key = Path(ARGS.tls_cert).expanduser(), Path(ARGS.tls_key).expanduser()
+
+    if not cert.exists() and not key.exists():
+        cert.parent.mkdir(parents=True, exist_ok=True)
+        key.parent.mkdir(parents=True, exist_ok=True)
+        tls.generate_self_signed(cert, key, list(dict.fromkeys([HOST, 'localhost'])))
+        print(f'TLS CERTIFICATE CREATED {cert}')
+
+    TLS_CONTEXT = tls.server_context(str(cert), str(key))
+    start_handshakes()
+
+
+def start_handshakes():
+    """
+    Start the TLS handshake workers.
 
     Returns:
         None
+    """
+    global HANDSHAKES
+
+    HANDSHAKES = tls.HandshakePool()
+    SELECTOR.register(HANDSHAKES.fileobj, selectors.EVENT_READ, None)
+
+
+def open_handoff_socket():
+    """
+    Start listening for a newer server to hand off to, if we were asked to.
+
+    Returns:
+        None
+    """
+    global HANDOFF
+
+    if ARGS.handoff_socket:
+        HANDOFF = handoff.listen(ARGS.handoff_socket)
+        SELECTOR.register(HANDOFF, selectors.EVENT_READ, None)
+
 
+def hand_off():
     """
-    SERVER.bind((HOST, PORT))
-    SERVER.listen()
+    Hand the listening socket and every session to the newer server connecting on 'HANDOFF', then stop.
+
+    Our copies of the sockets are only closed once the new server has
+    acknowledged getting everything, and without shutting them down, so the
+    clients stay connected to it. If the handoff fails part way, we carry on
+    serving everybody ourselves and listen for another attempt.
+
+    TLS connections can't be handed over, since their keys only exist in
+    this process. They are closed instead, and their clients have to
+    reconnect.
+
+    Returns:
+        None
+    """
+    global RUNNING
+
+    conn, _ = HANDOFF.accept()
+    conn.settimeout(handoff.TIMEOUT)
+
+    SELECTOR.unregister(HANDOFF)
+    HANDOFF.close()
+    os.unlink(ARGS.handoff_socket)
+
+    # The workers may be part way through a handshake on a socket we're about to close.
+    if HANDSHAKES is not None:
+        SELECTOR.unregister(HANDSHAKES.fileobj)
+        HANDSHAKES.close()
+
+    for session in SESSIONS:
+        if session.tls:
+            disconnect(session)
+
+    # Anything still waiting to be committed would be lost on the way, so commit it now.
+    publish_roster()
+    reap()
+
+    sessions = list(SESSIONS)
+    print(f'HANDOFF START {len(sessions)} sessions')
+
+    SELECTOR.unregister(SERVER)
+    for session in sessions:
+        SELECTOR.unregister(session.sock)
+
+    try:
+        handoff.hand_off(conn, SERVER, sessions, ROSTER.dump(), HISTORY.dump())
+    except (OSError, ValueError) as err:
+        print(f'HANDOFF FAILED {err}')
+        conn.close()
+
+        SELECTOR.register(SERVER, selectors.EVENT_READ, None)
+        for session in sessions:
+            register(session)
+
+        if TLS_CONTEXT is not None:
+            start_handshakes()
+
+        open_handoff_socket()
+        return
+
+    if ADMIN is not None:
+        ADMIN.close()
+
+    for session in sessions:
+        session.sock.close()
+    SERVER.close()
+    conn.close()
+
+    print('HANDOFF COMPLETE')
+    RUNNING = False
+
+
+def take_over():
+    """
+    Adopt the next batch of sessions sent by the server we're taking over from.
+
+    Returns:
+        None
+    """
+    global PREDECESSOR
+
+    try:
+        payload, fds = handoff.recv_frame(PREDECESSOR)
+        kind = payload['type']
+    except (OSError, ValueError, KeyError) as err:
+        # The old server keeps (or takes back) everything it hasn't handed over yet, so get out of its way rather
+        # than serve the same listening socket and clients alongside it.
+        print(f'TAKEOVER FAILED {err}')
+        sys.exit(1)
+
+    if kind == handoff.SESSIONS:
+        for data, fd in zip(payload['sessions'], fds):
+            sock = socket.socket(fileno=fd)
+
+            try:
+                session = handoff.load_session(data, sock, SPOOL)
+            except (OSError, ValueError, KeyError) as err:
+                # Without its upload or downloads we'd lose track of where its lines start, so let it reconnect.
+                print(f'TAKEOVER DROPPED {data.get("addr")} {err}')
+                sock.close()
+                if data.get('state') == ACTIVE:
+                    ROSTER.leave(int(data['client_id'], 16))
+                continue
+
+            if CAPTURE is not None:
+                session.capture_id = CAPTURE.new_connection(session.addr)
+                if session.nick is not None:
+                    CAPTURE.record(NICK, session.capture_id, session.nick)
+
+            if session.downloads:
+                NEXT_CHUNK[session] = 0.0
+
+            SESSIONS.add(session)
+            register(session)
+
+    elif kind == handoff.DONE:
+        handoff.send_frame(PREDECESSOR, {'type': handoff.ACK})
+        SELECTOR.unregister(PREDECESSOR)
+        PREDECESSOR.close()
+        PREDECESSOR = None
+
+        print(f'TAKEOVER COMPLETE {payload["count"]} sessions')
+        open_handoff_socket()
+
+
+def register(session):
+    """
+    Start watching a session's socket, including for writability if it has anything waiting to go out.
+
+    Arguments:
+        session (Session):
+            The session to watch.
+
+    Returns:
+        None
+    """
+    events = selectors.EVENT_READ | selectors.EVENT_WRITE if session.wbuf or session.downloads else selectors.EVENT_READ
+    SELECTOR.register(session.sock, events, session)
+
+
+def want_write(session, enabled=True):
+    """
+    Tell the selector whether we want to know when a client socket becomes writable.
+
+    Arguments:
+        session (Session):
+            The session in question.
+
+        enabled (bool):
+            True while the session has data waiting to be written. (Defaults to True)
+
+    Returns:
+        None
+    """
+    events = selectors.EVENT_READ | selectors.EVENT_WRITE if enabled else selectors.EVENT_READ
+    SELECTOR.modify(session.sock, events, session)
 
 
 def broadcast(message):
@@ -126,39 +566,508 @@ def broadcast(message):
     Returns:
         None
     """
-    for client in CLIENTS:
-        client.send(message)
+    if isinstance(message, str):
+        message = protocol.encode_line(message)
+
+    for session in SESSIONS.active():
+        client_send(session, message)
 
 
-def handle(client):
+def handle(session):
     """
-    Handle an ongoing connection with the client.
+    Handle a client socket that has become readable.
 
-    Contains the main loop for sending and receiving messages to and from the
-    client
+    Reads whatever the client sent and, line by line, either feeds it to
+    the handshake, carries it out as a command or broadcasts it as a chat
+    message. The raw bytes following a '/chunk' command go straight into the
+    file being uploaded.
 
     Arguments:
-        client:
-            The client object from the socket connection.
+        session (Session):
+            The session belonging to the readable socket.
 
     Returns:
         None
     """
-    nick = NICKS[-1]
-    while True:
+    message = read_from(session)
+
+    if message is None:
+        return
+
+    if not message:
+        disconnect(session)
+        return
+
+    if session.rbuf:
+        session.rbuf += message
+        data, session.rbuf = session.rbuf, None
+    else:
+        data = message
+
+    pos = 0
+
+    with memoryview(data) as view:
+        while pos < len(data) and not session.closed:
+            if session.upload is not None and session.upload.expecting:
+                pos += session.upload.write(view[pos:])
+                if not session.upload.expecting:
+                    chunk_received(session)
+                continue
+
+            line, pos = protocol.next_line(data, pos)
+            if line is None:
+                break
+
+            if session.state != ACTIVE:
+                handshake(session, line)
+            elif line.startswith(protocol.CMD_PREFIX):
+                command(session, line)
+            else:
+                print(f'MSG {line!r}')
+                if CAPTURE is not None:
+                    CAPTURE.record(MESSAGE, session.capture_id, line)
+                broadcast(HISTORY.record(session.nick, line))
+
+    if pos < len(data) and not session.closed:
+        if len(data) - pos > protocol.MAX_LINE:
+            print(f'OVERLONG LINE {session.nick}@{session.addr}')
+            disconnect(session)
+            return
+        session.rbuf = bytearray(data[pos:])
+
+
+def read_from(session):
+    """
+    Read whatever a readable client socket has for us.
+
+    Arguments:
+        session (Session):
+            The session belonging to the readable socket.
+
+    Returns:
+        bytes|None:
+            What was received; empty if the client has gone, or None if there turned out to be nothing to read.
+    """
+    try:
+        message = session.sock.recv(RECV_SIZE if session.upload is None else UPLOAD_RECV_SIZE)
+
+        # The selector only knows about the raw socket, so anything already decrypted has to be collected now.
+        if session.tls:
+            while message and session.sock.pending():
+                message += session.sock.recv(session.sock.pending())
+    except WOULD_BLOCK:
+        return None
+    except OSError:
+        return b''
+
+    session.rx += len(message)
+    session.last_active = monotonic()
+
+    return message
+
+
+def command(session, line):
+    """
+    Carry out a command sent by a client.
+
+    Arguments:
+        session (Session):
+            The session of the client that sent it.
+
+        line (str):
+            The command line, including its prefix.
+
+    Returns:
+        None
+    """
+    name, _, args = line[len(protocol.CMD_PREFIX):].partition(' ')
+    name = name.lower()
+
+    if name == protocol.CMD_ROSTER:
+        # A big roster can be more than a write buffer holds on its own, which is no reason to drop the client.
+        client_send(session, ROSTER.snapshot(), oversized=True)
+    elif name == protocol.CMD_UPLOAD:
+        offer_file(session, args)
+    elif name == protocol.CMD_CHUNK:
+        start_chunk(session, args)
+    elif name == protocol.CMD_FETCH:
+        fetch_file(session, args)
+    elif name == protocol.CMD_HISTORY:
+        send_history(session, args)
+    else:
+        client_send(session, f'Unknown command: {name}')
+
+
+def send_history(session, args):
+    """
+    Catch a client up on the chat messages it missed.
+
+    Arguments:
+        session (Session):
+            The client's session.
+
+        args (str):
+            The arguments to '/history'; the newest sequence number the client already has.
+
+    Returns:
+        None
+    """
+    try:
+        after = max(0, int(args))
+    except ValueError:
+        after = 0
+
+    data, last = HISTORY.since(after)
+
+    if data:
+        client_send(session, data)
+    client_send(session, f'{protocol.HISTORY_END} {last} {HISTORY.seq}')
+
+
+def offer_file(session, args):
+    """
+    Get ready to receive a file a client wants to upload, and tell it where to start from.
+
+    Arguments:
+        session (Session):
+            The uploading client's session.
+
+        args (str):
+            The arguments to '/upload'; '<file_id> <size> <name>'.
+
+    Returns:
+        None
+    """
+    file_id = args.split(' ', 1)[0]
+
+    try:
+        _, size, name = args.split(' ', 2)
+        entry = SPOOL.offer(file_id, int(size), name, session.nick)
+    except ValueError as err:
+        client_send(session, f'{protocol.FILE_ERROR} {file_id or "-"} {err}')
+        return
+
+    if session.upload is not None:
+        session.upload.finish()
+        session.upload = None
+
+    if entry.complete:
+        client_send(session, f'{protocol.FILE_ACCEPT} {file_id} {entry.size}')
+        return
+
+    session.upload = Upload(entry)
+    print(f'UPLOAD START {session.nick} {file_id} {entry.name} {session.upload.offset}/{entry.size}')
+    client_send(session, f'{protocol.FILE_ACCEPT} {file_id} {session.upload.offset}')
+
+
+def start_chunk(session, args):
+    """
+    Get ready for the raw bytes that follow a '/chunk' command.
+
+    We can't tell where the next line starts without knowing how many raw
+    bytes come first, so malformed chunks and chunks for files that aren't
+    being uploaded get the client disconnected. Chunks that merely start at
+    the wrong offset are skipped, and the client is told where to carry on
+    from.
+
+    Arguments:
+        session (Session):
+            The uploading client's session.
+
+        args (str):
+            The arguments to '/chunk'; '<file_id> <offset> <length>'.
+
+    Returns:
+        None
+    """
+    try:
+        file_id, offset, length = args.split(' ')
+        offset, length = int(offset), int(length)
+    except ValueError:
+        file_id, length = None, 0
+
+    upload = session.upload
+
+    if length <= 0 or upload is None or upload.entry.file_id != file_id:
+        client_send(session, f'{protocol.FILE_ERROR} {file_id or "-"} unexpected-chunk')
+        disconnect(session)
+        return
+
+    if not upload.start_chunk(offset, length):
+        client_send(session, f'{protocol.FILE_ACCEPT} {file_id} {upload.offset}')
+
+
+def chunk_received(session):
+    """
+    Deal with the end of an uploaded chunk, announcing the file to everyone if it was the last one.
+
+    Arguments:
+        session (Session):
+            The uploading client's session.
+
+    Returns:
+        None
+    """
+    upload = session.upload
+
+    if not upload.done:
+        return
+
+    session.upload = None
+
+    if not upload.finish():
+        client_send(session, f'{protocol.FILE_ERROR} {upload.entry.file_id} expired')
+        return
+
+    print(f'UPLOAD COMPLETE {session.nick} {upload.entry.file_id} {upload.entry.name}')
+    broadcast(upload.entry.announcement())
+
+
+def fetch_file(session, args):
+    """
+    Start sending a spooled file to a client.
+
+    Arguments:
+        session (Session):
+            The fetching client's session.
+
+        args (str):
+            The arguments to '/fetch'; '<file_id> [<offset>]'.
+
+    Returns:
+        None
+    """
+    file_id, _, offset = args.partition(' ')
+    entry = SPOOL.get(file_id)
+
+    try:
+        offset = int(offset or 0)
+    except ValueError:
+        offset = -1
+
+    if entry is None or not entry.complete:
+        client_send(session, f'{protocol.FILE_ERROR} {file_id or "-"} not-found')
+    elif not 0 <= offset <= entry.size:
+        client_send(session, f'{protocol.FILE_ERROR} {file_id} bad-offset')
+    elif session.downloads and len(session.downloads) >= MAX_DOWNLOADS:
+        client_send(session, f'{protocol.FILE_ERROR} {file_id} too-many-downloads')
+    elif offset == entry.size:
+        client_send(session, entry.header())
+    else:
+        # Sent ahead of the file data, since write() empties the write buffer before starting a chunk.
+        client_send(session, entry.header())
+        if session.downloads is None:
+            session.downloads = deque()
+        session.downloads.append(Download(entry, offset))
+        NEXT_CHUNK.setdefault(session, 0.0)
+        print(f'DOWNLOAD START {session.nick} {file_id} {offset}/{entry.size}')
+        want_write(session)
+
+
+def serve_download(session):
+    """
+    Start the next file chunk for a session, if its transfer rate allows.
+
+    Only called once the session's write buffer is empty, so that file data
+    only ever goes out when there's no chat waiting. Downloads take turns a
+    chunk at a time.
+
+    Arguments:
+        session (Session):
+            The downloading client's session.
+
+    Returns:
+        None
+    """
+    downloads = session.downloads
+
+    while downloads and downloads[0].done:
+        downloads.popleft().close()
+
+    if not downloads:
+        session.downloads = None
+        NEXT_CHUNK.pop(session, None)
+        want_write(session, False)
+        return
+
+    now = monotonic()
+
+    if NEXT_CHUNK[session] > now:
+        SLEEPING.add(session)
+        want_write(session, False)
+        return
+
+    length = downloads[0].next_chunk()
+    NEXT_CHUNK[session] = max(now, NEXT_CHUNK[session]) + length / TRANSFER_RATE
+
+    if pump(session):
+        downloads.rotate(-1)
+
+
+def pump(session):
+    """
+    Send as much of a session's current file chunk as its socket will take, counting it towards the bytes sent.
+
+    Arguments:
+        session (Session):
+            The downloading client's session.
+
+    Returns:
+        Boolean:
+            True once the chunk has been sent in full.
+    """
+    download = session.downloads[0]
+    offset = download.offset
+
+    done = download.pump(session.sock)
+    session.tx += download.offset - offset
+
+    return done
+
+
+def wake_sleepers():
+    """
+    Resume sending files to sessions whose transfer rate allows another chunk.
+
+    Returns:
+        None
+    """
+    now = monotonic()
+
+    for session in [session for session in SLEEPING if NEXT_CHUNK.get(session, 0) <= now]:
+        SLEEPING.discard(session)
+        if not session.closed:
+            want_write(session)
+
+
+def uncork():
+    """
+    Send everything queued for corked TLS sessions during this pass of the main loop.
+
+    Returns:
+        None
+    """
+    for session in CORKED:
+        if session.closed or session in CLOSING:
+            continue
+
         try:
-            message = client.recv(1024)
-            print(f'MSG {message}')
-            broadcast(f'<<{nick}>> {message}'.encode('ascii'))
-        except:
-            index = CLIENTS.index(client)
-            CLIENTS.remove(client)
-            client.close()
-            nick = NICKS[index]
-            print(f'DISCONNECT {nick}')
-            broadcast(f"{nick} left the server!".encode('ascii'))
-            NICKS.remove(nick)
-            break
+            if session.flush():
+                want_write(session)
+        except OSError:
+            CLOSING[session] = None
+
+    CORKED.clear()
+
+
+def publish_roster():
+    """
+    Commit pending roster changes and send the resulting delta to everyone.
+
+    Returns:
+        None
+    """
+    delta = ROSTER.commit()
+
+    if delta is not None:
+        print(f'ROSTER {delta[0]} -> {delta[1]} (+{len(delta[2])} -{len(delta[3])})')
+        broadcast(protocol.format_delta(*delta))
+
+
+def write(session):
+    """
+    Handle a client socket that has become writable.
+
+    Any file chunk that's part way out is finished first, then whatever is
+    waiting in the write buffer is sent, and only then is another file chunk
+    started.
+
+    Arguments:
+        session (Session):
+            The session belonging to the writable socket.
+
+    Returns:
+        None
+    """
+    try:
+        if session.streaming:
+            if not pump(session):
+                return
+            session.downloads.rotate(-1)
+
+        if session.flush():
+            return
+
+        if session.downloads:
+            serve_download(session)
+        else:
+            want_write(session, False)
+    except OSError:
+        disconnect(session)
+
+
+def disconnect(session):
+    """
+    Close a client connection and forget about it.
+
+    If the client had finished its handshake, everyone else is told that it left.
+
+    Arguments:
+        session (Session):
+            The session to close.
+
+    Returns:
+        None
+    """
+    if session.closed:
+        return
+
+    CLOSING.pop(session, None)
+    fileno = session.fileno
+
+    try:
+        SELECTOR.unregister(session.sock)
+    except (KeyError, ValueError):
+        pass
+
+    session.sock.close()
+    SESSIONS.remove(session, fileno)
+
+    if session.upload is not None:
+        session.upload.finish()
+        session.upload = None
+
+    if session.downloads:
+        for download in session.downloads:
+            download.close()
+        session.downloads = None
+
+    NEXT_CHUNK.pop(session, None)
+    SLEEPING.discard(session)
+    CORKED.discard(session)
+
+    if CAPTURE is not None:
+        CAPTURE.record(DISCONNECT, session.capture_id)
+
+    if session.state == ACTIVE:
+        print(f'DISCONNECT {session.nick}')
+        ROSTER.leave(session.client_id)
+
+
+def reap():
+    """
+    Disconnect every session that failed while being sent to.
+
+    Disconnecting may flush data to other sessions and fail for more of
+    them; those are picked up by this same loop.
+
+    Returns:
+        None
+    """
+    while CLOSING:
+        session = next(iter(CLOSING))
+        del CLOSING[session]
+        disconnect(session)
 
 
 def new_uuid():
@@ -166,7 +1075,7 @@ def new_uuid():
     Generate a UUID for a connecting client.
 
     For 'just-in-case' reasons, we start a loop before generating a UUID and then check the generated UUID against the
-    client manifest. If the uid is novel we'll break out of the loop and return it to the caller. Otherwise, we let the
+    session table. If the uid is novel we'll break out of the loop and return it to the caller. Otherwise, we let the
     loop run again. This process will repeat until a unique UUID has been generated. At this point we break outta the
     loop and return our generation to the caller.
 
@@ -174,67 +1083,73 @@ def new_uuid():
         I do not expect that this fail-safe will ever come into play, but better safe than HALTed/exploited.
 
     Returns:
-        A UUID (String):
-            A unique identifier for a connecting client.
+        A UUID (int):
+            A unique identifier for a connecting client, as a 128-bit integer.
 
     """
     uid = None
 
     while True:
-        uid = uuid4()
-        if uid not in CLIENT_MANIFEST.keys():
+        uid = uuid4().int
+        if not SESSIONS.has_client_id(uid):
             break
 
     return uid
 
 
-def client_send(client, msg):
+def client_send(session, msg, oversized=False):
     """
-    Send a message to the provided client socket connection.
+    Send a message to the provided client session.
+
+    Whatever the socket won't take right away is buffered and sent once it
+    becomes writable. Clients that let too much pile up are disconnected.
+
+    Messages to TLS clients are only queued here, and sent by 'uncork()' at
+    the end of the current pass of the main loop.
 
     Arguments:
-        client:
-            The client object from the socket connection.
+        session (Session):
+            The session of the client we want to send to.
 
-        msg:
-            The message that we want to send to the socket connection.
+        msg (str|bytes):
+            The message that we want to send to the socket connection. Strings
+            are sent as a single protocol line; bytes are sent as they are.
+
+        oversized (bool):
+            Send the message however big it is, rather than count it towards
+            the client's write buffer limit. (Defaults to False)
 
     Returns:
         None
     """
-    client.send(msg.encode('ascii'))
+    if session.closed or session in CLOSING:
+        return
 
+    if isinstance(msg, str):
+        msg = protocol.encode_line(msg)
 
-def client_receive(client):
-    """
-    Receive incoming message from client.
+    try:
+        if session.tls:
+            session.queue(msg, oversized)
+            CORKED.add(session)
+        elif session.send(msg, oversized):
+            want_write(session)
+    except (OSError, BufferError):
+        CLOSING[session] = None
 
-    Receive 1024 bits and decode it before returning it to caller.
 
-    Arguments:
-        client:
-            The client object from the incoming socket connection from client.
-
-    Returns:
-        String:
-            The decoded message from the client.
-
-    """
-    return client.recv(1024).decode('ascii')
-
-
-def req_from_client(client, pointer):
+def req_from_client(session, pointer):
     """
     Request information from the client.
 
-    Providing a pointer and a client object to attempt to contact we send a
-    message to the given client with the request string for whatever pointer
-    provided after which it waits for the client response which is immediately
-    returned to the caller.
+    Providing a pointer and a client session to contact we send a message to
+    the given client with the request string for whatever pointer provided.
+    The client's response arrives through 'handle()' like anything else it
+    sends, and is dealt with by 'handshake()'.
 
     Args:
-        client:
-            The client object from the socket.
+        session (Session):
+            The session of the client.
 
         pointer (String):
             The pointer string indicating the piece of information you'd like to attain.
@@ -243,8 +1158,7 @@ def req_from_client(client, pointer):
                  The pointer string must be one of the valid pointers; 'NICK' or 'UUID'
 
     Returns:
-        response (String):
-            The response given by the client.
+        None
 
     """
     pointers = [
@@ -260,60 +1174,230 @@ def req_from_client(client, pointer):
     if pointer.upper() not in pointers:
         raise ValueError(f"The 'pointer' parameter must be one of; {', '.join(pointers)}. Not '{pointer}'.")
 
-    client_send(client, f'REQ {pointer}')
+    client_send(session, f'REQ {pointer}')
 
-    return client_receive(client)
 
+def handshake(session, response):
+    """
+    Move a connecting client along its handshake.
 
-def handshake(client):
-    print('HANDSHAKE START')
+    Clients are asked for their nickname as soon as they connect, and asked
+    again until they give one that `protocol.valid_nick()` accepts. Once they've
+    given it we ask for their UUID, and once that arrives the client is
+    announced to everyone and can start chatting.
 
-    # Get wanted nickname
-    client_send(client, 'REQ NICK')
-    nickname = client_receive(client)
+    Arguments:
+        session (Session):
+            The session of the connecting client.
+
+        response (str):
+            The line the client sent in answer to our last request.
 
-    client_uuid = uuid4()
-    connection_uuid = uuid4()
+    Returns:
+        None
+    """
+    response = response.strip()
 
-    print(f'CLIENT UUID CREATE {client_uuid}')
-    print(f'CONNECTION UUID CREATE {connection_uuid}')
+    if session.state == AWAIT_NICK:
+        if not protocol.valid_nick(response):
+            print(f'{session.addr} BAD NICK {response!r}')
+            client_send(
+                session, f'{protocol.NICK_REJECTED} Nicknames can\'t be empty or contain spaces or control characters.'
+            )
+            req_from_client(session, 'NICK')
+            return
 
-    client_send(client, 'REQ UUID')
+        session.set_nick(response)
 
+        if CAPTURE is not None:
+            CAPTURE.record(NICK, session.capture_id, response)
 
-def receive():
+        print(f'{session.addr} IDENTLOW {session.nick}')
+
+        session.state = AWAIT_UUID
+        req_from_client(session, 'UUID')
+
+    elif session.state == AWAIT_UUID:
+        try:
+            client_uuid = UUID(response).int
+        except ValueError:
+            client_uuid = None
+
+        if client_uuid is not None and not SESSIONS.has_client_id(client_uuid):
+            SESSIONS.rekey(session, client_uuid)
+
+        print(f'CLIENT UUID {UUID(int=session.client_id)}')
+
+        session.state = ACTIVE
+        ROSTER.join(session.client_id, session.nick)
+        client_send(session, f'{protocol.SYNC} {HISTORY.epoch} {HISTORY.seq}')
+        client_send(session, 'You have been connected to the server')
+
+
+def accept():
+    """
+    Accept every connection waiting on the 'SERVER' socket and start their handshakes.
+
+    Returns:
+        None
+    """
     while True:
-        client, addr = SERVER.accept()
+        try:
+            client, addr = SERVER.accept()
+        except BlockingIOError:
+            return
+
+        client.setblocking(False)
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        if TLS_CONTEXT is not None:
+            client = TLS_CONTEXT.wrap_socket(client, server_side=True, do_handshake_on_connect=False)
 
         print(f'CONNECT {addr}')
 
-        client_send(client, 'REQ NICK')
+        capture_id = CAPTURE.new_connection(addr) if CAPTURE is not None else None
 
-        nick = client.recv(1024).decode('ascii')
+        session = Session(client, addr, client_id=new_uuid(), capture_id=capture_id)
 
-        client_uuid = uuid4()
-        connection_uuid = uuid4()
+        print(f'CLIENT UUID CREATE {UUID(int=session.client_id)}')
+        print(f'CONNECTION UUID CREATE {UUID(int=session.connection_id)}')
 
-        print(f'CLIENT UUID CREATE {client_uuid}')
-        print(f'CONNECTION UUID CREATE {connection_uuid}')
+        SESSIONS.add(session)
 
-        client.send('REQ UUID'.encode('ascii'))
+        if session.tls:
+            session.state = TLS_HANDSHAKE
+            HANDSHAKES.submit(client, session)
+            continue
 
-        CLIENT_MANIFEST[client_uuid] = {
+        SELECTOR.register(client, selectors.EVENT_READ, session)
 
-        }
+        req_from_client(session, 'NICK')
 
-        NICKS.append(nick)
-        CLIENTS.append(client)
 
-        print(f'{addr} IDENTLOW {nick}')
-        broadcast(f'{nick}@{addr} joined!'.encode('ascii'))
-        client.send('You have been connected to the server'.encode('ascii'))
+def tls_handshake(session):
+    """
+    Hand a handshaking TLS session's next step to the handshake workers.
 
-        thread = Thread(target=handle, args=(client,))
-        thread.start()
+    The socket is taken out of the selector until the step is done, so the
+    main loop neither waits for it nor touches it meanwhile.
 
+    Arguments:
+        session (Session):
+            The session whose socket became ready.
+
+    Returns:
+        None
+    """
+    SELECTOR.unregister(session.sock)
+    HANDSHAKES.submit(session.sock, session)
+
+
+def handshake_results():
+    """
+    Pick up after every TLS handshake step the workers have finished.
+
+    Sessions that need more from the client (or room to write) go back into
+    the selector until they do. Finished ones start the chat handshake.
+
+    Returns:
+        None
+    """
+    for session, result in HANDSHAKES.results():
+        if session.closed:
+            continue
+
+        if isinstance(result, Exception):
+            print(f'TLS HANDSHAKE FAILED {session.addr} {result}')
+            disconnect(session)
+        elif result == tls.READ:
+            SELECTOR.register(session.sock, selectors.EVENT_READ, session)
+        elif result == tls.WRITE:
+            SELECTOR.register(session.sock, selectors.EVENT_WRITE, session)
+        else:
+            sock = session.sock
+            print(f'TLS {session.addr} {sock.version()} {sock.cipher()[0]}{" RESUMED" if sock.session_reused else ""}')
+
+            session.state = AWAIT_NICK
+            SELECTOR.register(sock, selectors.EVENT_READ, session)
+            req_from_client(session, 'NICK')
+
+
+def receive():
+    """
+    Run the server's main loop.
+
+    Waits on the selector and accepts new connections, reads from readable
+    clients and writes to writable ones, all from this one thread. Roster
+    changes are published whenever their coalescing window runs out.
+
+    Returns:
+        None
+    """
+    while RUNNING:
+        deadlines = [NEXT_CHUNK[session] for session in SLEEPING]
+        if ROSTER.deadline is not None:
+            deadlines.append(ROSTER.deadline)
+        if ADMIN is not None and ADMIN.busy:
+            deadlines.append(ADMIN.deadline)
+        timeout = max(0, min(deadlines) - monotonic()) if deadlines else None
+
+        for key, mask in SELECTOR.select(timeout):
+            session = key.data
+
+            if ADMIN is not None and session is ADMIN:
+                ADMIN.ready(key.fileobj)
+                continue
+
+            if session is None:
+                if key.fileobj is SERVER:
+                    accept()
+                elif key.fileobj is HANDOFF:
+                    hand_off()
+                    break
+                elif key.fileobj is PREDECESSOR:
+                    take_over()
+                elif HANDSHAKES is not None and key.fileobj is HANDSHAKES.fileobj:
+                    handshake_results()
+                continue
+
+            if session.state == TLS_HANDSHAKE:
+                tls_handshake(session)
+                continue
+
+            if mask & selectors.EVENT_WRITE:
+                write(session)
+
+            if mask & selectors.EVENT_READ and not session.closed:
+                handle(session)
+
+        if ROSTER.due:
+            publish_roster()
+
+        if SLEEPING:
+            wake_sleepers()
+
+        if CORKED:
+            uncork()
+
+        if ADMIN is not None and ADMIN.busy:
+            ADMIN.run_due()
+
+        reap()
+
+
+def main():
+    # Make sure a plain 'kill' still runs our cleanup, so captures are flushed to disk.
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
 
-if __name__ == '__main__':
     server_startup()
-    receive()
+    try:
+        receive()
+    finally:
+        if ADMIN is not None and RUNNING:
+            ADMIN.close()
+        if CAPTURE is not None:
+            CAPTURE.close()
+
+
+if __name__ == '__main__':
+    main()
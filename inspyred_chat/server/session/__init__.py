@@ -0,0 +1,304 @@
+"""
+Compact per-connection state for the chat server.
+
+Each connected client is a single `Session`. Sessions use '__slots__' so they carry no per-instance '__dict__', keep
+both of their UUIDs as plain 128-bit ints, intern their nicknames, and only hold a write buffer while the kernel
+won't take everything we've tried to send them. The server only calls 'recv()' on a session once the selector says
+it's readable, and only holds on to a read buffer while the client is part way through sending a line.
+
+Sessions also count the bytes they've received and sent, and remember when their client was last heard from, for the
+admin socket's 'stats' command.
+
+All sessions live in one `SessionTable`, which replaces the separate client, nickname and manifest containers the
+server used to keep.
+
+A session's socket may be an 'ssl.SSLSocket', in which case sends and receives that can't go ahead right now raise one
+of the 'ssl.SSLWant*Error's instead of 'BlockingIOError'; catch `WOULD_BLOCK` to cover both.
+"""
+import ssl
+import sys
+from time import monotonic
+from uuid import uuid4
+
+AWAIT_NICK = 0
+AWAIT_UUID = 1
+ACTIVE = 2
+TLS_HANDSHAKE = 3
+
+STATES = {
+    AWAIT_NICK: 'AWAIT_NICK',
+    AWAIT_UUID: 'AWAIT_UUID',
+    ACTIVE: 'ACTIVE',
+    TLS_HANDSHAKE: 'TLS_HANDSHAKE',
+}
+"""
+(dict) - The name of each state a session can be in, keyed by its numeric value.
+"""
+
+IDLE_SESSION_BUDGET = 1024
+"""
+(int) - The most Python heap (in bytes, as measured by tracemalloc) a single idle, fully handshaken connection may cost.
+
+This covers the connection's `Session`, its entries in the `SessionTable` and its registration with the server's
+selector. It does not include the socket object itself or kernel socket buffers. 'tests/test_session.py' checks it.
+
+At this budget, 100,000 idle connections cost the server roughly 100MB of Python heap.
+"""
+
+MAX_WRITE_BUFFER = 1024 * 1024
+"""
+(int) - How many bytes may be waiting to go out to a single session before we consider it too slow and drop it. Any
+oversized messages (see `Session.queue()`) in the write buffer don't count towards this.
+"""
+
+WOULD_BLOCK = (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError)
+"""
+(tuple) - The exceptions a non-blocking plain or TLS socket raises when it can't send or receive right now.
+"""
+
+
+class Session:
+    __slots__ = (
+        'sock', 'addr', 'nick', 'client_id', 'connection_id', 'capture_id', 'state', 'rbuf', 'wbuf', 'upload',
+        'downloads', 'rx', 'tx', 'last_active', 'grace'
+    )
+
+    def __init__(self, sock, addr, client_id=None, capture_id=None):
+        """
+        The state the server keeps for a single connected client.
+
+        Arguments:
+            sock (socket.socket):
+                The (non-blocking) client socket.
+
+            addr (tuple):
+                The address tuple returned by 'socket.accept()'.
+
+            client_id (int):
+                The client's UUID as an int. A fresh one is generated if this isn't given.
+
+            capture_id (int):
+                The connection number handed out by the capture writer, if one is recording.
+        """
+        self.sock = sock
+        self.addr = addr
+        self.nick = None
+        self.client_id = uuid4().int if client_id is None else client_id
+        self.connection_id = uuid4().int
+        self.capture_id = capture_id
+        self.state = AWAIT_NICK
+        self.rbuf = None
+        self.wbuf = None
+        self.upload = None
+        self.downloads = None
+        self.rx = 0
+        self.tx = 0
+        self.last_active = monotonic()
+        self.grace = 0
+
+    def __repr__(self):
+        return f'<Session {self.nick}@{self.addr} {STATES[self.state]}>'
+
+    @property
+    def fileno(self):
+        return self.sock.fileno()
+
+    @property
+    def closed(self):
+        return self.sock.fileno() == -1
+
+    @property
+    def tls(self):
+        return isinstance(self.sock, ssl.SSLSocket)
+
+    @property
+    def streaming(self):
+        """
+        Whether a file chunk is part way out of the door, in which case everything else has to wait behind it.
+        """
+        return bool(self.downloads) and self.downloads[0].sending
+
+    @property
+    def pending(self):
+        """
+        The number of bytes waiting to be written to the client.
+        """
+        return len(self.wbuf) if self.wbuf else 0
+
+    def set_nick(self, nick):
+        self.nick = sys.intern(nick)
+
+    def queue(self, data, oversized=False):
+        """
+        Add `data` to the write buffer without trying to send anything yet.
+
+        Arguments:
+            data (bytes):
+                What to send.
+
+            oversized (bool):
+                Let `data` through however big it is, e.g. for a roster snapshot. It doesn't count towards
+                `MAX_WRITE_BUFFER` until the write buffer has been emptied. (Defaults to False)
+
+        Returns:
+            None
+
+        Raises:
+            BufferError:
+                If the write buffer would grow past `MAX_WRITE_BUFFER`.
+        """
+        if oversized:
+            self.grace += len(data)
+        elif self.pending + len(data) > MAX_WRITE_BUFFER + self.grace:
+            raise BufferError(f'{self!r} has more than {MAX_WRITE_BUFFER} bytes waiting to be sent.')
+        if self.wbuf is None:
+            self.wbuf = bytearray()
+        self.wbuf += data
+
+    def send(self, data, oversized=False):
+        """
+        Send as much of `data` as the socket will take right now and buffer the rest.
+
+        Arguments:
+            data (bytes):
+                What to send.
+
+            oversized (bool):
+                Let `data` through however big it is; see `queue()`. (Defaults to False)
+
+        Returns:
+            Boolean:
+                True if there is now data waiting in the write buffer, False if everything went out.
+
+        Raises:
+            BufferError:
+                If the write buffer would grow past `MAX_WRITE_BUFFER`.
+        """
+        if self.wbuf or self.streaming:
+            self.queue(data, oversized)
+            return True
+
+        try:
+            sent = self.sock.send(data)
+        except WOULD_BLOCK:
+            sent = 0
+
+        self.tx += sent
+
+        if sent < len(data):
+            self.wbuf = bytearray(data[sent:])
+            if oversized:
+                self.grace = len(self.wbuf)
+            return True
+
+        return False
+
+    def flush(self):
+        """
+        Try to write out the write buffer, dropping it once it's empty.
+
+        Returns:
+            Boolean:
+                True if data is still waiting to be written, False if the buffer was emptied.
+        """
+        if not self.wbuf:
+            self.wbuf = None
+            self.grace = 0
+            return False
+
+        if self.streaming:
+            return True
+
+        try:
+            sent = self.sock.send(self.wbuf)
+        except WOULD_BLOCK:
+            return True
+
+        del self.wbuf[:sent]
+        self.tx += sent
+
+        if not self.wbuf:
+            self.wbuf = None
+            self.grace = 0
+            return False
+
+        return True
+
+
+class SessionTable:
+    def __init__(self):
+        """
+        Every connected session, indexed by socket file descriptor and by client UUID.
+        """
+        self._by_fd = {}
+        self._by_client = {}
+
+    def __len__(self):
+        return len(self._by_fd)
+
+    def __iter__(self):
+        return iter(tuple(self._by_fd.values()))
+
+    def add(self, session):
+        self._by_fd[session.fileno] = session
+        self._by_client[session.client_id] = session
+
+    def remove(self, session, fileno=None):
+        """
+        Forget about a session.
+
+        Arguments:
+            session (Session):
+                The session to remove.
+
+            fileno (int):
+                The file descriptor it was registered under; needed when the socket has already been closed.
+
+        Returns:
+            None
+        """
+        self._by_fd.pop(session.fileno if fileno is None else fileno, None)
+        if self._by_client.get(session.client_id) is session:
+            del self._by_client[session.client_id]
+
+    def rekey(self, session, client_id):
+        """
+        Change the client UUID a session is known by, e.g. once the client has told us its own.
+
+        Arguments:
+            session (Session):
+                The session to update.
+
+            client_id (int):
+                The new client UUID, as an int.
+
+        Returns:
+            None
+        """
+        if self._by_client.get(session.client_id) is session:
+            del self._by_client[session.client_id]
+        session.client_id = client_id
+        self._by_client[client_id] = session
+
+    def get(self, fileno):
+        return self._by_fd.get(fileno)
+
+    def by_client_id(self, client_id):
+        return self._by_client.get(client_id)
+
+    def has_client_id(self, client_id):
+        return client_id in self._by_client
+
+    def active(self):
+        """
+        Every session that has finished its handshake.
+
+        Returns:
+            list:
+                The sessions in the 'ACTIVE' state.
+        """
+        return [session for session in self._by_fd.values() if session.state == ACTIVE]
+
+    def nicks(self):
+        return [session.nick for session in self._by_fd.values() if session.state == ACTIVE]
+
@@ -0,0 +1,230 @@
+"""
+Optional TLS for the chat server.
+
+The server's 'SSLContext' is built once and cached, and leaves session tickets switched on so that reconnecting
+clients can resume their earlier TLS session instead of going through a full handshake.
+
+Handshakes are driven one non-blocking step at a time by `handshake_step()`. The server runs each step on a small
+thread pool (OpenSSL releases the GIL while it does the expensive part), so the cost of setting up TLS for a crowd of
+new connections is never paid on the thread serving everybody else.
+"""
+import ipaddress
+import os
+import socket
+import ssl
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import lru_cache
+from queue import Empty, SimpleQueue
+
+TICKETS = 2
+"""
+(int) - How many TLS 1.3 session tickets to give each client, i.e. how many times it can resume before needing a full
+handshake again.
+"""
+
+WORKERS = 4
+"""
+(int) - How many threads run TLS handshake steps.
+"""
+
+READ = 'read'
+WRITE = 'write'
+DONE = 'done'
+
+
+@lru_cache(maxsize=None)
+def server_context(cert_path, key_path):
+    """
+    Get the (cached) 'SSLContext' the server wraps client sockets with.
+
+    Arguments:
+        cert_path (str):
+            The server's certificate (chain), PEM encoded.
+
+        key_path (str):
+            The certificate's private key, PEM encoded.
+
+    Returns:
+        ssl.SSLContext:
+            The context. The same object is returned for the same arguments every time.
+    """
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(cert_path, key_path)
+    context.num_tickets = TICKETS
+
+    return context
+
+
+def handshake_step(sock):
+    """
+    Take the TLS handshake on a non-blocking socket as far as it can go without waiting.
+
+    Arguments:
+        sock (ssl.SSLSocket):
+            The wrapped, non-blocking socket, created with 'do_handshake_on_connect=False'.
+
+    Returns:
+        str:
+            One of;
+                READ: The handshake needs more from the client; call again once the socket is readable.
+                WRITE: The socket is full; call again once it's writable.
+                DONE: The handshake has finished.
+
+    Raises:
+        ssl.SSLError, OSError:
+            If the handshake failed.
+    """
+    try:
+        sock.do_handshake()
+    except ssl.SSLWantReadError:
+        return READ
+    except ssl.SSLWantWriteError:
+        return WRITE
+
+    return DONE
+
+
+class HandshakePool:
+    def __init__(self, workers=WORKERS):
+        """
+        Run TLS handshake steps on worker threads and hand the results back to a selector loop.
+
+        The loop registers `fileobj` for reading; it becomes readable whenever a step has finished, and `results()`
+        then gives back what each one came to. A socket must not be watched by the loop, or touched at all, while a
+        step for it is running.
+
+        Arguments:
+            workers (int):
+                How many handshake steps may run at once. (Defaults to `WORKERS`)
+        """
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tls-handshake')
+        self._results = SimpleQueue()
+        self.fileobj, self._wake = socket.socketpair()
+        self.fileobj.setblocking(False)
+        self._wake.setblocking(False)
+
+    def submit(self, sock, tag):
+        """
+        Start the next step of a handshake.
+
+        Arguments:
+            sock (ssl.SSLSocket):
+                The socket being handshaken.
+
+            tag:
+                Anything; it's handed back with the result, e.g. the socket's session.
+
+        Returns:
+            None
+        """
+        future = self._executor.submit(handshake_step, sock)
+        future.add_done_callback(lambda done: self._finished(tag, done))
+
+    def _finished(self, tag, future):
+        error = future.exception()
+        self._results.put((tag, future.result() if error is None else error))
+
+        try:
+            self._wake.send(b'\0')
+        except BlockingIOError:
+            # The loop has plenty of unread wake-ups already.
+            pass
+
+    def results(self):
+        """
+        Collect the steps that have finished since the last call.
+
+        Returns:
+            list:
+                A list of (tag, result) tuples, where 'result' is READ, WRITE or DONE, or the exception the handshake
+                failed with.
+        """
+        try:
+            while self.fileobj.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        results = []
+
+        while True:
+            try:
+                results.append(self._results.get_nowait())
+            except Empty:
+                return results
+
+    def close(self):
+        """
+        Wait for any running steps to finish, then stop the worker threads.
+
+        Returns:
+            None
+        """
+        self._executor.shutdown(wait=True)
+        self.fileobj.close()
+        self._wake.close()
+
+
+def generate_self_signed(cert_path, key_path, hostnames, days=365):
+    """
+    Create a self-signed certificate and key, e.g. for trying TLS out or for a private server.
+
+    Clients verify the server by passing the certificate as their CA file.
+
+    Arguments:
+        cert_path (str|pathlib.Path):
+            Where to write the certificate.
+
+        key_path (str|pathlib.Path):
+            Where to write the private key. Only readable by our own user.
+
+        hostnames (list):
+            The host names and/or IP addresses clients will connect to.
+
+        days (int):
+            How long the certificate is valid for. (Defaults to 365)
+
+    Returns:
+        None
+    """
+    # Only needed here, so we don't make 'cryptography' a hard requirement for running a plain-text server.
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, hostnames[0])])
+
+    alt_names = []
+    for hostname in hostnames:
+        try:
+            alt_names.append(x509.IPAddress(ipaddress.ip_address(hostname)))
+        except ValueError:
+            alt_names.append(x509.DNSName(hostname))
+
+    now = datetime.utcnow()
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - timedelta(minutes=5))
+        .not_valid_after(now + timedelta(days=days))
+        .add_extension(x509.SubjectAlternativeName(alt_names), critical=False)
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+
+    with open(os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as file:
+        file.write(key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()
+        ))
+
+    with open(cert_path, 'wb') as file:
+        file.write(cert.public_bytes(serialization.Encoding.PEM))
@@ -0,0 +1,232 @@
+"""
+Measure what TLS costs the chat server.
+
+Both ends of each connection run in this process over memory buffers, so the numbers are pure TLS work with no
+network in the way;
+
+    * Handshakes per second, and the bytes each one puts on the wire, full and resumed from a session ticket.
+    * The bytes and time each chat message costs once encrypted, sent as one TLS record per message the way a naive
+      broadcast would, and corked into shared records the way the server sends them.
+
+Usage:
+    python -m inspyred_chat.server.tls.bench --cert server.crt --key server.key
+"""
+import ssl
+import tempfile
+from argparse import ArgumentParser
+from pathlib import Path
+from time import perf_counter
+
+from inspyred_chat import protocol
+from inspyred_chat.server.tls import generate_self_signed, server_context
+
+HOSTNAME = 'localhost'
+
+
+class Pair:
+    def __init__(self, server_ctx, client_ctx, session=None):
+        """
+        A client and server TLS connection wired directly to each other through memory buffers.
+
+        Arguments:
+            server_ctx (ssl.SSLContext):
+                The server's context.
+
+            client_ctx (ssl.SSLContext):
+                The client's context.
+
+            session (ssl.SSLSession):
+                A session for the client to try to resume. (Defaults to a full handshake)
+        """
+        self.bios = {}
+        self.wire = 0
+        self.client = self._wrap(client_ctx, server_side=False, server_hostname=HOSTNAME, session=session)
+        self.server = self._wrap(server_ctx, server_side=True)
+
+    def _wrap(self, context, **kwargs):
+        incoming, outgoing = ssl.MemoryBIO(), ssl.MemoryBIO()
+        end = context.wrap_bio(incoming, outgoing, **kwargs)
+        self.bios[end] = (incoming, outgoing)
+        return end
+
+    def _move(self, sender, receiver):
+        data = self.bios[sender][1].read()
+        if data:
+            self.bios[receiver][0].write(data)
+            self.wire += len(data)
+        return len(data)
+
+    def _shuttle(self):
+        return bool(self._move(self.client, self.server) + self._move(self.server, self.client))
+
+    def handshake(self):
+        """
+        Run the handshake to completion, then let the client pick up its session tickets.
+
+        Returns:
+            None
+        """
+        done = {self.client: False, self.server: False}
+
+        while not all(done.values()):
+            for end in done:
+                if not done[end]:
+                    try:
+                        end.do_handshake()
+                        done[end] = True
+                    except ssl.SSLWantReadError:
+                        pass
+            if not self._shuttle() and not all(done.values()):
+                raise ssl.SSLError('The handshake stalled.')
+
+        # TLS 1.3 tickets arrive after the handshake, and are only processed when the client next reads.
+        self._shuttle()
+        try:
+            self.client.read(1)
+        except ssl.SSLWantReadError:
+            pass
+
+    def send(self, payload):
+        """
+        Encrypt `payload` on the server end and decrypt it on the client end.
+
+        Returns:
+            int:
+                The number of bytes that went over the "wire".
+        """
+        self.server.write(payload)
+        wire = self._move(self.server, self.client)
+
+        received = 0
+        while received < len(payload):
+            received += len(self.client.read(len(payload)))
+
+        return wire
+
+
+def client_context(cafile):
+    context = ssl.create_default_context(cafile=cafile)
+    context.check_hostname = True
+    return context
+
+
+def bench_handshakes(server_ctx, client_ctx, count):
+    """
+    Time full and resumed handshakes.
+
+    Arguments:
+        server_ctx (ssl.SSLContext):
+            The server's context.
+
+        client_ctx (ssl.SSLContext):
+            The client's context.
+
+        count (int):
+            How many handshakes of each kind to run.
+
+    Returns:
+        dict:
+            For each of 'full' and 'resumed', a tuple of (handshakes_per_second, bytes_per_handshake, resumed_count).
+    """
+    results = {}
+    session = None
+
+    for name in ('full', 'resumed'):
+        wire = reused = 0
+
+        start = perf_counter()
+        for _ in range(count):
+            pair = Pair(server_ctx, client_ctx, session if name == 'resumed' else None)
+            pair.handshake()
+            wire += pair.wire
+            reused += pair.client.session_reused
+            # Each ticket is only good once, so carry on with a fresh one.
+            session = pair.client.session
+        elapsed = perf_counter() - start
+
+        results[name] = (count / elapsed, wire / count, reused)
+
+    return results
+
+
+def bench_messages(server_ctx, client_ctx, count, size, batch):
+    """
+    Measure the per-message cost of encrypting chat lines one record at a time, and `batch` lines to a record.
+
+    Arguments:
+        server_ctx (ssl.SSLContext):
+            The server's context.
+
+        client_ctx (ssl.SSLContext):
+            The client's context.
+
+        count (int):
+            How many messages to send each way.
+
+        size (int):
+            How long each message is, in bytes, terminator included.
+
+        batch (int):
+            How many messages to put in each record when corking.
+
+    Returns:
+        dict:
+            For each of 'single' and 'corked', a tuple of (bytes_per_message, microseconds_per_message).
+    """
+    line = protocol.encode_line('x' * (size - len(protocol.TERMINATOR)))
+    results = {}
+
+    for name, per_record in (('single', 1), ('corked', batch)):
+        pair = Pair(server_ctx, client_ctx)
+        pair.handshake()
+
+        payload = line * per_record
+        records = count // per_record
+        wire = 0
+
+        start = perf_counter()
+        for _ in range(records):
+            wire += pair.send(payload)
+        elapsed = perf_counter() - start
+
+        sent = records * per_record
+        results[name] = (wire / sent, elapsed / sent * 1e6)
+
+    return results
+
+
+def main():
+    parser = ArgumentParser(prog='inspyred-chat-tls-bench', description='Measure what TLS costs the chat server.')
+    parser.add_argument('--cert', help='The server certificate to use. A throwaway one is made if not given.')
+    parser.add_argument('--key', help='The certificate\'s private key.')
+    parser.add_argument('--handshakes', type=int, default=500, help='How many handshakes of each kind to run.')
+    parser.add_argument('--messages', type=int, default=20000, help='How many messages to send each way.')
+    parser.add_argument('--size', type=int, default=64, help='The size of each message in bytes.')
+    parser.add_argument('--batch', type=int, default=32, help='How many messages share a record when corked.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.cert is None:
+            args.cert, args.key = str(Path(tmp, 'bench.crt')), str(Path(tmp, 'bench.key'))
+            generate_self_signed(args.cert, args.key, [HOSTNAME])
+
+        server_ctx = server_context(args.cert, args.key)
+        client_ctx = client_context(args.cert)
+
+        results = bench_handshakes(server_ctx, client_ctx, args.handshakes)
+        for name, (rate, wire, reused) in results.items():
+            print(
+                f'{name.capitalize():<7} handshakes: {rate:8.1f}/s, {wire:6.0f} bytes on the wire each '
+                f'({reused}/{args.handshakes} resumed)'
+            )
+
+        results = bench_messages(server_ctx, client_ctx, args.messages, args.size, args.batch)
+        for name, (wire, micros) in results.items():
+            print(
+                f'{name.capitalize():<7} {args.size} byte messages: {wire:7.1f} bytes on the wire '
+                f'(+{wire - args.size:.1f}), {micros:6.2f}us each'
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,516 @@
+"""
+Spool uploaded files to disk and stream them back out to whoever fetches them.
+
+Uploads are written straight from the received buffer into a '.part' file in the spool directory, next to a small JSON
+sidecar describing the file. Once the last byte arrives the '.part' file is renamed into place. Because both live on
+disk, an interrupted upload can be resumed from wherever it got to, even by a different server process.
+
+When a new file won't fit in the spool's quota, uploads that haven't moved in `PART_MAX_AGE` are given up on, then the
+oldest complete files are removed until it does.
+
+Downloads to plain-text clients never pass file data through Python at all; each chunk is sent with 'os.sendfile()'
+straight from the spool file to the client socket. TLS clients need the data encrypted first, so theirs is read into
+memory and sent a piece at a time.
+"""
+import json
+import os
+import ssl
+from operator import itemgetter
+from pathlib import Path
+from time import time
+
+from inspyred_chat import protocol
+from inspyred_chat.server.session import WOULD_BLOCK
+
+MAX_FILE_SIZE = 256 * 1024 * 1024
+"""
+(int) - The largest file, in bytes, that can be uploaded.
+"""
+
+DEFAULT_QUOTA = 4 * 1024 * 1024 * 1024
+"""
+(int) - How many bytes of uploaded files the spool may hold, counting every file offered at its full size.
+"""
+
+META_SIZE = 4096
+"""
+(int) - What each file's JSON sidecar is counted as against the spool's quota; one filesystem block.
+"""
+
+PART_MAX_AGE = 24 * 60 * 60
+"""
+(int) - How many seconds an unfinished upload has to go without receiving anything before it may be removed to make
+room for new files.
+"""
+
+DEFAULT_RATE = 1024 * 1024
+"""
+(int) - How many bytes per second of file data each client is sent, at most.
+"""
+
+NAME_LIMIT = 255
+
+TLS_READ_SIZE = 16 * 1024
+"""
+(int) - How much of a file to read and send at once to a TLS client; one full TLS record.
+"""
+
+
+class SpoolFile:
+    __slots__ = ('file_id', 'name', 'size', 'owner', 'dirpath')
+
+    def __init__(self, file_id, name, size, owner, dirpath):
+        """
+        A file that has been, or is being, uploaded into the spool.
+
+        Arguments:
+            file_id (str):
+                The ID the uploader gave the file.
+
+            name (str):
+                The file's name, as given by the uploader.
+
+            size (int):
+                The file's full size in bytes.
+
+            owner (str):
+                The nickname of the uploader.
+
+            dirpath (pathlib.Path):
+                The spool directory.
+        """
+        self.file_id = file_id
+        self.name = name
+        self.size = size
+        self.owner = owner
+        self.dirpath = dirpath
+
+    @property
+    def path(self):
+        return self.dirpath.joinpath(self.file_id)
+
+    @property
+    def part_path(self):
+        return self.dirpath.joinpath(f'{self.file_id}.part')
+
+    @property
+    def meta_path(self):
+        return self.dirpath.joinpath(f'{self.file_id}.json')
+
+    @property
+    def complete(self):
+        return self.path.exists()
+
+    @property
+    def modified(self):
+        """
+        When the file, or whatever there is of it so far, was last written to, in seconds since the epoch.
+        """
+        for path in (self.path, self.part_path, self.meta_path):
+            try:
+                return path.stat().st_mtime
+            except FileNotFoundError:
+                pass
+
+        return 0.0
+
+    @property
+    def received(self):
+        """
+        How many bytes of the file have been uploaded so far.
+        """
+        if self.complete:
+            return self.size
+
+        try:
+            return self.part_path.stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    def announcement(self):
+        return f'{protocol.FILE_AVAILABLE} {self.file_id} {self.size} {self.owner} {self.name}'
+
+    def header(self):
+        return f'{protocol.FILE_START} {self.file_id} {self.size} {self.name}'
+
+
+class Spool:
+    def __init__(self, dirpath, quota=DEFAULT_QUOTA, part_max_age=PART_MAX_AGE):
+        """
+        The directory uploaded files are kept in, and an index of what's in it.
+
+        Files left behind by an earlier server (including half-finished uploads) are picked up again.
+
+        Arguments:
+            dirpath (str|pathlib.Path):
+                The spool directory. Created if it doesn't exist.
+
+            quota (int):
+                How many bytes of files the spool may hold. (Defaults to `DEFAULT_QUOTA`)
+
+            part_max_age (float):
+                How many seconds an unfinished upload may sit untouched before it can be removed to make room.
+                (Defaults to `PART_MAX_AGE`)
+        """
+        self.dirpath = Path(dirpath).expanduser().resolve()
+        self.dirpath.mkdir(parents=True, exist_ok=True)
+        self.quota = quota
+        self.part_max_age = part_max_age
+        self.used = 0
+        self.files = {}
+
+        for meta in self.dirpath.glob('*.json'):
+            self._load(meta)
+
+    def _load(self, meta):
+        try:
+            with open(meta) as file:
+                entry = SpoolFile(dirpath=self.dirpath, **json.load(file))
+
+            if not isinstance(entry.file_id, str) or meta.name != f'{entry.file_id}.json':
+                raise ValueError(f'it describes {entry.file_id!r}')
+
+            if type(entry.size) is not int or not 0 < entry.size <= MAX_FILE_SIZE:
+                raise ValueError(f'bad size {entry.size!r}')
+
+            if not isinstance(entry.name, str) or protocol.file_name(entry.name) != entry.name:
+                raise ValueError(f'bad name {entry.name!r}')
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as err:
+            print(f'SPOOL SKIPPED {meta}: {err}')
+            return None
+
+        self.files[entry.file_id] = entry
+        self.used += entry.size + META_SIZE
+        return entry
+
+    def _remove(self, entry):
+        for path in (entry.path, entry.part_path, entry.meta_path):
+            path.unlink(missing_ok=True)
+
+        del self.files[entry.file_id]
+        self.used -= entry.size + META_SIZE
+
+    def make_room(self, size):
+        """
+        Free up enough of the quota for `size` more bytes, if need be.
+
+        Stale unfinished uploads go first, then the complete files that were finished longest ago. Anybody still
+        downloading a removed file can carry on, as they have it open already. Files that are still being uploaded are
+        never removed.
+
+        Arguments:
+            size (int):
+                How many bytes are needed.
+
+        Returns:
+            Boolean:
+                True if there's room now.
+        """
+        if self.used + size <= self.quota:
+            return True
+
+        stale_before = time() - self.part_max_age
+        partial, complete = [], []
+
+        for entry in self.files.values():
+            (complete if entry.complete else partial).append((entry.modified, entry))
+
+        candidates = sorted((item for item in partial if item[0] < stale_before), key=itemgetter(0))
+        candidates += sorted(complete, key=itemgetter(0))
+
+        for _, entry in candidates:
+            if self.used + size <= self.quota:
+                break
+
+            print(f'SPOOL EVICTED {entry.file_id} {entry.name} ({entry.received}/{entry.size})')
+            self._remove(entry)
+
+        return self.used + size <= self.quota
+
+    def get(self, file_id):
+        """
+        Find a file in the spool.
+
+        Files offered to another server sharing the spool directory since we looked through it (e.g. the one we're
+        taking over from) are picked up from disk.
+
+        Arguments:
+            file_id (str):
+                The file's ID.
+
+        Returns:
+            SpoolFile|None:
+                The file's spool entry, or None if there's no such file.
+        """
+        entry = self.files.get(file_id)
+
+        if entry is None and protocol.FILE_ID.match(file_id):
+            entry = self._load(self.dirpath.joinpath(f'{file_id}.json'))
+
+        return entry
+
+    def offer(self, file_id, size, name, owner):
+        """
+        Get ready to receive a file, or find out how far along an earlier attempt at uploading it got.
+
+        Arguments:
+            file_id (str):
+                The ID the uploader picked for the file.
+
+            size (int):
+                The file's full size in bytes.
+
+            name (str):
+                The file's name.
+
+            owner (str):
+                The uploader's nickname.
+
+        Returns:
+            SpoolFile:
+                The file's spool entry. Check its 'received' property to see where the upload should carry on from.
+
+        Raises:
+            ValueError:
+                If the ID, size or name aren't acceptable, don't match an earlier offer with the same ID, or the file
+                won't fit in the spool's quota even after making room for it.
+        """
+        if not protocol.FILE_ID.match(file_id):
+            raise ValueError('bad-id')
+
+        if not 0 < size <= MAX_FILE_SIZE:
+            raise ValueError('bad-size')
+
+        name = protocol.file_name(name)
+        if name is None:
+            raise ValueError('bad-name')
+        name = name[:NAME_LIMIT]
+
+        entry = self.files.get(file_id)
+
+        if entry is not None:
+            if entry.size != size or entry.owner != owner:
+                raise ValueError('id-in-use')
+            return entry
+
+        if not self.make_room(size + META_SIZE):
+            raise ValueError('spool-full')
+
+        entry = SpoolFile(file_id, name, size, owner, self.dirpath)
+
+        with open(entry.meta_path, 'w') as file:
+            json.dump({'file_id': file_id, 'name': name, 'size': size, 'owner': owner}, file)
+
+        self.files[file_id] = entry
+        self.used += size + META_SIZE
+
+        return entry
+
+
+class Upload:
+    __slots__ = ('entry', 'fd', 'offset', 'expecting', 'discard')
+
+    def __init__(self, entry):
+        """
+        A client's upload into the spool, one '/chunk' at a time.
+
+        Arguments:
+            entry (SpoolFile):
+                The spool entry being uploaded.
+        """
+        self.entry = entry
+        self.fd = os.open(entry.part_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        self.offset = os.fstat(self.fd).st_size
+        self.expecting = 0
+        self.discard = False
+
+    @property
+    def done(self):
+        return self.offset >= self.entry.size
+
+    def start_chunk(self, offset, length):
+        """
+        Get ready for the raw bytes of a '/chunk'.
+
+        Chunks that don't carry on exactly where the last one stopped, or that would run past the end of the file, are
+        still read off the socket (so that we stay in step with the client) but thrown away.
+
+        Arguments:
+            offset (int):
+                Where in the file the chunk starts.
+
+            length (int):
+                How many raw bytes follow.
+
+        Returns:
+            Boolean:
+                True if the chunk will be kept, False if it'll be discarded.
+        """
+        self.expecting = length
+        self.discard = offset != self.offset or length > protocol.CHUNK_SIZE or offset + length > self.entry.size
+        return not self.discard
+
+    def write(self, view):
+        """
+        Take as many of the chunk's raw bytes as we're still expecting from received data.
+
+        Arguments:
+            view (memoryview):
+                The received data.
+
+        Returns:
+            int:
+                How many bytes of `view` were consumed.
+        """
+        view = view[:self.expecting]
+
+        if not self.discard:
+            written = 0
+            while written < len(view):
+                written += os.write(self.fd, view[written:])
+            self.offset += len(view)
+
+        self.expecting -= len(view)
+
+        return len(view)
+
+    def finish(self):
+        """
+        Close the upload, moving the file into place if all of it arrived.
+
+        Returns:
+            Boolean:
+                True if the file is complete.
+        """
+        os.close(self.fd)
+        self.fd = -1
+
+        if self.done:
+            try:
+                os.replace(self.entry.part_path, self.entry.path)
+            except FileNotFoundError:
+                # The upload stalled for long enough to be removed to make room for others.
+                return False
+            return True
+
+        return False
+
+    def dump(self):
+        return {'file_id': self.entry.file_id, 'expecting': self.expecting, 'discard': self.discard}
+
+    @classmethod
+    def load(cls, data, spool):
+        entry = spool.get(data['file_id'])
+        if entry is None:
+            raise ValueError(f'{data["file_id"]} is not in the spool.')
+
+        upload = cls(entry)
+        upload.expecting = data['expecting']
+        upload.discard = data['discard']
+        return upload
+
+
+class Download:
+    __slots__ = ('entry', 'fd', 'offset', 'head', 'remaining')
+
+    def __init__(self, entry, offset=0):
+        """
+        A file being streamed out of the spool to a client, one 'FILE DATA' chunk at a time.
+
+        Arguments:
+            entry (SpoolFile):
+                The (complete) spool entry to send.
+
+            offset (int):
+                Where in the file to start. (Defaults to 0)
+        """
+        self.entry = entry
+        self.fd = os.open(entry.path, os.O_RDONLY)
+        self.offset = offset
+        self.head = None
+        self.remaining = 0
+
+    @property
+    def sending(self):
+        """
+        Whether a chunk has been started and not finished. Nothing else may be written to the socket meanwhile.
+        """
+        return bool(self.head or self.remaining)
+
+    @property
+    def done(self):
+        return not self.sending and self.offset >= self.entry.size
+
+    def next_chunk(self):
+        """
+        Start the next chunk of the file.
+
+        Returns:
+            int:
+                The number of bytes of file data in the chunk.
+        """
+        length = min(protocol.CHUNK_SIZE, self.entry.size - self.offset)
+        line = f'{protocol.FILE_DATA} {self.entry.file_id} {self.offset} {length}'
+        self.head = memoryview(protocol.encode_line(line))
+        self.remaining = length
+        return length
+
+    def pump(self, sock):
+        """
+        Send as much of the current chunk as the (non-blocking) socket will take.
+
+        Arguments:
+            sock (socket.socket):
+                The client socket.
+
+        Returns:
+            Boolean:
+                True once the chunk has been sent in full, False if the socket filled up first.
+        """
+        try:
+            while self.head:
+                self.head = self.head[sock.send(self.head):]
+
+            while self.remaining:
+                if isinstance(sock, ssl.SSLSocket):
+                    # A retried TLS write has to start with the same bytes as the one that couldn't finish, which
+                    # reading from the same offset again gives us.
+                    data = os.pread(self.fd, min(self.remaining, TLS_READ_SIZE), self.offset)
+                    sent = sock.send(data) if data else 0
+                else:
+                    sent = os.sendfile(sock.fileno(), self.fd, self.offset, self.remaining)
+                if not sent:
+                    raise OSError(f'{self.entry.path} is shorter than expected.')
+                self.offset += sent
+                self.remaining -= sent
+        except WOULD_BLOCK:
+            return False
+
+        self.head = None
+        return True
+
+    def close(self):
+        os.close(self.fd)
+        self.fd = -1
+
+    def dump(self):
+        return {
+            'file_id': self.entry.file_id,
+            'offset': self.offset,
+            'head': bytes(self.head).decode(protocol.ENCODING) if self.head else None,
+            'remaining': self.remaining,
+        }
+
+    @classmethod
+    def load(cls, data, spool):
+        entry = spool.get(data['file_id'])
+        if entry is None or not entry.complete:
+            raise ValueError(f'{data["file_id"]} is not in the spool.')
+
+        download = cls(entry, data['offset'])
+        download.remaining = data['remaining']
+        if data['head']:
+            download.head = memoryview(data['head'].encode(protocol.ENCODING))
+        return download
@@ -0,0 +1,175 @@
+import json
+import selectors
+import socket
+from types import ModuleType
+
+import pytest
+
+from inspyred_chat.server import admin
+from inspyred_chat.server.admin import LISTING_BATCH, AdminServer, Listing, Timings, encode
+
+
+def double(value):
+    return value * 2
+
+
+def module():
+    owner = ModuleType('owner')
+    owner.double = double
+    return owner
+
+
+def test_timings_wrap_and_restore():
+    owner = module()
+    timings = Timings([('math', owner, 'double')])
+
+    timings.enable()
+
+    assert owner.double is not double
+    assert owner.double(2) == 4
+    owner.double(3)
+    assert timings.report()['math']['calls'] == 2
+
+    timings.enable()
+    timings.disable()
+
+    assert owner.double is double
+    assert not timings.enabled
+
+    timings.reset()
+    assert timings.report()['math']['calls'] == 0
+
+
+def test_timings_command():
+    timings = Timings([('math', module(), 'double')])
+
+    assert timings.command(['on'])['enabled']
+    assert not timings.command(['OFF'])['enabled']
+
+    with pytest.raises(ValueError):
+        timings.command(['sideways'])
+
+
+def test_encode_plain_answers():
+    assert b''.join(encode({'a': 1, 'b': [2]})) == b'{"a": 1, "b": [2]}\n'
+
+
+@pytest.mark.parametrize('payload', [
+    {'head': 1, 'items': Listing(range(LISTING_BATCH * 2 + 3), lambda n: None if n % 7 else {'n': n})},
+    {'items': Listing(range(LISTING_BATCH * 2 + 3), lambda n: n), 'more': Listing([], str)},
+    {'items': Listing([1, 2], lambda n: None)},
+])
+def test_encode_listings(payload):
+    chunks = list(encode(payload))
+    decoded = json.loads(b''.join(chunks))
+
+    assert chunks[-1].endswith(b'}\n')
+    assert all(b'\n' not in chunk for chunk in chunks[:-1])
+
+    for key, value in payload.items():
+        if isinstance(value, Listing):
+            expected = [value.describe(item) for item in value.items]
+            assert decoded[key] == [item for item in expected if item is not None]
+        else:
+            assert decoded[key] == value
+
+
+def test_listings_are_worked_out_a_batch_at_a_time():
+    described = []
+    chunks = encode({'items': Listing(range(LISTING_BATCH * 3), lambda n: described.append(n) or n)})
+
+    next(chunks)
+    next(chunks)
+    next(chunks)
+
+    assert len(described) == LISTING_BATCH
+
+
+def run_loop(selector, until):
+    for _ in range(1000):
+        if until():
+            return
+        for key, _ in selector.select(1):
+            key.data.ready(key.fileobj)
+
+    raise AssertionError('The admin server never got there.')
+
+
+def test_admin_server_answers_from_the_loop(tmp_path):
+    path = tmp_path.joinpath('admin.sock')
+    selector = selectors.DefaultSelector()
+    items = {n: n for n in range(LISTING_BATCH * 4)}
+    server = AdminServer(path, selector, {'stats': lambda args: {'items': Listing(list(items), items.get)}})
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(str(path))
+            client.sendall(b'stats\n')
+            client.setblocking(False)
+
+            data = bytearray()
+
+            def answered():
+                # Whatever's gone by the time its batch is written is left out.
+                if server.sending:
+                    items.pop(LISTING_BATCH * 4 - 1, None)
+
+                try:
+                    data.extend(client.recv(65536))
+                except BlockingIOError:
+                    pass
+
+                return data.endswith(b'\n') and not server.busy
+
+            run_loop(selector, answered)
+
+            assert json.loads(data) == {'items': list(range(LISTING_BATCH * 4 - 1))}
+    finally:
+        server.close()
+        selector.close()
+
+    assert not path.exists()
+
+
+def test_admin_server_unknown_command(tmp_path):
+    path = tmp_path.joinpath('admin.sock')
+    selector = selectors.DefaultSelector()
+    server = AdminServer(path, selector, {})
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(str(path))
+            client.sendall(b'bogus\n')
+
+            run_loop(selector, lambda: server.sending)
+            run_loop(selector, lambda: not server.busy)
+
+            client.settimeout(1)
+            answer = json.loads(client.recv(65536))
+
+        assert answer['error'] == 'unknown command: bogus'
+        assert 'threads' in answer['commands']
+    finally:
+        server.close()
+        selector.close()
+
+
+def test_stale_answers_are_given_up_on(tmp_path, monkeypatch):
+    monkeypatch.setattr(admin, 'REPLY_TIMEOUT', 0)
+    path = tmp_path.joinpath('admin.sock')
+    selector = selectors.DefaultSelector()
+    server = AdminServer(path, selector, {})
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(str(path))
+            client.sendall(b'bogus\n')
+
+            run_loop(selector, lambda: server.sending)
+
+            server.run_due()
+
+            assert not server.busy
+    finally:
+        server.close()
+        selector.close()
@@ -0,0 +1,79 @@
+from time import monotonic, sleep
+
+import pytest
+
+from inspyred_chat.server.capture import CONNECT, DISCONNECT, HEADER, MESSAGE, NICK, CaptureWriter, read_capture
+from inspyred_chat.server.capture.errors import CaptureFormatError
+from inspyred_chat.server.capture.replay import ReplayConnection, ReplayStats
+
+
+def test_capture_round_trip(tmp_path):
+    path = tmp_path.joinpath('capture.bin')
+    writer = CaptureWriter(path)
+
+    first = writer.new_connection(('127.0.0.1', 40000))
+    writer.record(NICK, first, 'alice')
+    sleep(0.05)
+    writer.record(MESSAGE, first, b'hello\n')
+    second = writer.new_connection(('127.0.0.1', 40001))
+    writer.record(DISCONNECT, first)
+    writer.close()
+
+    started, records = read_capture(path)
+
+    assert started > 0
+    assert [(r.kind, r.conn_id, r.payload) for r in records] == [
+        (CONNECT, first, b'127.0.0.1:40000'),
+        (NICK, first, b'alice'),
+        (MESSAGE, first, b'hello\n'),
+        (CONNECT, second, b'127.0.0.1:40001'),
+        (DISCONNECT, first, b''),
+    ]
+
+    offsets = [r.t_ns for r in records]
+    assert offsets == sorted(offsets)
+    assert offsets[2] - offsets[1] >= 50_000_000
+
+
+def test_capture_cut_short_is_read_up_to_the_last_record(tmp_path):
+    path = tmp_path.joinpath('capture.bin')
+    writer = CaptureWriter(path)
+    conn_id = writer.new_connection(('127.0.0.1', 40000))
+    writer.record(MESSAGE, conn_id, b'hello\n')
+    writer.close()
+
+    path.write_bytes(path.read_bytes()[:-3])
+
+    _, records = read_capture(path)
+
+    assert [r.kind for r in records] == [CONNECT]
+
+
+def test_read_capture_rejects_other_files(tmp_path):
+    path = tmp_path.joinpath('capture.bin')
+
+    path.write_bytes(b'ICC')
+    with pytest.raises(CaptureFormatError):
+        read_capture(path)
+
+    path.write_bytes(b'x' * HEADER.size)
+    with pytest.raises(CaptureFormatError):
+        read_capture(path)
+
+
+def test_replay_scales_offsets_by_speed():
+    conn = ReplayConnection(0, [], ('127.0.0.1', 5300), 10, monotonic(), ReplayStats())
+
+    conn.wait_until(500_000_000)
+
+    assert 0.045 <= monotonic() - conn.start_time < 0.2
+
+
+def test_replay_report_counts_failed_connects():
+    stats = ReplayStats()
+
+    for _ in range(2):
+        stats.connecting()
+        stats.error('connect failed')
+
+    assert 'Errors: 2 (100.00% of connects + sends)' in stats.report(1.0)
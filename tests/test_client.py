@@ -0,0 +1,131 @@
+import io
+
+import pytest
+
+pytest.importorskip('appdirs')
+
+import inspyred_chat.client as client_module
+from inspyred_chat.client import Client
+from inspyred_chat.client.output import Output
+
+FILE_ID = 'a' * 32
+
+
+class Lines(list):
+    def emit(self, line):
+        self.append(line)
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(client_module, 'DOWNLOAD_DIR', tmp_path)
+
+    # Built by hand, as a real one connects to a server as soon as it's made.
+    client = Client.__new__(Client)
+    client.output = Lines()
+    client.files = {}
+    client.downloads = {}
+    client.sink = None
+    client.handlers = {'FILE': client.handle_file_message}
+
+    return client
+
+
+def receive(client, reads):
+    """
+    Feed data to `client` a read at a time, the way its receive thread does.
+    """
+    pending = b''
+    for data in reads:
+        data = pending + data
+        pending = data[client.process(data):]
+
+    return pending
+
+
+def download(client, data, name='notes.txt', file_id=FILE_ID):
+    client.start_download(f'FILE START {file_id} {len(data)} {name}')
+    client.start_sink(f'FILE DATA {file_id} 0 {len(data)}')
+    client.write_sink(memoryview(data))
+
+
+def test_downloads_never_replace_existing_files(client, tmp_path):
+    tmp_path.joinpath('notes.txt').write_bytes(b'mine')
+
+    download(client, b'first')
+    download(client, b'second', file_id='b' * 32)
+
+    assert tmp_path.joinpath('notes.txt').read_bytes() == b'mine'
+    assert tmp_path.joinpath('notes (1).txt').read_bytes() == b'first'
+    assert tmp_path.joinpath('notes (2).txt').read_bytes() == b'second'
+    assert not list(tmp_path.glob('*.part'))
+
+
+@pytest.mark.parametrize('file_id, name', [
+    (FILE_ID, '..'),
+    (FILE_ID, '.'),
+    ('../../' + 'a' * 26, 'notes.txt'),
+])
+def test_bad_files_are_not_downloaded(client, tmp_path, file_id, name):
+    client.start_download(f'FILE START {file_id} 5 {name}')
+
+    assert not client.downloads
+    assert not list(tmp_path.iterdir())
+    assert client.output
+
+
+def test_fetch_checks_the_file_id(client):
+    client.fetch_file('../../etc/passwd')
+
+    assert client.output == ["'../../etc/passwd' isn't a file ID."]
+
+
+def test_partial_lines_wait_for_the_rest(client):
+    assert client.process(b'hello\nwor') == len(b'hello\n')
+    assert client.output == ['hello']
+
+    assert receive(client, [b'hello\nwor', b'ld\nand', b' more']) == b'and more'
+    assert client.output == ['hello', 'hello', 'world']
+
+
+def test_several_messages_in_one_read(client):
+    data = b'one\ntwo\n\xffthree\n'
+
+    assert client.process(data) == len(data)
+    assert client.output == ['one', 'two', '\ufffdthree']
+
+
+@pytest.mark.parametrize('size', [1, 7, 64, 4096])
+def test_file_data_split_across_reads(client, tmp_path, size):
+    body = b'line one\nline two\n' * 20
+    data = (
+        f'FILE START {FILE_ID} {len(body)} notes.txt\n'.encode()
+        + f'FILE DATA {FILE_ID} 0 100\n'.encode() + body[:100]
+        + b'between\n'
+        + f'FILE DATA {FILE_ID} 100 {len(body) - 100}\n'.encode() + body[100:]
+        + b'after\n'
+    )
+
+    assert receive(client, [data[i:i + size] for i in range(0, len(data), size)]) == b''
+
+    assert tmp_path.joinpath('notes.txt').read_bytes() == body
+    assert client.output == ['between', f'Saved {tmp_path.joinpath("notes.txt")}', 'after']
+    assert client.sink is None and not client.downloads
+
+
+def test_output_counts_dropped_lines():
+    stream = io.StringIO()
+    output = Output(stream=stream, max_pending=2)
+
+    # Stop the writer first, so nothing is shown until we say.
+    output.close()
+
+    for n in range(5):
+        output.emit(f'line {n}')
+
+    assert output.dropped == 3
+
+    output.flush()
+
+    assert stream.getvalue() == '[3 messages not shown; use /scrollback to see them]\nline 3\nline 4\n'
+    assert output.dropped == 0
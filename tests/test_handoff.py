@@ -0,0 +1,119 @@
+import os
+import socket
+from collections import deque
+from threading import Thread
+
+import pytest
+
+from inspyred_chat.server import handoff
+from inspyred_chat.server.history import History
+from inspyred_chat.server.roster import Roster
+from inspyred_chat.server.session import ACTIVE, Session
+from inspyred_chat.server.transfer import Download, Spool, Upload
+
+
+def test_frames_carry_file_descriptors():
+    ours, theirs = socket.socketpair(socket.AF_UNIX)
+    read_end, write_end = os.pipe()
+
+    try:
+        handoff.send_frame(ours, {'type': 'test', 'text': 'x' * 100000}, [read_end])
+        payload, fds = handoff.recv_frame(theirs)
+
+        assert payload == {'type': 'test', 'text': 'x' * 100000}
+        assert len(fds) == 1
+
+        os.write(write_end, b'through')
+        assert os.read(fds[0], 16) == b'through'
+        os.close(fds[0])
+
+        ours.close()
+        with pytest.raises(ConnectionError):
+            handoff.recv_frame(theirs)
+    finally:
+        for fd in (read_end, write_end):
+            os.close(fd)
+        ours.close()
+        theirs.close()
+
+
+def test_hand_off_round_trip(tmp_path):
+    spool = Spool(tmp_path.joinpath('spool'))
+    partial = spool.offer('a' * 32, 10, 'up.txt', 'alice')
+    complete = spool.offer('b' * 32, 5, 'down.txt', 'bob')
+    complete.path.write_bytes(b'hello')
+
+    roster = Roster()
+    roster.join(1, 'alice')
+    roster.commit()
+
+    history = History()
+    history.record('alice', 'hello')
+
+    ours, theirs = socket.socketpair()
+    ours.setblocking(False)
+    session = Session(ours, ('127.0.0.1', 40000), client_id=1)
+    session.set_nick('alice')
+    session.state = ACTIVE
+    session.rbuf = bytearray(b'half a li')
+    session.wbuf = bytearray(b'queued\n')
+    session.grace = 3
+    session.upload = Upload(partial)
+    session.upload.start_chunk(0, 4)
+    session.downloads = deque([Download(complete)])
+    session.downloads[0].next_chunk()
+
+    server = socket.create_server(('127.0.0.1', 0))
+    listener = handoff.listen(tmp_path.joinpath('handoff.sock'))
+    listener.setblocking(True)
+
+    def old_server():
+        conn, _ = listener.accept()
+        with conn:
+            handoff.hand_off(conn, server, [session], roster.dump(), history.dump())
+
+    old = Thread(target=old_server)
+    old.start()
+
+    conn, new_server, roster_data, history_data = handoff.connect(tmp_path.joinpath('handoff.sock'))
+    loaded = None
+
+    try:
+        payload, fds = handoff.recv_frame(conn)
+        assert payload['type'] == handoff.SESSIONS
+        loaded = handoff.load_session(payload['sessions'][0], socket.socket(fileno=fds[0]), spool)
+
+        payload, _ = handoff.recv_frame(conn)
+        assert payload == {'type': handoff.DONE, 'count': 1}
+        handoff.send_frame(conn, {'type': handoff.ACK})
+        old.join()
+
+        new_roster, new_history = Roster(), History()
+        new_roster.load(roster_data)
+        new_history.load(history_data)
+        assert new_roster.members == roster.members
+        assert new_history.since(0) == history.since(0)
+
+        assert new_server.getsockname() == server.getsockname()
+
+        assert (loaded.nick, loaded.client_id, loaded.connection_id, loaded.state, loaded.addr) == \
+            ('alice', 1, session.connection_id, ACTIVE, ('127.0.0.1', 40000))
+        assert (loaded.rbuf, loaded.wbuf, loaded.grace) == (b'half a li', b'queued\n', 3)
+        assert (loaded.upload.entry.file_id, loaded.upload.offset, loaded.upload.expecting) == ('a' * 32, 0, 4)
+        download, = loaded.downloads
+        assert (download.entry.file_id, download.remaining, bytes(download.head)) == \
+            ('b' * 32, 5, b'FILE DATA ' + b'b' * 32 + b' 0 5\n')
+
+        session.sock.close()
+        theirs.sendall(b'ne\n')
+        loaded.sock.setblocking(True)
+        assert loaded.sock.recv(16) == b'ne\n'
+    finally:
+        old.join()
+        for sock in (conn, new_server, server, listener, theirs):
+            sock.close()
+        for each in (session, loaded):
+            if each is not None:
+                each.sock.close()
+                each.upload.finish()
+                each.downloads[0].close()
@@ -0,0 +1,59 @@
+from inspyred_chat import protocol
+from inspyred_chat.server.history import History
+
+
+def seqs(data):
+    return [protocol.parse_chat(line)[0] for line in data.decode(protocol.ENCODING).splitlines()]
+
+
+def test_record_numbers_messages():
+    history = History()
+
+    first = history.record('alice', 'hello')
+    history.record('bob', 'hi')
+
+    assert history.seq == 2
+    assert seqs(first) == [1]
+
+
+def test_since_returns_only_what_was_missed():
+    history = History()
+    for i in range(5):
+        history.record('alice', str(i))
+
+    data, last = history.since(2)
+
+    assert seqs(data) == [3, 4, 5]
+    assert last == 5
+    assert history.since(5) == (b'', 5)
+
+
+def test_since_starts_at_the_oldest_remembered_message():
+    history = History(size=3)
+    for i in range(5):
+        history.record('alice', str(i))
+
+    assert history.oldest == 3
+    assert seqs(history.since(0)[0]) == [3, 4, 5]
+
+
+def test_since_is_limited_but_always_returns_something():
+    history = History()
+    for i in range(5):
+        history.record('alice', 'x' * 100)
+
+    data, last = history.since(0, limit=1)
+
+    assert seqs(data) == [1]
+    assert last == 1
+
+
+def test_dump_and_load():
+    history = History(size=3)
+    for i in range(5):
+        history.record('alice', str(i))
+
+    other = History(size=3)
+    other.load(history.dump())
+
+    assert (other.epoch, other.seq, list(other.ring)) == (history.epoch, history.seq, list(history.ring))
@@ -0,0 +1,96 @@
+import json
+
+import pytest
+
+from inspyred_chat import protocol
+
+
+def test_encode_line_keeps_a_single_line():
+    assert protocol.encode_line('one\ntwo') == b'one two\n'
+    assert protocol.encode_line('café') == b'caf?\n'
+
+
+def test_next_line_stops_after_each_line():
+    data = b'first\nsecond\npart'
+
+    line, pos = protocol.next_line(data)
+    assert line == 'first'
+
+    line, pos = protocol.next_line(data, pos)
+    assert line == 'second'
+
+    assert protocol.next_line(data, pos) == (None, pos)
+    assert data[pos:] == b'part'
+
+
+@pytest.mark.parametrize('name, expected', [
+    ('notes.txt', 'notes.txt'),
+    ('../../notes.txt', 'notes.txt'),
+    ('C:\\Users\\alice\\notes.txt', 'notes.txt'),
+    ('', None),
+    ('.', None),
+    ('..', None),
+    ('dir/', None),
+    ('bell\x07', None),
+])
+def test_file_name(name, expected):
+    assert protocol.file_name(name) == expected
+
+
+def test_snapshot_round_trip():
+    members = {1: 'alice', 2 ** 127: 'bob'}
+
+    line = protocol.format_snapshot(7, members)
+    from_version, to_version, added, removed = protocol.parse_roster(line)
+
+    assert from_version is None
+    assert to_version == 7
+    assert {int(uid, 16): nick for uid, nick in added.items()} == members
+    assert removed == []
+
+
+def test_delta_round_trip():
+    line = protocol.format_delta(3, 4, {5: 'carol'}, {6})
+    from_version, to_version, added, removed = protocol.parse_roster(line)
+
+    assert (from_version, to_version) == (3, 4)
+    assert added == {f'{5:032x}': 'carol'}
+    assert removed == [f'{6:032x}']
+
+
+def test_delta_is_compact():
+    line = protocol.format_delta(0, 1, {5: 'carol'}, [])
+    body = line.split(' ', 4)[4]
+
+    assert ' ' not in body
+    assert json.loads(body) == {'+': {f'{5:032x}': 'carol'}, '-': []}
+
+
+@pytest.mark.parametrize('line', ['ROSTER', 'ROSTER SNAPSHOT x {}', 'ROSTER DELTA 1 2 {"+": {}}', 'CHAT 1 2 <<a>> b'])
+def test_parse_roster_rejects_malformed_lines(line):
+    with pytest.raises((ValueError, KeyError)):
+        protocol.parse_roster(line)
+
+
+@pytest.mark.parametrize('nick, valid', [
+    ('alice', True),
+    ('Bob_2', True),
+    ('', False),
+    ('two words', False),
+    ('tab\there', False),
+    ('bell\x07', False),
+])
+def test_valid_nick(nick, valid):
+    assert protocol.valid_nick(nick) is valid
+
+
+def test_chat_round_trip():
+    line = protocol.format_chat(42, 1660000000000, 'alice', 'hello >> there')
+
+    assert protocol.parse_chat(line) == (42, 1660000000000, 'alice', 'hello >> there', '<<alice>> hello >> there')
+
+
+@pytest.mark.parametrize('line', ['CHATTY 1 2 <<a>> b', 'CHAT x 2 <<a>> b', 'CHAT 1', 'SYNC abc 1'])
+def test_parse_chat_rejects_malformed_lines(line):
+    with pytest.raises(ValueError):
+        protocol.parse_chat(line)
@@ -0,0 +1,103 @@
+from inspyred_chat.server.roster import Roster
+
+
+def test_nothing_is_committed_until_asked():
+    roster = Roster()
+
+    roster.join(1, 'alice')
+
+    assert roster.version == 0
+    assert len(roster) == 0
+    assert roster.deadline is not None
+
+
+def test_changes_are_coalesced_into_one_version():
+    roster = Roster()
+
+    roster.join(1, 'alice')
+    roster.join(2, 'bob')
+
+    assert roster.commit() == (0, 1, {1: 'alice', 2: 'bob'}, set())
+    assert roster.members == {1: 'alice', 2: 'bob'}
+    assert roster.deadline is None
+
+    roster.leave(1)
+    roster.join(3, 'carol')
+
+    assert roster.commit() == (1, 2, {3: 'carol'}, {1})
+    assert roster.members == {2: 'bob', 3: 'carol'}
+
+
+def test_join_and_leave_in_one_window_cancel_out():
+    roster = Roster()
+
+    roster.join(1, 'alice')
+    roster.leave(1)
+
+    assert roster.commit() is None
+    assert roster.version == 0
+
+
+def test_reconnect_in_one_window_cancels_out():
+    roster = Roster()
+    roster.join(1, 'alice')
+    roster.commit()
+
+    roster.leave(1)
+    roster.join(1, 'alice')
+
+    assert roster.commit() is None
+    assert roster.version == 1
+    assert roster.members == {1: 'alice'}
+
+
+def test_rejoin_with_a_new_nick_is_an_addition():
+    roster = Roster()
+    roster.join(1, 'alice')
+    roster.commit()
+
+    roster.leave(1)
+    roster.join(1, 'alicia')
+
+    assert roster.commit() == (1, 2, {1: 'alicia'}, set())
+    assert roster.members == {1: 'alicia'}
+
+
+def test_due_once_the_window_passes():
+    roster = Roster(window=0)
+
+    assert not roster.due
+
+    roster.join(1, 'alice')
+
+    assert roster.due
+
+
+def test_snapshot_is_built_once_per_version():
+    roster = Roster()
+    roster.join(1, 'alice')
+    roster.commit()
+
+    snapshot = roster.snapshot()
+
+    assert snapshot.startswith(b'ROSTER SNAPSHOT 1 ')
+    assert roster.snapshot() is snapshot
+
+    roster.join(2, 'bob')
+    roster.commit()
+
+    assert roster.snapshot() is not snapshot
+    assert roster.snapshot().startswith(b'ROSTER SNAPSHOT 2 ')
+
+
+def test_dump_and_load():
+    roster = Roster()
+    roster.join(2 ** 127, 'alice')
+    roster.commit()
+
+    other = Roster()
+    other.load(roster.dump())
+
+    assert other.version == 1
+    assert other.members == {2 ** 127: 'alice'}
+    assert other.snapshot() == roster.snapshot()
@@ -0,0 +1,170 @@
+import resource
+import selectors
+import socket
+import tracemalloc
+
+import pytest
+
+from inspyred_chat.server.session import ACTIVE, IDLE_SESSION_BUDGET, MAX_WRITE_BUFFER, Session, SessionTable
+
+
+def build_sessions(socks, table, selector, start=0):
+    for i, sock in enumerate(socks, start):
+        sock.setblocking(False)
+        session = Session(sock, ('127.0.0.1', 40000 + i % 20000))
+        session.set_nick(f'user{i}')
+        session.state = ACTIVE
+        table.add(session)
+        selector.register(sock, selectors.EVENT_READ, session)
+
+
+def idle_footprint(small=5000, large=10000, warmup=1000):
+    """
+    Measure how much Python heap an idle, fully handshaken connection costs.
+
+    Builds sessions over local sockets and registers them with a selector the same way the server does, measuring the
+    heap with tracemalloc once `small` and once `large` of them exist. Only the difference between the two is used, so
+    one-off costs don't count. `large` should be twice `small`; the table's and selector's dicts then have the same
+    amount of room to spare at both points rather than one of them having just been resized. A batch of `warmup`
+    sessions is built and thrown away first to prime the allocators. The sockets are all created before measuring
+    starts so that only the server's own state is counted; the warmup reuses them.
+
+    Arguments:
+        small (int):
+            How many sessions to take the first measurement at. (Defaults to 5000)
+
+        large (int):
+            How many sessions to take the second measurement at. (Defaults to 10000)
+
+        warmup (int):
+            How many sessions to build and discard before measuring. (Defaults to 1000)
+
+    Returns:
+        Float:
+            The average number of bytes per idle session.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    needed = large + 100
+
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        if hard != resource.RLIM_INFINITY and hard < needed:
+            pytest.skip(f'Measuring needs {needed} file descriptors but only {hard} are allowed.')
+        resource.setrlimit(resource.RLIMIT_NOFILE, (needed, hard))
+
+    socks = []
+
+    try:
+        socks = [socket.socket() for _ in range(large)]
+
+        selector = selectors.DefaultSelector()
+        build_sessions(socks[:warmup], SessionTable(), selector)
+        selector.close()
+
+        table = SessionTable()
+        selector = selectors.DefaultSelector()
+
+        try:
+            tracemalloc.start()
+            build_sessions(socks[:small], table, selector)
+            before = tracemalloc.get_traced_memory()[0]
+            build_sessions(socks[small:], table, selector, small)
+            after = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+            selector.close()
+    finally:
+        for sock in socks:
+            sock.close()
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+    return (after - before) / (large - small)
+
+
+def test_session_buffers_only_what_the_socket_wont_take():
+    ours, theirs = socket.socketpair()
+    ours.setblocking(False)
+
+    try:
+        session = Session(ours, ('127.0.0.1', 40000))
+
+        assert not session.send(b'hello\n')
+        assert session.wbuf is None
+        assert theirs.recv(16) == b'hello\n'
+
+        sent = 6
+        while not session.send(b'x' * 65536):
+            sent += 65536
+        sent += 65536
+        assert session.pending > 0
+
+        while session.pending:
+            theirs.recv(1024 * 1024)
+            session.flush()
+        assert session.wbuf is None
+        assert session.tx == sent
+    finally:
+        ours.close()
+        theirs.close()
+
+
+def test_session_queue_is_bounded():
+    ours, theirs = socket.socketpair()
+
+    try:
+        session = Session(ours, ('127.0.0.1', 40000))
+        session.queue(b'x' * MAX_WRITE_BUFFER)
+
+        with pytest.raises(BufferError):
+            session.queue(b'x')
+    finally:
+        ours.close()
+        theirs.close()
+
+
+def test_oversized_messages_dont_count_towards_the_limit():
+    ours, theirs = socket.socketpair()
+
+    try:
+        ours.setblocking(False)
+        session = Session(ours, ('127.0.0.1', 40000))
+        session.queue(b'x' * MAX_WRITE_BUFFER * 2, oversized=True)
+        session.queue(b'x' * MAX_WRITE_BUFFER)
+
+        with pytest.raises(BufferError):
+            session.queue(b'x')
+
+        theirs.setblocking(False)
+        while session.flush():
+            try:
+                while theirs.recv(1024 * 1024):
+                    pass
+            except BlockingIOError:
+                pass
+
+        assert session.grace == 0
+    finally:
+        ours.close()
+        theirs.close()
+
+
+def test_session_table_rekey():
+    ours, theirs = socket.socketpair()
+
+    try:
+        table = SessionTable()
+        session = Session(ours, ('127.0.0.1', 40000), client_id=1)
+        table.add(session)
+
+        table.rekey(session, 2)
+
+        assert not table.has_client_id(1)
+        assert table.by_client_id(2) is session
+        assert table.get(ours.fileno()) is session
+
+        table.remove(session)
+
+        assert len(table) == 0
+        assert not table.has_client_id(2)
+    finally:
+        ours.close()
+        theirs.close()
@@ -0,0 +1,62 @@
+import pytest
+
+pytest.importorskip('appdirs')
+
+from inspyred_chat.client.store import MessageStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = MessageStore(tmp_path.joinpath('messages.sqlite3'))
+    yield store
+    store.close()
+
+
+def test_add_ignores_duplicates(store):
+    assert store.add('host:5300', 'e', 1, 1000, 'alice', 'hello')
+    assert not store.add('host:5300', 'e', 1, 1000, 'alice', 'hello')
+    assert store.add('host:5300', 'other', 1, 1000, 'alice', 'hello')
+
+
+def test_high_water(store):
+    assert store.high_water('host:5300') == (None, 0)
+
+    store.set_high_water('host:5300', 'e', 5)
+    store.set_high_water('host:5300', 'e', 6)
+    store.commit()
+
+    assert store.high_water('host:5300') == ('e', 6)
+
+
+def test_pages_walk_back_in_time(store):
+    for seq in range(1, 121):
+        store.add('host:5300', 'e', seq, 1000 + seq, 'alice', str(seq))
+    store.add('elsewhere:5300', 'e', 1, 5000, 'bob', 'not ours')
+    store.commit()
+
+    seen = []
+    before = None
+
+    while True:
+        page = store.page('host:5300', before, limit=50)
+        if not page:
+            break
+        seen[:0] = [row[1] for row in page]
+        before = page[0][2], page[0][0]
+
+    assert seen == list(range(1, 121))
+
+
+def test_pruned_to_its_limit(tmp_path):
+    store = MessageStore(tmp_path.joinpath('messages.sqlite3'), max_bytes=256 * 1024)
+
+    try:
+        for seq in range(1, 20001):
+            store.add('host:5300', 'e', seq, seq, 'alice', 'x' * 100)
+            if not seq % 1000:
+                store.commit()
+
+        assert store.size() <= 256 * 1024 * 2
+        assert store.page('host:5300', limit=1)[0][1] == 20000
+    finally:
+        store.close()
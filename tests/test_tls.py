@@ -0,0 +1,121 @@
+import selectors
+import socket
+import ssl
+from threading import Thread
+
+import pytest
+
+pytest.importorskip('cryptography')
+
+from inspyred_chat.server import tls
+
+
+@pytest.fixture
+def cert(tmp_path):
+    cert_path, key_path = str(tmp_path.joinpath('cert.pem')), str(tmp_path.joinpath('key.pem'))
+    tls.generate_self_signed(cert_path, key_path, ['localhost', '127.0.0.1'])
+    return cert_path, key_path
+
+
+def serve_one(server, context, pool):
+    """
+    Accept a connection and handshake it the way the server does; a step at a time on the pool, waiting on the
+    selector in between.
+    """
+    conn, _ = server.accept()
+    conn.setblocking(False)
+    sock = context.wrap_socket(conn, server_side=True, do_handshake_on_connect=False)
+
+    selector = selectors.DefaultSelector()
+    selector.register(pool.fileobj, selectors.EVENT_READ)
+
+    try:
+        pool.submit(sock, 'tag')
+
+        for _ in range(10):
+            assert selector.select(5)
+            results = pool.results()
+            if not results:
+                continue
+
+            (tag, result), = results
+            assert tag == 'tag'
+
+            if result == tls.DONE:
+                sock.sendall(b'hello\n')
+                return sock
+
+            assert result in (tls.READ, tls.WRITE)
+
+            event = selectors.EVENT_READ if result == tls.READ else selectors.EVENT_WRITE
+            selector.register(sock, event)
+            assert selector.select(5)
+            selector.unregister(sock)
+            pool.submit(sock, 'tag')
+
+        raise AssertionError('The handshake never finished.')
+    finally:
+        selector.close()
+
+
+def test_handshakes_complete_and_resume(cert):
+    context = tls.server_context(*cert)
+    assert tls.server_context(*cert) is context
+
+    client_context = ssl.create_default_context(cafile=cert[0])
+    pool = tls.HandshakePool(workers=2)
+    server = socket.create_server(('127.0.0.1', 0))
+    server.settimeout(5)
+    session, reused = None, []
+
+    def client():
+        nonlocal session
+
+        for _ in range(2):
+            with socket.create_connection(server.getsockname()) as sock:
+                with client_context.wrap_socket(sock, server_hostname='127.0.0.1', session=session) as ssock:
+                    # TLS 1.3 session tickets arrive after the handshake, along with the first data.
+                    ssock.recv(16)
+                    session = ssock.session
+                    reused.append(ssock.session_reused)
+
+    thread = Thread(target=client)
+    thread.start()
+
+    try:
+        with serve_one(server, context, pool) as first, serve_one(server, context, pool) as second:
+            thread.join(5)
+
+            assert not first.session_reused
+            assert second.session_reused
+            assert reused == [False, True]
+    finally:
+        thread.join(5)
+        server.close()
+        pool.close()
+
+
+def test_failed_handshakes_are_reported(cert):
+    context = tls.server_context(*cert)
+    pool = tls.HandshakePool(workers=1)
+    ours, theirs = socket.socketpair()
+
+    try:
+        ours.setblocking(False)
+        sock = context.wrap_socket(ours, server_side=True, do_handshake_on_connect=False)
+        theirs.sendall(b'GET / HTTP/1.1\r\n\r\n')
+
+        pool.submit(sock, 'tag')
+
+        selector = selectors.DefaultSelector()
+        selector.register(pool.fileobj, selectors.EVENT_READ)
+        selector.select(5)
+        selector.close()
+
+        (tag, result), = pool.results()
+        assert tag == 'tag'
+        assert isinstance(result, (ssl.SSLError, OSError))
+    finally:
+        pool.close()
+        ours.close()
+        theirs.close()
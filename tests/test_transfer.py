@@ -0,0 +1,121 @@
+import json
+import os
+
+import pytest
+
+from inspyred_chat.server.transfer import META_SIZE, Spool, Upload
+
+FILE_ID = 'a' * 32
+
+
+def test_offer_is_resumable(tmp_path):
+    spool = Spool(tmp_path)
+    entry = spool.offer(FILE_ID, 10, 'notes.txt', 'alice')
+
+    upload = Upload(entry)
+    upload.start_chunk(0, 4)
+    upload.write(memoryview(b'abcd'))
+    upload.finish()
+
+    assert spool.offer(FILE_ID, 10, 'notes.txt', 'alice').received == 4
+
+    with pytest.raises(ValueError, match='id-in-use'):
+        spool.offer(FILE_ID, 11, 'notes.txt', 'alice')
+
+
+@pytest.mark.parametrize('file_id, size, name, reason', [
+    ('not-an-id', 10, 'notes.txt', 'bad-id'),
+    (FILE_ID, 0, 'notes.txt', 'bad-size'),
+    (FILE_ID, 10, '', 'bad-name'),
+    (FILE_ID, 10, '.', 'bad-name'),
+    (FILE_ID, 10, '..', 'bad-name'),
+    (FILE_ID, 10, 'dir/..', 'bad-name'),
+])
+def test_offer_rejects_bad_files(tmp_path, file_id, size, name, reason):
+    with pytest.raises(ValueError, match=reason):
+        Spool(tmp_path).offer(file_id, size, name, 'alice')
+
+
+def test_quota(tmp_path):
+    spool = Spool(tmp_path, quota=2 * (100 + META_SIZE))
+
+    spool.offer('a' * 32, 100, 'one', 'alice')
+    spool.offer('b' * 32, 100, 'two', 'alice')
+
+    with pytest.raises(ValueError, match='spool-full'):
+        spool.offer('c' * 32, 1, 'three', 'alice')
+
+    assert Spool(tmp_path).used == spool.used
+
+
+def test_offer_keeps_only_the_file_name(tmp_path):
+    assert Spool(tmp_path).offer(FILE_ID, 10, '../../notes.txt', 'alice').name == 'notes.txt'
+
+
+def complete(entry):
+    entry.path.write_bytes(b'x' * entry.size)
+
+
+def test_oldest_complete_files_make_room(tmp_path):
+    spool = Spool(tmp_path, quota=2 * (100 + META_SIZE))
+
+    old = spool.offer('a' * 32, 100, 'old', 'alice')
+    new = spool.offer('b' * 32, 100, 'new', 'alice')
+    complete(old)
+    complete(new)
+    os.utime(old.path, (1, 1))
+
+    spool.offer('c' * 32, 100, 'newest', 'alice')
+
+    assert spool.get('a' * 32) is None
+    assert not old.path.exists() and not old.meta_path.exists()
+    assert spool.get('b' * 32) is new
+    assert spool.used == 2 * (100 + META_SIZE)
+    assert Spool(tmp_path).used == spool.used
+
+
+def test_only_stale_uploads_make_room(tmp_path):
+    spool = Spool(tmp_path, quota=2 * (100 + META_SIZE), part_max_age=60)
+
+    stale = spool.offer('a' * 32, 100, 'stale', 'alice')
+    Upload(stale).finish()
+    fresh = spool.offer('b' * 32, 100, 'fresh', 'alice')
+    Upload(fresh).finish()
+
+    with pytest.raises(ValueError, match='spool-full'):
+        spool.offer('c' * 32, 100, 'new', 'alice')
+
+    os.utime(stale.part_path, (1, 1))
+
+    spool.offer('c' * 32, 100, 'new', 'alice')
+
+    assert spool.get('a' * 32) is None
+    assert not stale.part_path.exists()
+    assert spool.get('b' * 32) is fresh
+
+
+@pytest.mark.parametrize('sidecar', [
+    {'file_id': FILE_ID, 'name': 'notes.txt', 'size': 10},
+    {'file_id': FILE_ID, 'name': 'notes.txt', 'size': 10, 'owner': 'alice', 'extra': 1},
+    {'file_id': 'b' * 32, 'name': 'notes.txt', 'size': 10, 'owner': 'alice'},
+    {'file_id': FILE_ID, 'name': 'notes.txt', 'size': '10', 'owner': 'alice'},
+    {'file_id': FILE_ID, 'name': '..', 'size': 10, 'owner': 'alice'},
+    [FILE_ID],
+])
+def test_bad_sidecars_are_skipped(tmp_path, sidecar):
+    tmp_path.joinpath(f'{FILE_ID}.json').write_text(json.dumps(sidecar))
+
+    spool = Spool(tmp_path)
+
+    assert spool.get(FILE_ID) is None
+    assert spool.used == 0
+
+
+def test_files_offered_elsewhere_are_found(tmp_path):
+    ours, theirs = Spool(tmp_path), Spool(tmp_path)
+
+    theirs.offer(FILE_ID, 10, 'notes.txt', 'alice')
+
+    assert ours.get(FILE_ID).name == 'notes.txt'
+    assert ours.get('b' * 32) is None
+    assert ours.get('../../etc/passwd') is None